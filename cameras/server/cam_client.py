@@ -1,7 +1,40 @@
-import socket
 import time
-import json
-from utils.message_client import send_message
+from utils.message_client import get_pool, client_command
+from utils.async_client import AsyncClient, async_command
+
+# Commands that are safe to send again when the connection drops before
+# the reply arrives
+IDEMPOTENT = ['STATUS', 'PREFIX']
+
+
+class CameraRequests:
+    """
+    Command and parameters of each camera server request.  Camera and
+    AsyncCamera both send what these return, so the blocking and asyncio
+    clients can't drift apart.
+    """
+
+    @staticmethod
+    def initialize():
+        return "INITIALIZE", None
+
+    @staticmethod
+    def shutdown():
+        return "SHUTDOWN", None
+
+    @staticmethod
+    def status():
+        return "STATUS", None
+
+    @staticmethod
+    def prefix():
+        return "PREFIX", None
+
+    @staticmethod
+    def take_image(shutter='normal', exptime=0.0, readout=2.0, save_as=""):
+        parameters = {'shutter': shutter, "exptime": exptime,
+                      "readout": readout, "save_as": save_as}
+        return "TAKE_IMAGE", parameters
 
 
 class Camera:
@@ -15,8 +48,9 @@ class Camera:
 
         self.address = address
         self.port = port
-        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.socket.connect((self.address, self.port))
+        # Shared with every other client of the same server
+        self.connection = get_pool(self.address, self.port,
+                                   idempotent=IDEMPOTENT)
 
     def __send_command(self, cmd="", parameters=None, timeout=300,
                        return_before_done=False):
@@ -27,42 +61,76 @@ class Camera:
         :param timeout: timeout in seconds for waiting for a command
         :return: Tuple (bool,string)
         """
-        return send_message(self.socket, cmd=cmd, parameters=parameters,
-                            timeout=timeout,
-                            return_before_done=return_before_done,
-                            start=time.time())
+        return self.connection.send_command(
+            cmd=cmd, parameters=parameters, timeout=timeout,
+            return_before_done=return_before_done, start=time.time())
 
-    def initialize(self):
-        return self.__send_command(cmd="INITIALIZE")
+    def send_request(self, cmd, parameters=None, **options):
+        """
+        Send a command made by CameraRequests, see client_command
+        """
+        return self.__send_command(cmd=cmd, parameters=parameters, **options)
 
-    def shutdown(self):
-        return self.__send_command(cmd="SHUTDOWN")
+    def check_socket(self):
+        """
+        Try sending a command to the camera program
+        :return:(bool,response)
+        """
+        return self.__send_command(cmd="PING", timeout=10)
+
+    def get_metrics(self, command=None, reset=False):
+        """
+        Latency histograms, counts and error counts the server keeps for
+        each command
+        :param command: only return this command
+        :param reset: have the server start counting again
+        :return: dictionary
+        """
+        parameters = {
+            'command': command,
+            'reset': reset
+        }
+        return self.__send_command(cmd="METRICS", parameters=parameters)
+
+    initialize = client_command(CameraRequests.initialize)
+    shutdown = client_command(CameraRequests.shutdown)
+    status = client_command(CameraRequests.status)
+    prefix = client_command(CameraRequests.prefix)
+    take_image = client_command(CameraRequests.take_image,
+                                return_before_done=False)
+
+    def listen(self, request_id=None, timeout=None):
+        """
+        Wait for the reply of a command sent with return_before_done
+        :param request_id: 'id' of the early return, defaults to the oldest
+                           command still waiting
+        :param timeout: seconds to wait, None waits until the reply arrives
+        :return: dictionary
+        """
+        return self.connection.listen(request_id=request_id, timeout=timeout)
 
-    def status(self):
-        return self.__send_command(cmd="STATUS")
 
-    def prefix(self):
-        return self.__send_command(cmd="PREFIX")
+class AsyncCamera(AsyncClient):
+    """
+    asyncio version of Camera.  Instead of return_before_done, start the
+    exposure as a task and await it when the image is needed:
 
-    def take_image(self, shutter='normal', exptime=0.0, readout=2.0,
-                   save_as="", return_before_done=False):
+        exposure = asyncio.ensure_future(rc.take_image(exptime=30))
+        ...
+        ret = await exposure
+    """
 
-        parameters = {'shutter': shutter, "exptime": exptime,
-                      "readout": readout, "save_as": save_as}
+    IDEMPOTENT = IDEMPOTENT
 
-        return self.__send_command(cmd="TAKE_IMAGE", parameters=parameters,
-                                   return_before_done=return_before_done)
+    def __init__(self, address='pylos.palomar.caltech.edu', port=5001,
+                 encodings=None):
+        super().__init__(address, port, encodings=encodings)
 
-    def listen(self):
-        data = self.socket.recv(2048)
-        counter = 0
-        while not data:
-            time.sleep(.1)
-            data = self.socket.recv(2048)
-            counter += 1
-            if counter > 100:
-                break
-        return json.loads(data.decode('utf-8'))
+    initialize = async_command(CameraRequests.initialize)
+    shutdown = async_command(CameraRequests.shutdown)
+    status = async_command(CameraRequests.status)
+    prefix = async_command(CameraRequests.prefix)
+    take_image = async_command(CameraRequests.take_image, timeout=300)
 
 
 if __name__ == '__main__':
@@ -72,4 +140,4 @@ if __name__ == '__main__':
                         return_before_done=False))
     print(rc.status())
     print(rc.status())
-    print(rc.socket.close())
+    print(rc.connection.close())
@@ -0,0 +1,319 @@
+"""
+Load test for the command servers.
+
+Simulated clients, each on its own connection as the robot, the web
+watcher and manual sessions are, send a weighted mix of commands to a
+server for a fixed time.  Throughput, p50/p99 latency and the error rate
+of every command are reported and appended to a json lines file.
+
+The ocs server can be run against the tcs, stage and lamp simulators by
+pointing the gxn, stage and lamp addresses in the config at them and
+starting everything from here:
+
+    python -m observatory.server.load_test --start-sims --start-ocs \
+        --clients robot=1,watcher=2,manual=4 --duration 60
+
+Other servers (cam_server on 5001/5002) are driven the same way with
+--port and a mix of their commands, see MIXES and --mix.
+"""
+import os
+import json
+import time
+import random
+import argparse
+import datetime
+import threading
+
+import yaml
+
+from utils.message_client import Connection
+
+# Open the config file
+SR = os.path.abspath(os.path.dirname(__file__) + '/../../')
+with open(os.path.join(SR, 'config', 'sedm_config.yaml')) as data_file:
+    params = yaml.load(data_file, Loader=yaml.FullLoader)
+
+DEFAULT_RESULTS = os.path.join(params['logging']['logpath'],
+                               'load_test.jsonl')
+
+# Ports the simulators listen on in their __main__
+SIM_PORTS = {'tcs': 9002, 'stages': 8000, 'lamps': 7000}
+
+# Header status batch sent by SEDm.get_status_dict for every image
+STATUS_BATCH = [{'command': 'OBSSNAPSHOT'}] + \
+               [{'command': 'ARCLAMPSTATUS', 'key': '%s_lamp' % lamp,
+                 'parameters': {'lamp': lamp, 'force_check': True}}
+                for lamp in ['xe', 'cd', 'hg']] + \
+               [{'command': 'STAGEPOSITION', 'key': key,
+                 'parameters': {'stage_id': stage_id}}
+                for key, stage_id in [('ifufocus', 1), ('ifufoc2', 2)]]
+
+# Client profiles: seconds between commands and a list of
+# [weight, command, parameters]
+MIXES = {
+    'robot': {'interval': 1.0,
+              'commands': [[4, 'BATCH', {'commands': STATUS_BATCH}],
+                           [2, 'OBSPOS', None],
+                           [1, 'OBSSTATUS', None]]},
+    'watcher': {'interval': 5.0,
+                'commands': [[1, 'TELEMETRY', {'topic': 'pos',
+                                               'max_age': 5}],
+                             [1, 'TELEMETRY', {'topic': 'status',
+                                               'max_age': 10}],
+                             [1, 'TELEMETRY', {'topic': 'weather',
+                                               'max_age': 60}],
+                             [1, 'TELEMETRY', {'topic': 'faults',
+                                               'max_age': 30}]]},
+    'manual': {'interval': 0.5,
+               'commands': [[3, 'PING', None],
+                            [2, 'OBSWEATHER', None],
+                            [1, 'TELFAULTS', None],
+                            [1, 'ARCLAMPSTATUS', {'lamp': 'hg',
+                                                  'force_check': True}],
+                            [1, 'STAGEPOSITION', {'stage_id': 1}]]},
+    # No pause between commands, for the maximum throughput
+    'flood': {'interval': 0,
+              'commands': [[1, 'OBSPOS', None],
+                           [1, 'PING', None]]},
+    'camera': {'interval': 0.5,
+               'commands': [[1, 'STATUS', None],
+                            [1, 'PREFIX', None],
+                            [1, 'PING', None]]}
+}
+
+
+def percentile(values, q):
+    """
+    Percentile of a list by linear interpolation
+
+    :param values: list of numbers
+    :param q: percentile between 0 and 100
+    :return: float, NaN for an empty list
+    """
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    pos = (len(values) - 1) * q / 100.
+    low = int(pos)
+    high = min(low + 1, len(values) - 1)
+    return values[low] + (values[high] - values[low]) * (pos - low)
+
+
+class LoadClient(threading.Thread):
+    """
+    One simulated client sending commands from a mix until stopped
+    """
+
+    def __init__(self, name, address, port, mix, stop, seed=None):
+        """
+        :param name: label of the client in the results
+        :param address: host name of the server
+        :param port: port of the server
+        :param mix: dictionary with the 'interval' and 'commands'
+        :param stop: threading.Event set at the end of the test
+        :param seed: random seed for the command order
+        """
+        super().__init__(daemon=True)
+        self.name = name
+        self.address = address
+        self.port = port
+        self.mix = mix
+        self.stop = stop
+        self.random = random.Random(seed)
+        # (command, seconds, ok, error)
+        self.samples = []
+
+    def run(self):
+        try:
+            connection = Connection(self.address, self.port)
+        except Exception as e:
+            self.samples.append(('CONNECT', 0., False, str(e)))
+            return
+
+        weights = [c[0] for c in self.mix['commands']]
+        while not self.stop.is_set():
+            _, cmd, parameters = self.random.choices(self.mix['commands'],
+                                                     weights)[0]
+            start = time.perf_counter()
+            ret = connection.send_command(cmd, parameters, timeout=120,
+                                          start=time.time())
+            elapsed = time.perf_counter() - start
+
+            error = ret.get('error') if isinstance(ret, dict) else None
+            if error is None and isinstance(ret, dict) and \
+                    isinstance(ret.get('data'), dict) and \
+                    ret['data'].get('batch_errors'):
+                error = str(ret['data']['batch_errors'])
+            self.samples.append((cmd, elapsed, error is None, error))
+
+            if connection.closed:
+                break
+            self.stop.wait(self.mix['interval'])
+
+        connection.close()
+
+
+def summarize(samples, duration):
+    """
+    Statistics of every command
+
+    :param samples: list of (command, seconds, ok, error)
+    :param duration: length of the test in seconds
+    :return: dictionary of command: statistics, plus 'ALL'
+    """
+    by_command = {}
+    for cmd, elapsed, ok, error in samples:
+        by_command.setdefault(cmd, []).append((elapsed, ok, error))
+    by_command['ALL'] = [(s[1], s[2], s[3]) for s in samples]
+
+    stats = {}
+    for cmd, values in by_command.items():
+        latencies = [v[0] for v in values if v[1]]
+        errors = [v[2] for v in values if not v[1]]
+        stats[cmd] = {'count': len(values),
+                      'throughput': len(values) / duration,
+                      'error_rate': len(errors) / len(values)
+                      if values else 0.,
+                      'p50_ms': percentile(latencies, 50) * 1000,
+                      'p99_ms': percentile(latencies, 99) * 1000,
+                      'max_ms': max(latencies) * 1000 if latencies
+                      else float('nan'),
+                      'errors': sorted(set(errors))[:5]}
+    return stats
+
+
+def report(result):
+    """
+    Print a table of the command statistics
+    """
+    print("%s:%s for %.0fs with %s" % (result['address'], result['port'],
+                                       result['duration'],
+                                       result['clients']))
+    print("%-16s %8s %10s %8s %10s %10s %10s" %
+          ('command', 'count', 'per sec', 'errors', 'p50 (ms)', 'p99 (ms)',
+           'max (ms)'))
+    for cmd, values in sorted(result['stats'].items(),
+                              key=lambda x: x[0] == 'ALL'):
+        print("%-16s %8d %10.2f %7.1f%% %10.1f %10.1f %10.1f" %
+              (cmd, values['count'], values['throughput'],
+               100 * values['error_rate'], values['p50_ms'],
+               values['p99_ms'], values['max_ms']))
+        for error in values['errors']:
+            print("    %s" % error[:100])
+
+
+def run_load_test(address='localhost', port=5003, clients=None,
+                  duration=60., mixes=None, seed=0):
+    """
+    Run the simulated clients against a server
+
+    :param address: host name of the server
+    :param port: port of the server
+    :param clients: dictionary of mix name: number of clients
+    :param duration: seconds to run for
+    :param mixes: dictionary of the mixes, MIXES by default
+    :param seed: random seed
+    :return: dictionary with the settings and the statistics
+    """
+    mixes = mixes if mixes else MIXES
+    clients = clients if clients else {'robot': 1, 'watcher': 1,
+                                       'manual': 2}
+
+    stop = threading.Event()
+    threads = []
+    for name, count in clients.items():
+        for i in range(count):
+            threads.append(LoadClient("%s-%d" % (name, i), address, port,
+                                      mixes[name], stop,
+                                      seed=seed + len(threads)))
+
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    stop.wait(duration)
+    stop.set()
+    for thread in threads:
+        thread.join(130)
+    duration = time.time() - start
+
+    samples = [s for thread in threads for s in thread.samples]
+    return {'date': datetime.datetime.utcnow().isoformat(),
+            'address': address, 'port': port, 'clients': clients,
+            'duration': duration, 'stats': summarize(samples, duration)}
+
+
+def start_simulators(ports=None):
+    """
+    Run the tcs, stage and lamp simulators in this process
+    """
+    from observatory.telescope import tcs_sim_server
+    from observatory.stages import stage_sim_server
+    from observatory.arclamps import lamp_sim_server
+
+    ports = dict(SIM_PORTS, **(ports or {}))
+    for module, name in [(tcs_sim_server, 'tcs'),
+                         (stage_sim_server, 'stages'),
+                         (lamp_sim_server, 'lamps')]:
+        server = module.SimServer('localhost', ports[name])
+        threading.Thread(target=server.start, daemon=True).start()
+
+
+def start_ocs(port=5003):
+    """
+    Run the ocs server in this process and connect it to its devices
+    """
+    from observatory.server import ocs_server
+
+    server = ocs_server.ocsServer('localhost', port)
+    threading.Thread(target=server.start, daemon=True).start()
+    time.sleep(1)
+    print(Connection('localhost', port).send_command('INITIALIZE_ALL',
+                                                     timeout=120))
+    return server
+
+
+def parse_clients(value):
+    """
+    Parse 'robot=1,watcher=2' to a dictionary
+    """
+    clients = {}
+    for item in value.split(','):
+        name, count = item.split('=')
+        clients[name.strip()] = int(count)
+    return clients
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--address', default='localhost')
+    parser.add_argument('--port', type=int, default=5003)
+    parser.add_argument('--clients', type=parse_clients,
+                        default='robot=1,watcher=1,manual=2',
+                        help="mix=count pairs, mixes: %s" %
+                             ", ".join(MIXES))
+    parser.add_argument('--duration', type=float, default=60.)
+    parser.add_argument('--mix', help="json file of extra mixes in the "
+                                      "MIXES format")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--start-sims', action='store_true',
+                        help="run the tcs, stage and lamp simulators")
+    parser.add_argument('--start-ocs', action='store_true',
+                        help="run the ocs server on --port")
+    parser.add_argument('--results', default=DEFAULT_RESULTS)
+    args = parser.parse_args()
+
+    mixes = dict(MIXES)
+    if args.mix:
+        with open(args.mix) as data_file:
+            mixes.update(json.load(data_file))
+
+    if args.start_sims:
+        start_simulators()
+    if args.start_ocs:
+        start_ocs(args.port)
+
+    result = run_load_test(args.address, args.port, args.clients,
+                           args.duration, mixes, args.seed)
+    report(result)
+    with open(args.results, 'a') as outfile:
+        outfile.write(json.dumps(result) + "\n")
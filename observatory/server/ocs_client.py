@@ -1,222 +1,456 @@
-import socket
 import time
-import json
+from utils.message_client import get_pool, client_command
+from utils.async_client import AsyncClient, async_command
 
+# Commands that are safe to send again when the connection drops before
+# the reply arrives
+IDEMPOTENT = ['OBSPOS', 'OBSSTATUS', 'OBSWEATHER', 'TELFAULTS',
+              'ARCLAMPSTATUS', 'ARCLAMPON', 'ARCLAMPOFF', 'STAGEPOSITION',
+              'STAGESTATE', 'TELEMETRY', 'OBSSNAPSHOT', 'INITIALIZE_LAMPS',
+              'INITIALIZE_STAGES', 'INITIALIZE_TCS']
 
-class Observatory:
-    def __init__(self, address='localhost',  port=5003):
-        """
 
-        :param camera:
-        :param address:
-        :param port:
-        """
-
-        self.address = address
-        self.port = port
-        print(self.address, self.port)
-        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.socket.connect((self.address, self.port))
-
-    def __send_command(self, cmd="", parameters=None, timeout=300,
-                       return_before_done=False):
-        """
-
-        :param cmd: string command to send to the camera socket
-        :param parameters: list of parameters associated with cmd
-        :param timeout: timeout in seconds for waiting for a command
-        :return: Tuple (bool,string)
-        """
-        start = time.time()
-        try:
-            if timeout:
-                self.socket.settimeout(timeout)
-
-            if parameters:
-                send_str = json.dumps({'command': cmd,
-                                       'parameters': parameters})
-            else:
-                send_str = json.dumps({'command': cmd})
-
-            self.socket.send(b"%s" % send_str.encode('utf-8'))
-
-            if return_before_done:
-                return {"elaptime": time.time()-start,
-                        "data": "exiting the loop early"}
-
-            data = self.socket.recv(2048)
-            counter = 0
-            while not data:
-                time.sleep(.5)
-                data = self.socket.recv(2048)
-                counter += 1
-                if counter > 100:
-                    break
-
-            return json.loads(data.decode('utf-8'))
-        except Exception as e:
-            return {'elaptime': time.time() - start,
-                    'error': str(e)}
+class ObservatoryRequests:
+    """
+    Command and parameters of each ocs server request.  Observatory and
+    AsyncObservatory both send what these return, so the blocking and
+    asyncio clients can't drift apart.
+    """
 
     # INITIALIZE COMMANDS
-    def initialize_ocs(self):
-        return self.__send_command(cmd="INITIALIZE_ALL")
+    @staticmethod
+    def initialize_ocs():
+        return "INITIALIZE_ALL", None
 
-    def initialize_lamps(self):
-        return self.__send_command(cmd="INITIALIZE_LAMPS")
+    @staticmethod
+    def initialize_lamps():
+        return "INITIALIZE_LAMPS", None
 
-    def initialize_stages(self):
-        return self.__send_command(cmd="INITIALIZE_STAGES")
+    @staticmethod
+    def initialize_stages():
+        return "INITIALIZE_STAGES", None
 
-    def initialize_tcs(self):
-        return self.__send_command(cmd="INITIALIZE_TCS")
+    @staticmethod
+    def initialize_tcs():
+        return "INITIALIZE_TCS", None
 
-    def check_socket(self):
+    @staticmethod
+    def batch(commands):
         """
-        Try sending a command to the camera program
-        :return:(bool,response)
+        Send several commands in one request.  The server runs commands for
+        different devices at the same time and returns one merged reply.
+
+        :param commands: list of dictionaries with the 'command', optional
+                         'parameters' and an optional 'key' to store the
+                         data of that command under
+        :param timeout: timeout in seconds for the whole batch
+        :return: dictionary, failed commands are listed in
+                 data['batch_errors']
         """
-        return self.__send_command(cmd="PING")
-
-    # STATUS COMMANDS
-    def check_status(self):
-        x = self.__send_command(cmd="OBSSTATUS")
-        return x
-
-    def check_faults(self):
-        return self.__send_command(cmd="TELFAULTS")
-
-    def check_pos(self):
-        return self.__send_command(cmd="OBSPOS")
+        parameters = {
+            'commands': commands
+        }
+        return "BATCH", parameters
 
-    def check_weather(self):
-        return self.__send_command(cmd="OBSWEATHER")
+    @staticmethod
+    def get_snapshot(max_age=None):
+        """
+        Position, status, weather and faults of the telescope read together
+        and merged into one dictionary
+        :param max_age: oldest reply in seconds the tcs may reuse, None
+                        takes its configured snapshot_max_age
+        :return: dictionary, replies that failed are listed in
+                 data['snapshot_errors']
+        """
+        parameters = {
+            'max_age': max_age
+        }
+        return "OBSSNAPSHOT", parameters
 
     # STAGE COMMANDS
-    def move_stage(self, position=3.3, stage_id=1):
+    @staticmethod
+    def move_stage(position=3.3, stage_id=1):
         parameters = {
             'position': position,
             'stage_id': stage_id
         }
-        return self.__send_command(cmd="STAGEMOVE",
-                                   parameters=parameters)
+        return "STAGEMOVE", parameters
 
-    def stage_position(self, stage_id):
+    @staticmethod
+    def stage_position(stage_id):
         parameters = {
             'stage_id': stage_id
         }
-        return self.__send_command(cmd="STAGEPOSITION",
-                                   parameters=parameters)
+        return "STAGEPOSITION", parameters
 
-    def stage_home(self, stage_id):
+    @staticmethod
+    def stage_home(stage_id):
         parameters = {
             'stage_id': stage_id
         }
-        return self.__send_command(cmd="STAGEHOME",
-                                   parameters=parameters)
+        return "STAGEHOME", parameters
 
     # TCS COMMANDS
-    def halogens_on(self):
-        return self.__send_command(cmd="TELHALON", return_before_done=False)
+    @staticmethod
+    def halogens_on():
+        return "TELHALON", None
 
-    def take_control(self):
-        return self.__send_command(cmd="TAKECONTROL")
+    @staticmethod
+    def take_control():
+        return "TAKECONTROL", None
 
-    def halogens_off(self):
-        return self.__send_command(cmd="TELHALOFF", return_before_done=False)
+    @staticmethod
+    def halogens_off():
+        return "TELHALOFF", None
 
-    def telx(self):
-        return self.__send_command(cmd="TELX")
+    @staticmethod
+    def telx():
+        return "TELX", None
 
-    def tel_offset(self, ra=0, dec=0):
+    @staticmethod
+    def tel_offset(ra=0, dec=0):
         parameters = {
             'ra': ra,
             'dec': dec
         }
-        return self.__send_command(cmd="TELOFFSET", parameters=parameters)
+        return "TELOFFSET", parameters
 
-    def goto_focus(self, pos=14.26):
+    @staticmethod
+    def goto_focus(pos=14.26):
         parameters = {
             'pos': pos
         }
-        return self.__send_command(cmd="TELGOFOC", parameters=parameters)
+        return "TELGOFOC", parameters
 
-    def set_rates(self, ra=0, dec=0):
+    @staticmethod
+    def set_rates(ra=0, dec=0):
         parameters = {
             'ra': ra,
             'dec': dec
         }
-        return self.__send_command(cmd="SETRATES", parameters=parameters)
-
-    def tel_move(self, name='Test', ra=None, dec=None, equinox=2000,
-                 ra_rate=0, dec_rate=0, motion_flag="", epoch=""):
-
-        ra = float(ra)/15
-        dec = float(dec)
+        return "SETRATES", parameters
 
+    @staticmethod
+    def tel_move(name='Test', ra=None, dec=None, equinox=2000, ra_rate=0,
+                 dec_rate=0, motion_flag="", epoch=""):
         parameters = {
             'name': name,
-            'ra': ra,
-            'dec': dec,
+            'ra': float(ra)/15,
+            'dec': float(dec),
             'equinox': equinox,
             'ra_rate': ra_rate,
             'dec_rate': dec_rate,
             'motion_flag': motion_flag,
             'epoch': epoch,
         }
+        return "TELMOVE", parameters
 
-        return self.__send_command(cmd="TELMOVE", parameters=parameters)
-
-    def stow(self, ha=0, dec=109, domeaz=40):
+    @staticmethod
+    def stow(ha=0, dec=109, domeaz=40):
         parameters = {
             'ha': ha,
             'dec': dec,
             'domeaz': domeaz
         }
-        return self.__send_command(cmd="TELSTOW", parameters=parameters)
+        return "TELSTOW", parameters
 
-    def dome(self, state):
+    @staticmethod
+    def dome(state):
         parameters = {
             'state': state
         }
-        return self.__send_command(cmd="DOME",
-                                   parameters=parameters)
+        return "DOME", parameters
 
     # LAMP COMMANDS
-    def arclamp(self, lamp="", command="", force_check=True):
+    @staticmethod
+    def arclamp(lamp="", command="", force_check=True):
+        """
+        :raises ValueError: for a command other than ON, OFF or STATUS
+        """
+        cmd = {"ON": "ARCLAMPON", "OFF": "ARCLAMPOFF",
+               "STATUS": "ARCLAMPSTATUS"}.get(command.upper())
+        if cmd is None:
+            raise ValueError("Arclamp command not known")
+
+        parameters = {
+            'lamp': lamp
+        }
+        if cmd == "ARCLAMPSTATUS":
+            parameters['force_check'] = force_check
+        return cmd, parameters
+
+
+class Observatory:
+    def __init__(self, address='localhost',  port=5003):
+        """
+
+        :param camera:
+        :param address:
+        :param port:
+        """
+
+        self.address = address
+        self.port = port
+        print(self.address, self.port)
+        # Shared with every other client of the same server
+        self.connection = get_pool(self.address, self.port,
+                                   idempotent=IDEMPOTENT)
+
+    def __send_command(self, cmd="", parameters=None, timeout=300,
+                       return_before_done=False):
+        """
+
+        :param cmd: string command to send to the camera socket
+        :param parameters: list of parameters associated with cmd
+        :param timeout: timeout in seconds for waiting for a command
+        :return: Tuple (bool,string)
+        """
+        return self.connection.send_command(
+            cmd=cmd, parameters=parameters, timeout=timeout,
+            return_before_done=return_before_done, start=time.time())
+
+    def send_request(self, cmd, parameters=None, **options):
+        """
+        Send a command made by ObservatoryRequests, see client_command
+        """
+        return self.__send_command(cmd=cmd, parameters=parameters, **options)
+
+    # INITIALIZE COMMANDS
+    initialize_ocs = client_command(ObservatoryRequests.initialize_ocs)
+    initialize_lamps = client_command(ObservatoryRequests.initialize_lamps)
+    initialize_stages = client_command(ObservatoryRequests.initialize_stages)
+    initialize_tcs = client_command(ObservatoryRequests.initialize_tcs)
+
+    def check_socket(self):
+        """
+        Try sending a command to the camera program
+        :return:(bool,response)
+        """
+        return self.__send_command(cmd="PING")
+
+    def get_metrics(self, command=None, reset=False):
+        """
+        Latency histograms, counts and error counts the server keeps for
+        each command
+        :param command: only return this command
+        :param reset: have the server start counting again
+        :return: dictionary
+        """
+        parameters = {
+            'command': command,
+            'reset': reset
+        }
+        return self.__send_command(cmd="METRICS", parameters=parameters)
+
+    batch = client_command(ObservatoryRequests.batch, timeout=300)
+
+    # TELEMETRY COMMANDS
+    def subscribe(self, topics=None):
+        """
+        Have the server push every new snapshot of the topics to this
+        client, they are read with get_telemetry.  The subscription is
+        renewed when the connection is replaced.
+        :param topics: list of topics, by default all of them
+        """
+        return self.connection.subscribe(topics)
+
+    def unsubscribe(self, topics=None):
+        return self.connection.unsubscribe(topics)
+
+    def latest(self, topic, max_age=None):
+        """
+        Data of the last snapshot of a subscribed topic pushed to this
+        connection, without asking the server
+        :param topic: name of the topic
+        :param max_age: seconds, None takes the latest snapshot of any age
+        :return: data of the snapshot, None if there is no recent one
+        """
+        snapshot = self.connection.latest(topic, max_age)
+        if snapshot is None or 'data' not in snapshot:
+            return None
+        return snapshot['data']
+
+    def get_telemetry(self, topic, max_age=None):
+        """
+        Latest snapshot of a topic polled by the server.  A pushed snapshot
+        no older than max_age is used without asking the server, otherwise
+        the server returns its cached value or polls the device again.
+        :param topic: pos, status, weather, faults, lamps or stages
+        :param max_age: seconds, None takes the latest snapshot of any age
+        :return: dictionary with the 'data' and the 'time' it was read
+        """
         start = time.time()
-        command = command.upper()
-        if command == "ON":
-            parameters = {
-                'lamp': lamp
-            }
-            return self.__send_command(cmd="ARCLAMPON",
-                                       parameters=parameters)
-        elif command == "OFF":
-            parameters = {
-                'lamp': lamp
-            }
-            return self.__send_command(cmd="ARCLAMPOFF",
-                                       parameters=parameters)
-
-        elif command == "STATUS":
-            parameters = {
-                'lamp': lamp,
-                'force_check':  force_check
-            }
-            return self.__send_command(cmd="ARCLAMPSTATUS",
-                                       parameters=parameters)
-        else:
-            return {"elaptime": time.time()-start,
-                    "error": "Arclamp command not known"}
+        snapshot = self.connection.latest(topic, max_age)
+        if snapshot is not None and 'data' in snapshot:
+            return {'elaptime': time.time() - start,
+                    'data': snapshot['data'], 'time': snapshot['time']}
+
+        parameters = {
+            'topic': topic,
+            'max_age': max_age
+        }
+        ret = self.__send_command(cmd="TELEMETRY", parameters=parameters)
+        if 'data' in ret:
+            return {'elaptime': time.time() - start,
+                    'data': ret['data']['data'], 'time': ret['data']['time']}
+        return ret
+
+    # STATUS COMMANDS
+    def check_status(self, max_age=None):
+        if max_age is not None:
+            return self.get_telemetry('status', max_age)
+        x = self.__send_command(cmd="OBSSTATUS")
+        return x
+
+    def check_faults(self, max_age=None):
+        if max_age is not None:
+            return self.get_telemetry('faults', max_age)
+        return self.__send_command(cmd="TELFAULTS")
+
+    def check_pos(self, max_age=None):
+        if max_age is not None:
+            return self.get_telemetry('pos', max_age)
+        return self.__send_command(cmd="OBSPOS")
+
+    def check_weather(self, max_age=None):
+        if max_age is not None:
+            return self.get_telemetry('weather', max_age)
+        return self.__send_command(cmd="OBSWEATHER")
+
+    get_snapshot = client_command(ObservatoryRequests.get_snapshot)
 
     # STAGE COMMANDS
-    def stage_position(self, stage_id):
+    move_stage = client_command(ObservatoryRequests.move_stage)
+    stage_position = client_command(ObservatoryRequests.stage_position)
+    stage_home = client_command(ObservatoryRequests.stage_home)
+
+    # TCS COMMANDS
+    halogens_on = client_command(ObservatoryRequests.halogens_on)
+    take_control = client_command(ObservatoryRequests.take_control)
+    halogens_off = client_command(ObservatoryRequests.halogens_off)
+    telx = client_command(ObservatoryRequests.telx)
+    tel_offset = client_command(ObservatoryRequests.tel_offset)
+    goto_focus = client_command(ObservatoryRequests.goto_focus)
+    set_rates = client_command(ObservatoryRequests.set_rates)
+    tel_move = client_command(ObservatoryRequests.tel_move)
+    stow = client_command(ObservatoryRequests.stow)
+    dome = client_command(ObservatoryRequests.dome)
+
+    # LAMP COMMANDS
+    def arclamp(self, lamp="", command="", force_check=True):
+        start = time.time()
+        try:
+            cmd, parameters = ObservatoryRequests.arclamp(lamp, command,
+                                                          force_check)
+        except ValueError as e:
+            return {"elaptime": time.time()-start, "error": str(e)}
+        return self.__send_command(cmd=cmd, parameters=parameters)
+
+    def listen(self, request_id=None, timeout=None):
+        """
+        Wait for the reply of a command sent with return_before_done
+        :param request_id: 'id' of the early return, defaults to the oldest
+                           command still waiting
+        :param timeout: seconds to wait, None waits until the reply arrives
+        :return: dictionary
+        """
+        return self.connection.listen(request_id=request_id, timeout=timeout)
+
+
+class AsyncObservatory(AsyncClient):
+    """
+    asyncio version of Observatory.  Commands for different devices run at
+    the same time on the server, so a telescope move, stage moves and lamp
+    warm-ups can be awaited together:
+
+        await asyncio.gather(ocs.tel_move(ra=ra, dec=dec),
+                             ocs.move_stage(3.5, 1),
+                             ocs.arclamp('hg', 'ON'))
+    """
+
+    IDEMPOTENT = IDEMPOTENT
+
+    def __init__(self, address='localhost', port=5003, encodings=None):
+        super().__init__(address, port, encodings=encodings)
+
+    # INITIALIZE COMMANDS
+    initialize_ocs = async_command(ObservatoryRequests.initialize_ocs)
+    initialize_lamps = async_command(ObservatoryRequests.initialize_lamps)
+    initialize_stages = async_command(ObservatoryRequests.initialize_stages)
+    initialize_tcs = async_command(ObservatoryRequests.initialize_tcs)
+    batch = async_command(ObservatoryRequests.batch, timeout=300)
+
+    # TELEMETRY COMMANDS
+    async def get_telemetry(self, topic, max_age=None):
+        """
+        See Observatory.get_telemetry
+        """
+        start = time.time()
+        snapshot = self.latest(topic, max_age)
+        if snapshot is not None and 'data' in snapshot:
+            return {'elaptime': time.time() - start,
+                    'data': snapshot['data'], 'time': snapshot['time']}
+
         parameters = {
-            'stage_id': stage_id
+            'topic': topic,
+            'max_age': max_age
         }
-        return self.__send_command(cmd="STAGEPOSITION",
-                                   parameters=parameters)
+        ret = await self.send_command(cmd="TELEMETRY", parameters=parameters)
+        if 'data' in ret:
+            return {'elaptime': time.time() - start,
+                    'data': ret['data']['data'], 'time': ret['data']['time']}
+        return ret
+
+    # STATUS COMMANDS
+    async def check_status(self, max_age=None):
+        if max_age is not None:
+            return await self.get_telemetry('status', max_age)
+        return await self.send_command(cmd="OBSSTATUS")
+
+    async def check_faults(self, max_age=None):
+        if max_age is not None:
+            return await self.get_telemetry('faults', max_age)
+        return await self.send_command(cmd="TELFAULTS")
+
+    async def check_pos(self, max_age=None):
+        if max_age is not None:
+            return await self.get_telemetry('pos', max_age)
+        return await self.send_command(cmd="OBSPOS")
+
+    async def check_weather(self, max_age=None):
+        if max_age is not None:
+            return await self.get_telemetry('weather', max_age)
+        return await self.send_command(cmd="OBSWEATHER")
+
+    get_snapshot = async_command(ObservatoryRequests.get_snapshot)
+
+    # STAGE COMMANDS
+    move_stage = async_command(ObservatoryRequests.move_stage)
+    stage_position = async_command(ObservatoryRequests.stage_position)
+    stage_home = async_command(ObservatoryRequests.stage_home)
+
+    # TCS COMMANDS
+    halogens_on = async_command(ObservatoryRequests.halogens_on)
+    take_control = async_command(ObservatoryRequests.take_control)
+    halogens_off = async_command(ObservatoryRequests.halogens_off)
+    telx = async_command(ObservatoryRequests.telx)
+    tel_offset = async_command(ObservatoryRequests.tel_offset)
+    goto_focus = async_command(ObservatoryRequests.goto_focus)
+    set_rates = async_command(ObservatoryRequests.set_rates)
+    tel_move = async_command(ObservatoryRequests.tel_move)
+    stow = async_command(ObservatoryRequests.stow)
+    dome = async_command(ObservatoryRequests.dome)
+
+    # LAMP COMMANDS
+    async def arclamp(self, lamp="", command="", force_check=True):
+        start = time.time()
+        try:
+            cmd, parameters = ObservatoryRequests.arclamp(lamp, command,
+                                                          force_check)
+        except ValueError as e:
+            return {"elaptime": time.time()-start, "error": str(e)}
+        return await self.send_command(cmd=cmd, parameters=parameters)
+
 
 if __name__ == '__main__':
     ocs = Observatory()
@@ -1,19 +1,14 @@
 import os
-import logging
-import json
-from logging.handlers import TimedRotatingFileHandler
 import time
 from observatory.arclamps import controller as lamps
 from observatory.stages import controller as stages
 from observatory.telescope import tcs
-import socket
-import threading
 
 import yaml
 
 from utils.sedmlogging import setup_logger
-from utils.message_server import (message_handler, response_handler,
-                                  error_handler)
+from utils.command_server import CommandServer
+from utils.telemetry import Telemetry
 
 # Open the config file
 SR = os.path.abspath(os.path.dirname(__file__) + '/../../')
@@ -25,147 +20,193 @@ name = "ocsLogger"
 logfile = os.path.join(params['logging']['logpath'], 'ocs_server.log')
 logger = setup_logger(name, log_file=logfile)
 
+# Command latency metrics
+metrics_file = os.path.join(params['logging']['logpath'],
+                            'ocs_metrics.jsonl')
+metrics_interval = params['logging'].get('metrics_interval', 900)
+
 
 class ocsServer:
     def __init__(self, hostname, port):
         self.hostname = hostname
         self.port = port
-        self.socket = ""
         self.stages = None
         self.lamp_controller = None
         self.lamps_dict = None
         self.tcs = None
 
-    def handle(self, connection, address):
-        while True:
-            starttime = time.time()
-            data = message_handler(connection, starttime=starttime)
-            ret = ''
-            logger.info("Data Received: %s", data)
-
-            # Check the data return if it's False then there was an error and
-            # we should exit the loop.  Or if the data is not in dictionary
-            # form then we should exit
-            if isinstance(data, bool) or not isinstance(data, dict):
-                print(data, "Bad return from message_handler")
-                print(connection, address)
-                break
-                
-            if 'command' in data:
-                if 'parameters' in data:
-                    parameters = data['parameters']
-                else:
-                    parameters = {}
-
-                if data['command'].upper() == 'INITIALIZE_ALL':
-                    ret = ''
-                    if not self.lamp_controller:
-                        logger.info("Initializing Arc Lamps")
-                        self.lamp_controller = True
-                        self.lamps_dict = lamps.connect_all()
-                        ret += 'Lamps Connected\n'
-                    if not self.stages:
-                        logger.info("Initializing Stages")
-                        self.stages = stages.Stage()
-                        ret += 'Stages initialized\n'
-                    if not self.tcs:
-                        logger.info("Initializing Telescope")
-                    self.tcs = tcs.Telescope()
-                    ret += 'Telescope initialized\n'
-                    ret = {'elaptime': time.time() - starttime,
-                                'data': ret}
-
-                elif data['command'].upper() == 'INITIALIZE_LAMPS':
-                    if not self.lamp_controller:
-                        logger.info("Initializing Arc Lamps")
-                        self.lamp_controller = lamps.Lamp()
-                    ret = "Lamps initialized"
-                elif data['command'].upper() == 'INITIALIZE_STAGES':
-                    if not self.stages:
-                        logger.info("Initializing Stages")
-                        self.stages = stages.Stage()
-                    ret = "Stages initialized"
-                elif data['command'].upper() == 'INITIALIZE_TCS':
-                    if not self.tcs:
-                        logger.info("Initializing Telescope")
-                        self.tcs = tcs.Telescope()
-                    ret = "Telescope initialized"
-                elif data['command'].upper() == "OBSSTATUS":
-                    ret = self.tcs.get_status()
-                elif data['command'].upper() == "OBSWEATHER":
-                    ret = self.tcs.get_weather()
-                elif data['command'].upper() == "OBSPOS":
-                    ret = self.tcs.get_pos()
-                elif data['command'].upper() == "TELMOVE":
-                    ret = self.tcs.tel_move_sequence(**parameters)
-                elif data['command'].upper() == "TELOFFSET":
-                    ret = self.tcs.offset(**parameters)
-                elif data['command'].upper() == "TELGOFOC":
-                    ret = self.tcs.gofocus(**parameters)
-                elif data['command'].upper() == "TELOFFSETFOC":
-                    ret = self.tcs.incfocus(**parameters)
-                elif data['command'].upper() == "TELFAULTS":
-                    ret = self.tcs.get_faults()
-                elif data['command'].upper() == "TELX":
-                    ret = self.tcs.x()
-                elif data['command'].upper() == "TAKECONTROL":
-                    ret = self.tcs.takecontrol()
-                elif data['command'].upper() == "TELHALON":
-                    ret = self.tcs.halogens_on()
-                elif data['command'].upper() == "TELX":
-                    ret = self.tcs.x()
-                elif data['command'].upper() == "TELHALOFF":
-                    ret = self.tcs.halogens_off()
-                elif data['command'].upper() == "TELSTOW":
-                    ret = self.tcs.stow(**parameters)
-                elif data['command'].upper() == "DOME":
-                    ret = self.tcs.dome(**parameters)
-                elif data['command'].upper() == "SETRATES":
-                    ret = self.tcs.irates(**parameters)
-                elif data['command'].upper() == "ARCLAMPON":
-                    ret = self.lamps_dict[parameters['lamp']].on()
-                elif data['command'].upper() == "ARCLAMPOFF":
-                    ret = self.lamps_dict[parameters['lamp']].off()
-                elif data['command'].upper() == "ARCLAMPSTATUS":
-                    ret = self.lamps_dict[parameters['lamp']].status(parameters['force_check'])
-                elif data['command'].upper() == "STAGEMOVE":
-                    ret = self.stages.move_focus(**parameters)
-                elif data['command'].upper() == "STAGEPOSITION":
-                    ret = self.stages.get_position(**parameters)
-                elif data['command'].upper() == "STAGESTATE":
-                    ret = self.stages.get_state(**parameters)
-                elif data['command'].upper() == "STAGEHOME":
-                    ret = self.stages.home(**parameters)
-                elif data['command'].upper() == "PING":
-                    ret = {'elaptime': time.time()-starttime,
-                           'data': 'PONG'}
-                else:
-                    ret = {"elaptime": time.time()-starttime,
-                           "error": "Command not found"}
-            else:
-                ret = {'elaptime': time.time()-starttime,
-                       'error': "Command not found"}
-
-            response = response_handler(ret, inputdata=data,
-                                        starttime=starttime)
-            logger.info("Response: %s", response)
-            jsonstr = json.dumps(response)
-            connection.sendall(jsonstr.encode('utf-8'))
+        # One pool of workers per device so a slow telescope move doesn't
+        # hold up lamp or stage requests
+        self.server = CommandServer(hostname, port, logger=logger,
+                                    pools={'tcs': 4, 'lamps': 3,
+                                           'stages': 2},
+                                    metrics_file=metrics_file,
+                                    metrics_interval=metrics_interval)
+        self.register_commands()
+
+        self.telemetry = Telemetry(self.server)
+        self.add_telemetry()
+
+    def register_commands(self):
+        register = self.server.register
+
+        register('INITIALIZE_ALL', self.initialize_all)
+        register('INITIALIZE_LAMPS', self.initialize_lamps)
+        register('INITIALIZE_STAGES', self.initialize_stages)
+        register('INITIALIZE_TCS', self.initialize_tcs)
+
+        # Telescope information commands return right away
+        for name, method in [('OBSSTATUS', 'get_status'),
+                             ('OBSWEATHER', 'get_weather'),
+                             ('OBSPOS', 'get_pos'),
+                             ('TELFAULTS', 'get_faults'),
+                             ('OBSSNAPSHOT', 'get_snapshot'),
+                             ('TELX', 'x'),
+                             ('TAKECONTROL', 'takecontrol'),
+                             ('TELHALON', 'halogens_on'),
+                             ('TELHALOFF', 'halogens_off'),
+                             ('TELOFFSET', 'offset'),
+                             ('TELOFFSETFOC', 'incfocus'),
+                             ('SETRATES', 'irates')]:
+            register(name, self._tcs_command(method), pool='tcs', timeout=60)
+
+        # Slow telescope and dome moves
+        for name, method in [('TELMOVE', 'tel_move_sequence'),
+                             ('TELGOFOC', 'gofocus'),
+                             ('TELSTOW', 'stow'),
+                             ('DOME', 'dome')]:
+            register(name, self._tcs_command(method), pool='tcs', timeout=600)
+
+        # Each lamp has its own controller, so a batch can query them all
+        # at once.  The stages share one controller and the tcs one socket
+        def lamp_group(parameters):
+            return 'lamp_%s' % parameters.get('lamp')
+
+        register('ARCLAMPON', self.arclamp_on, pool='lamps',
+                 group=lamp_group)
+        register('ARCLAMPOFF', self.arclamp_off, pool='lamps',
+                 group=lamp_group)
+        register('ARCLAMPSTATUS', self.arclamp_status, pool='lamps',
+                 timeout=60, group=lamp_group)
+
+        register('STAGEMOVE', self._stage_command('move_focus'),
+                 pool='stages')
+        register('STAGEPOSITION', self._stage_command('get_position'),
+                 pool='stages', timeout=60)
+        register('STAGESTATE', self._stage_command('get_state'),
+                 pool='stages', timeout=60)
+        register('STAGEHOME', self._stage_command('home'), pool='stages')
+
+    def add_telemetry(self):
+        """
+        Poll every device in the background so clients can read the cached
+        values instead of each polling the hardware
+        """
+        intervals = params['observatory'].get('telemetry', {}).get(
+            'intervals', {})
+
+        for topic, method in [('pos', 'get_pos'), ('status', 'get_status'),
+                              ('weather', 'get_weather'),
+                              ('faults', 'get_faults')]:
+            self.telemetry.add_topic(topic, self._tcs_poll(method),
+                                     intervals.get(topic), device='tcs')
+
+        self.telemetry.add_topic('lamps', self.poll_lamps,
+                                 intervals.get('lamps'), device='lamps')
+        self.telemetry.add_topic('stages', self.poll_stages,
+                                 intervals.get('stages'), device='stages')
+
+    def _tcs_poll(self, method):
+        def poll():
+            if not self.tcs:
+                return {'error': 'Telescope not initialized'}
+            # The poll times the snapshots, so skip the tcs cache
+            return getattr(self.tcs, method)(max_age=0)
+        return poll
+
+    def poll_lamps(self):
+        if not self.lamps_dict:
+            return {'error': 'Lamps not initialized'}
+        ret = {}
+        for lamp, controller in self.lamps_dict.items():
+            ret['%s_lamp' % lamp] = controller.status(True).get('data',
+                                                                'UNKNOWN')
+        return {'data': ret}
+
+    def poll_stages(self):
+        if not self.stages:
+            return {'error': 'Stages not initialized'}
+        ret = {}
+        for key, stage_id in [('ifufocus', 1), ('ifufoc2', 2)]:
+            pos = self.stages.get_position(stage_id)
+            if 'error' in pos:
+                return pos
+            ret[key] = pos['data']
+        return {'data': ret}
+
+    def _tcs_command(self, method):
+        """
+        Command calling a tcs.Telescope method, looked up at call time as
+        the telescope can be reinitialized
+        """
+        return lambda **parameters: getattr(self.tcs, method)(**parameters)
+
+    def _stage_command(self, method):
+        return lambda **parameters: getattr(self.stages, method)(**parameters)
+
+    def initialize_all(self):
+        starttime = time.time()
+        ret = ''
+        if not self.lamp_controller:
+            logger.info("Initializing Arc Lamps")
+            self.lamp_controller = True
+            self.lamps_dict = lamps.connect_all()
+            ret += 'Lamps Connected\n'
+        if not self.stages:
+            logger.info("Initializing Stages")
+            self.stages = stages.Stage()
+            ret += 'Stages initialized\n'
+        if not self.tcs:
+            logger.info("Initializing Telescope")
+            self.tcs = tcs.Telescope()
+            ret += 'Telescope initialized\n'
+        return {'elaptime': time.time() - starttime,
+                'data': ret}
+
+    def initialize_lamps(self):
+        if not self.lamp_controller:
+            logger.info("Initializing Arc Lamps")
+            self.lamp_controller = lamps.Lamp()
+        return "Lamps initialized"
+
+    def initialize_stages(self):
+        if not self.stages:
+            logger.info("Initializing Stages")
+            self.stages = stages.Stage()
+        return "Stages initialized"
+
+    def initialize_tcs(self):
+        if not self.tcs:
+            logger.info("Initializing Telescope")
+            self.tcs = tcs.Telescope()
+        return "Telescope initialized"
+
+    def arclamp_on(self, lamp):
+        return self.lamps_dict[lamp].on()
+
+    def arclamp_off(self, lamp):
+        return self.lamps_dict[lamp].off()
+
+    def arclamp_status(self, lamp, force_check=True):
+        return self.lamps_dict[lamp].status(force_check)
 
     def start(self):
-        logger.debug("IFU server now listening for connections on port:%s" % self.port)
-        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        self.socket.settimeout(None)
-        self.socket.bind((self.hostname, self.port))
-        self.socket.listen(5)
-
-        while True:
-            conn, address = self.socket.accept()
-            logger.debug("Got connection from %s:%s" % (conn, address))
-            new_thread = threading.Thread(target=self.handle, args=(conn, address))
-            new_thread.start()
-            logger.debug("Started process")
+        logger.debug("OCS server now listening for connections on port:%s" % self.port)
+        try:
+            self.server.start()
+        finally:
+            if self.tcs:
+                self.tcs.close()
 
 
 if __name__ == "__main__":
@@ -3,6 +3,10 @@ import socket
 import json
 import time
 import yaml
+import queue
+import threading
+import itertools
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError
 
 from utils.sedmlogging import setup_logger
 
@@ -18,6 +22,291 @@ logfile = os.path.join(params['logging']['logpath'], 'tcs.log')
 logger = setup_logger(name, log_file=logfile)
 
 
+# Sexagesimal values of the info commands and the degrees in one unit of
+# their first field.  They are kept as strings for the headers and a
+# '<key>_deg' float is added next to them
+SEXAGESIMAL_KEYS = {'telescope_ha': 15., 'telescope_ra': 15.,
+                    'telescope_dec': 1., 'object_ra': 15.,
+                    'object_dec': 1., 'lst': 15., 'solar_ra': 15.,
+                    'solar_dec': 1.}
+
+# Keys as sent by the GXN mapped to the lower case names used everywhere
+# else, the same few dozen keys come back in every reply
+_KEY_NAMES = {}
+
+
+def sexagesimal_to_deg(value, scale=1.):
+    """
+    Convert a GXN sexagesimal string such as 'e00:51:28.85', '-20:31:56.3'
+    or '10:44' to degrees.  East hour angles are negative.
+
+    :param value: lower case string
+    :param scale: degrees in one unit of the first field, 15 for hours
+    :return: float, None if the value can't be parsed
+    """
+    sign = 1.
+    if value[:1] in ('e', '-'):
+        sign = -1.
+        value = value[1:]
+    elif value[:1] in ('w', '+'):
+        value = value[1:]
+
+    total = 0.
+    unit = 1.
+    try:
+        for field in value.split(':'):
+            total += float(field) / unit
+            unit *= 60.
+    except ValueError:
+        return None
+    return sign * total * scale
+
+
+def parse_info(text, delimiter="="):
+    """
+    Parse the reply of an info command in one pass.  Keys and values are
+    lower cased as before, numbers come back as int or float, sexagesimal
+    values also get a '<key>_deg' float and everything else (enums, dates,
+    names) stays a string.
+
+    :param text: reply of ?POS, ?STATUS or ?WEATHER
+    :param delimiter: separator of key and value
+    :return: dictionary, False when the reply has no values
+    """
+    ret = {}
+    for line in text.splitlines():
+        key, sep, value = line.partition(delimiter)
+        if not sep:
+            continue
+
+        name = _KEY_NAMES.get(key)
+        if name is None:
+            name = _KEY_NAMES[key] = key.lower()
+        value = value.lower()
+
+        if name in SEXAGESIMAL_KEYS:
+            ret[name] = value
+            ret[name + '_deg'] = sexagesimal_to_deg(value,
+                                                    SEXAGESIMAL_KEYS[name])
+            continue
+
+        first = value[:1]
+        if first.isdigit() or first in '-+.':
+            try:
+                ret[name] = int(value)
+                continue
+            except ValueError:
+                try:
+                    ret[name] = float(value)
+                    continue
+                except ValueError:
+                    pass
+        ret[name] = value
+
+    if not ret:
+        return False
+    return ret
+
+
+# Fields of the info replies that show each slow command is still running,
+# and their values while it is.  A command is done when none of its fields
+# shows a busy value.
+TELESCOPE_BUSY = ('?POS', 'telescope_motion_status',
+                  ('slewing', 'moving', 'acquiring'))
+FOCUS_BUSY = ('?STATUS', 'focus_motion_status', ('moving',))
+DOME_BUSY = ('?STATUS', 'dome_motion_mode', ('moving',))
+SHUTTER_BUSY = ('?STATUS', 'dome_shutter_status',
+                ('opening', 'closing', 'moving'))
+MOVE_BUSY = {'GOPOS': (TELESCOPE_BUSY,),
+             'STOW': (TELESCOPE_BUSY, DOME_BUSY),
+             'TELINIT': (TELESCOPE_BUSY, DOME_BUSY, FOCUS_BUSY),
+             'GODOME': (DOME_BUSY,),
+             'GOFOCUS': (FOCUS_BUSY,),
+             'INCFOCUS': (FOCUS_BUSY,),
+             'OPEN': (SHUTTER_BUSY,),
+             'CLOSE': (SHUTTER_BUSY,)}
+for _cmd in ['GOREF', 'PT', 'PTS', 'N', 'S', 'E', 'W', 'ES', 'WS']:
+    MOVE_BUSY[_cmd] = MOVE_BUSY['GOPOS']
+# LAMPON, IRATES and CLOSED have no motion field to watch, the GXN reply
+# is taken as the end of the command
+
+# Moves whose ?POS samples, from just before the command to the settled
+# position, go to the position history for fitting the slew model
+RECORDED_MOVES = ('GOPOS', 'STOW', 'GODOME')
+
+
+class GXNChannel:
+    """
+    One socket to the GXN interface with a queue in front of it.  Commands
+    from every thread are sent one at a time by a single I/O worker, so a
+    reply can't be read by the wrong caller.
+    """
+
+    def __init__(self, address, name='gxn'):
+        """
+        :param address: (ip, port) of the GXN interface
+        :param name: label of the channel in the log
+        """
+        self.address = address
+        self.name = name
+        self.socket = None
+        self.requests = queue.PriorityQueue()
+        self.request_count = itertools.count()
+        self.in_progress = {}
+        self.queue_lock = threading.Lock()
+        self.closed = False
+        self.io_thread = threading.Thread(target=self._io_worker,
+                                          daemon=True)
+        self.io_thread.start()
+
+    def __connect(self):
+        logger.info("Connecting %s channel to address:%s", self.name,
+                    self.address)
+        try:
+            self.socket = socket.socket()
+            self.socket.connect((self.address))
+        except Exception as e:
+            logger.error("Error connecting to the GXN:%s", str(e),
+                         exc_info=True)
+            self.socket = None
+            pass
+        return self.socket
+
+    def __disconnect(self):
+        """
+        Close the socket after a failed exchange, a late reply left on it
+        would otherwise be read as the reply of the next command
+        """
+        try:
+            self.socket.close()
+        except Exception:
+            pass
+        self.socket = None
+
+    def submit(self, cmd, timeout, info=False):
+        """
+        Queue a command for the I/O worker.  Info commands are read only,
+        so a caller asking for one that is already queued or on the wire
+        shares its reply instead of sending it again.  Fast commands are
+        sent ahead of queued slow ones.
+
+        :param cmd: full command string with its parameters
+        :param timeout: seconds the worker waits for the reply
+        :param info: True for the ?POS, ?STATUS, ?WEATHER, ?FAULTS commands
+        :return: Future of a dictionary with the reply string in 'data' or
+                 an 'error'
+        """
+        with self.queue_lock:
+            if self.closed:
+                future = Future()
+                future.set_result({"error": "GXN %s channel is closed" %
+                                            self.name})
+                return future
+            future = self.in_progress.get(cmd) if info else None
+            if future is None:
+                future = Future()
+                if info:
+                    self.in_progress[cmd] = future
+                priority = 0 if timeout <= 60 else 1
+                self.requests.put((priority, next(self.request_count), cmd,
+                                   timeout, info, future))
+            else:
+                logger.info("Sharing the reply of the queued %s", cmd)
+        return future
+
+    def transact(self, cmd, timeout, info=False):
+        """
+        Queue a command and wait for the reply, see submit
+        """
+        return self.submit(cmd, timeout, info).result()
+
+    def close(self):
+        """
+        Stop the I/O worker and close the socket.  Commands still queued
+        get an error, one already on the wire is let finish.
+        """
+        with self.queue_lock:
+            if self.closed:
+                return
+            self.closed = True
+            self.requests.put((-1, next(self.request_count), None, 0, False,
+                               None))
+
+    def _io_worker(self):
+        """
+        The only thread that touches the socket, sends the queued commands
+        one at a time and hands back their replies
+        """
+        while True:
+            _, _, cmd, timeout, info, future = self.requests.get()
+            if cmd is None:
+                break
+            try:
+                ret = self._exchange(cmd, timeout, info)
+            except Exception as e:
+                logger.error("Unkown error", exc_info=True)
+                ret = {"error": str(e)}
+            with self.queue_lock:
+                if self.in_progress.get(cmd) is future:
+                    del self.in_progress[cmd]
+            future.set_result(ret)
+
+        if self.socket:
+            self.__disconnect()
+        while not self.requests.empty():
+            future = self.requests.get()[-1]
+            if future is not None:
+                future.set_result({"error": "GXN %s channel is closed" %
+                                            self.name})
+
+    def _exchange(self, cmd, timeout, info=False):
+        """
+        Send one command on the socket and read the reply, run by the I/O
+        worker only
+
+        :return: dictionary with the reply string in 'data' or an 'error'
+        """
+        # Check if the socket is open
+        if not self.socket:
+            logger.info("Socket not connected")
+            if not self.__connect():
+                return {"error": "Error connecting to the GXN adderess"}
+
+        self.socket.settimeout(timeout)
+        try:
+            logger.info("Sending:%s with %ss timeout", cmd, timeout)
+            self.socket.send(b"%s \r" % cmd.encode('utf-8'))
+        except Exception as e:
+            logger.error("Error sending command: %s", str(e), exc_info=True)
+            self.__disconnect()
+            return {"error": "Error commamd:%s failed" % cmd}
+
+        try:
+            # Slight delay added for the info command to print out
+            if info:
+                time.sleep(.05)
+
+            ret = self.socket.recv(2048)
+            if not ret:
+                # Try one more time to get a return
+                ret = self.socket.recv(2048)
+        except Exception as e:
+            logger.error("Error reading the reply of %s: %s", cmd, str(e),
+                         exc_info=True)
+            self.__disconnect()
+            return {"error": str(e)}
+
+        # If we still don't have a return then something has gone wrong.
+        if not ret:
+            logger.error("No response given back from the GXN interface")
+            self.__disconnect()
+            return {"error": "No response from TCS"}
+
+        ret = ret.decode('utf-8')
+        logger.info("Received: %s", ret)
+        return {"data": ret}
+
+
 class Telescope:
     """Top level class to handle all the GXN commands and to make sure they
     are properly formatted.  Commands return True and time to complete command
@@ -33,8 +322,6 @@ class Telescope:
         self.pos = {}
         self.status = {}
         self.faults = {}
-        self.socket = None
-        self.error_tracker = 0
         with open(os.path.join(SR, 'config', 'tcs.json')) as data_file:
             self.tcs_config = json.load(data_file)
 
@@ -62,67 +349,91 @@ class Telescope:
                                          'INCFOCUS']
 
         self.info_commands = ['?POS', '?STATUS', '?WEATHER', '?FAULTS']
+
+        # Position samples taken during the RECORDED_MOVES are appended here
+        # for fitting the slew model used by the scheduler
+        # (sky/targets/scheduler/slew.py), each line ends with the id of
+        # the move it was taken in
+        self.pos_history_file = params['observatory']['tcs'].get(
+            'pos_history', '')
+        self.pos_history_keys = ['julian_date', 'telescope_ha',
+                                 'telescope_dec', 'telescope_azimuth',
+                                 'dome_azimuth', 'telescope_motion_status']
+
+        # Commands from every thread go through a channel with a single I/O
+        # worker, so replies can't be read by the wrong caller.  Slow moves
+        # get a socket of their own so info commands keep going during a
+        # slew
+        self.channel = GXNChannel(self.address, 'info')
+        if params['observatory']['tcs'].get('move_socket', True):
+            self.move_channel = GXNChannel(self.address, 'move')
+        else:
+            self.move_channel = self.channel
+
+        # Slow commands are watched by polling the motion fields, every
+        # poll_min seconds at first and backing off to poll_max
+        move = params['observatory']['tcs'].get('move', {})
+        self.move_poll_min = move.get('poll_min', 0.5)
+        self.move_poll_max = move.get('poll_max', 5.)
+        self.move_settle_timeout = move.get('settle_timeout', 60.)
+        self.move_retries = move.get('retries', 2)
+        self.move_retry_delay = move.get('retry_delay', 5.)
+        self.move_pool = ThreadPoolExecutor(max_workers=2)
+
+        # Latest reply of each info command by command, with the time it was
+        # read, reused for snapshot_max_age seconds
+        max_age = params['observatory']['tcs'].get('snapshot_max_age', {})
+        self.snapshot_max_age = {'?%s' % k.upper(): v
+                                 for k, v in max_age.items()}
+        self.snapshots = {}
+        # Bumped by clear_snapshots, a reply to a query sent before the
+        # bump may show the telescope before the move and isn't cached
+        self.snapshot_generation = 0
+        self.snapshot_lock = threading.Lock()
+        self.snapshot_pool = ThreadPoolExecutor(max_workers=4)
         self.takecontrol()
 
-    def __connect(self):
-        logger.info("Connecting to address:%s", self.address)
-        try:
-            self.socket = socket.socket()
-            self.socket.connect((self.address))
-        except Exception as e:
-            logger.error("Error connecting to the GXN:%s", str(e),
-                         exc_info=True)
-            self.socket = None
-            pass
-        return self.socket
-    
-    # CONTROL COMMANDS:
-    def send_command(self, cmd="", parameters=None,
-                     error_handling=True):
+    def close(self):
+        """
+        Close the GXN sockets and stop the I/O workers and thread pools,
+        for a Telescope that is being replaced or shut down
+        """
+        self.channel.close()
+        if self.move_channel is not self.channel:
+            self.move_channel.close()
+        self.move_pool.shutdown(wait=False)
+        self.snapshot_pool.shutdown(wait=False)
+
+    def _format_command(self, cmd, parameters=None):
         """
-        Send one of the GXN commands to the server.
+        Check a command and add its parameters
+
         :param cmd: Predefined "fast" or "slow" commands
         :param parameters: List of parameters that go with the specified cmd
-        :param timeout: amount in seconds to wait for a command to time out
-        :return: Bool,time to complete command in seconds
+        :return: (full command string, timeout in seconds, is info command)
+        :raises ValueError: for unknown commands and missing parameters
         """
-        # Start timer
-        start = time.time()
-        origin_command = cmd
-        origin_params = parameters
-
         info = False
-        # Check if the socket is open
-        if not self.socket:
-            logger.info("Socket not connected")
-            self.socket = self.__connect()
-            if not self.socket:
-                return {"elaptime": time.time()-start,
-                        "error": "Error connecting to the GXN adderess"}
 
         # Make sure all commands are upper case
         cmd = cmd.upper()
 
         # 1.Check to see if it is a fast or slow command
         if cmd in self.fast_commands:
-            self.socket.settimeout(60)
+            timeout = 60
             if cmd in self.info_commands:
                 info = True
-            logger.info("Sending fast command with 60s timeout")
         elif cmd in self.slow_commands:
-            self.socket.settimeout(300)
-            logger.info("Sending slow command with 300s timeout")
+            timeout = 300
         else:
             logger.error("Command '%s' is not a valid GXN command", cmd,
                          exc_info=True)
-            return {"elaptime": time.time() - start,
-                    "error": "Error with input commamd:%s" % cmd}
+            raise ValueError("Error with input commamd:%s" % cmd)
 
         # 2. Check if command is in the commands with parameters list.  If yes
         # and parameters are not listed return false
         if cmd in self.commands_with_parameters and not parameters:
-            return {"elaptime": time.time() - start,
-                    "error": "Error commamd:%s should have parameters" % cmd}
+            raise ValueError("Error commamd:%s should have parameters" % cmd)
 
         elif cmd in self.commands_with_parameters and isinstance(parameters,
                                                                  list):
@@ -130,106 +441,90 @@ class Telescope:
             parameters = [str(x) for x in parameters]
             cmd += " ".join(parameters)
 
-        # 3. At this point we have the full command for the GXN interface
+        return cmd, timeout, info
+
+    # CONTROL COMMANDS:
+    def send_command(self, cmd="", parameters=None,
+                     error_handling=True):
+        """
+        Send one of the GXN commands to the server.  Slow commands are
+        run by move_async and waited for, fast commands go through the same
+        retries in the calling thread.
+        :param cmd: Predefined "fast" or "slow" commands
+        :param parameters: List of parameters that go with the specified cmd
+        :param error_handling: retry -3 and -6 returns
+        :return: Bool,time to complete command in seconds
+        """
+        # Start timer
+        start = time.time()
+
         try:
-            logger.info("Sending:%s", cmd)
-            self.socket.send(b"%s \r" % cmd.encode('utf-8'))
-        except Exception as e:
-            logger.error("Error sending command: %s", str(e), exc_info=True)
+            self._format_command(cmd, parameters)
+        except ValueError as e:
             return {"elaptime": time.time() - start,
-                    "error": "Error commamd:%s failed" % cmd}
+                    "error": str(e)}
+
+        slow = cmd.upper() in self.slow_commands
+        if error_handling:
+            if slow:
+                return self.move_async(cmd, parameters).result()
+            future = Future()
+            self._run_command(future, self._send_once, cmd.upper(),
+                              parameters, 0, start)
+            return future.result()
 
-        # 4. Get the return response
         try:
-            # Slight delay added for the info command to print out
-            if info:
-                time.sleep(.05)
+            ret = self._send_once(None, cmd, parameters,
+                                  self.move_channel if slow else None)
+        except Exception as e:
+            logger.error("Unkown error", exc_info=True)
+            ret = {"error": str(e)}
+        ret.pop('code', None)
+        ret['elaptime'] = time.time() - start
+        return ret
 
-            ret = self.socket.recv(2048)
+    def _send_once(self, future, cmd, parameters, channel=None):
+        """
+        Send a command once and wait for the reply.  Takes the future like
+        _watch_move so _run_command can retry either of them
 
-            # Return the int code
-            if ret:
-                ret = ret.decode('utf-8')
-            else:
-                # Try one more time to get a return
-                ret = self.socket.recv(2048)
+        :param channel: GXNChannel to use, the info channel by default
+        :return: dictionary with the 'data' or 'error', and the GXN return
+                 'code' when it wasn't 0
+        """
+        full_cmd, timeout, info = self._format_command(cmd, parameters)
 
-            # If we still don't have a return then something has gone wrong.
-            if not ret:
-                logger.error("No response given back from the GXN interface")
-                return {"elaptime": time.time() - start,
-                        "error": "No response from TCS"}
+        # Anything but an info command can change what they return
+        if not info:
+            self.clear_snapshots()
 
-            # Return the info product or return code
-            logger.info("Received: %s", ret)
-            if info:
-                return {"elaptime": time.time() - start,
-                        "data": ret.rstrip('\0')}
-            else:
-                try:
-                    if isinstance(ret, str):
-                        ret = ret.rstrip('\0')
-                        if len(ret) <= 2:
-                            int_code = int(ret.rstrip('\0'))
-                            if int_code == 0:
-                                return {"elaptime": time.time() - start,
-                                        "data": "Success"}
-                            else:
-                                if error_handling:
-                                    if self.error_tracker >= 2:
-                                        self.error_tracker = 0
-                                        return {"elaptime": time.time() - start,
-                                                "error": self.check_return(int_code)}
-
-                                    if int_code == -3:
-                                        logger.error("%s: command can't be executed", cmd)
-                                        time.sleep(5)
-                                        self.error_tracker += 1
-                                        print("Command can't be executed so "
-                                              "waiting 5s and trying again")
-                                        ret = self.send_command(cmd=origin_command,
-                                                                 parameters=origin_params)
-                                        if 'data' in ret:
-                                            return {'elaptime': time.time()-start,
-                                                    'data': ret['data']}
-                                        elif 'error' in ret:
-                                            return {'elaptime': time.time()-start,
-                                                    'error': ret['error']}
-                                        else:
-                                            return ret
-
-                                    if int_code == -6:
-                                        logger.error("Robot does not have control")
-                                        self.error_tracker += 1
-                                        ret = self.takecontrol()
-                                        if 'error' in ret:
-                                            return {'elaptime': time.time()-start,
-                                                    'error': "Unable to take "
-                                                             "control of telescope"}
-                                        else:
-                                            return self.send_command(cmd=origin_command,
-                                                                     parameters=origin_params)
-
-                                return {"elaptime": time.time() - start,
-                                        "error": self.check_return(int_code)}
-                        else:
-                            return {"elaptime": time.time() - start,
-                                    "error": "Added output to "
-                                             "TCS return string:%s" % ret}
-                    else:
-                        print("Unknown TCS return")
-                        return {"elaptime": time.time()-start,
-                                "error": "Unknown TCS return value"}
-                except Exception as e:
-                    logger.error("Unbable to convert telescope return to int",
-                                 exc_info=True)
-                    return {"elaptime": time.time() - start,
-                            "error": str(e)}
-        except Exception as e:
-            logger.error("Unkown error",
+        # At this point we have the full command for the GXN interface,
+        # queue it for the I/O worker and wait for the reply
+        channel = channel or self.channel
+        ret = channel.transact(full_cmd, timeout, info)
+        if 'error' in ret:
+            return ret
+        ret = ret['data']
+
+        # Return the info product or return code
+        if info:
+            return {"data": ret.rstrip('\0')}
+        if not isinstance(ret, str):
+            print("Unknown TCS return")
+            return {"error": "Unknown TCS return value"}
+
+        ret = ret.rstrip('\0')
+        if len(ret) > 2:
+            return {"error": "Added output to TCS return string:%s" % ret}
+        try:
+            code = int(ret)
+        except ValueError as e:
+            logger.error("Unbable to convert telescope return to int",
                          exc_info=True)
-            return {"elaptime": time.time() - start,
-                    "error": str(e)}
+            return {"error": str(e)}
+        if code != 0:
+            return {"error": self.check_return(code), "code": code}
+        return {"data": "Success"}
 
     def check_return(self, int_return):
         """Non-ASCII-information commands return "0" in case of success, "-1" if
@@ -254,6 +549,162 @@ class Telescope:
 
         return self.error_str
 
+    def move_async(self, cmd, parameters=None):
+        """
+        Start a slow command and return right away.  The command goes out
+        on the move socket while the motion fields of ?POS or ?STATUS are
+        polled on the info socket, often at first and less often as the
+        move goes on.  The future is done once the GXN has replied and the
+        motion field no longer shows the move running.  A -3 return is sent again
+        after retry_delay seconds from a timer, and a -6 after taking
+        control, up to retries times.
+
+        :param cmd: one of the slow commands
+        :param parameters: List of parameters that go with the specified cmd
+        :return: concurrent.futures.Future of the send_command dictionary,
+                 its 'motion' attribute holds the last value of each motion
+                 field by field name
+        """
+        future = Future()
+        future.motion = None
+        self.move_pool.submit(self._run_command, future, self._watch_move,
+                              cmd.upper(), parameters, 0, time.time(),
+                              self.move_pool)
+        return future
+
+    def _run_command(self, future, run, cmd, parameters, attempt, start,
+                     pool=None):
+        """
+        Run one attempt of a command and set the future with its result.
+        -3 and -6 returns are tried again, up to move_retries times for
+        each call, from a timer so no thread sleeps waiting for the retry.
+
+        :param future: Future of the send_command dictionary
+        :param run: _watch_move or _send_once
+        :param attempt: number of the attempt, 0 for the first
+        :param start: time the command was first sent
+        :param pool: executor the retries run in, None to run them in the
+                     timer thread
+        """
+        try:
+            ret = run(future, cmd, parameters)
+        except Exception as e:
+            logger.error("Error running %s", cmd, exc_info=True)
+            ret = {"error": str(e)}
+
+        code = ret.pop('code', None)
+        retry = None
+        if code == -3 and attempt < self.move_retries:
+            logger.error("%s: command can't be executed, trying again in "
+                         "%ss", cmd, self.move_retry_delay)
+            retry = self.move_retry_delay
+        elif code == -6 and attempt < self.move_retries:
+            logger.error("Robot does not have control")
+            if 'error' in self.takecontrol():
+                ret = {"error": "Unable to take control of telescope"}
+            else:
+                retry = 0
+
+        if retry is not None:
+            args = (self._run_command, future, run, cmd, parameters,
+                    attempt + 1, start, pool)
+            timer = threading.Timer(retry, pool.submit if pool else
+                                    lambda method, *a: method(*a), args=args)
+            timer.daemon = True
+            timer.start()
+            return
+
+        ret['elaptime'] = time.time() - start
+        future.set_result(ret)
+
+    def _motion_state(self, checks, move_id=None):
+        """
+        :param checks: (info command, field, busy values) tuples from
+                       MOVE_BUSY
+        :param move_id: also read ?POS and add it to the position history
+                        under this move id
+        :return: (dictionary of the motion field values by field, None for
+                 the ones that couldn't be read, True if any of them is busy
+                 or unreadable)
+        """
+        replies = {}
+        if move_id:
+            replies['?POS'] = self._get_info('?POS', max_age=0).get('data')
+            self.record_pos(replies['?POS'], move_id)
+        motion = {}
+        busy = False
+        for info, field, busy_values in checks:
+            if info not in replies:
+                replies[info] = self._get_info(info, max_age=0).get('data')
+            value = replies[info].get(field) if replies[info] else None
+            motion[field] = value
+            if value is None or value in busy_values:
+                busy = True
+        return motion, busy
+
+    def _watch_move(self, future, cmd, parameters):
+        """
+        Send a slow command and wait until it has finished, run in the
+        move pool
+
+        :return: dictionary with the 'data' or 'error', and the GXN return
+                 'code' when it wasn't 0
+        """
+        try:
+            full_cmd, timeout, _ = self._format_command(cmd, parameters)
+        except ValueError as e:
+            return {"error": str(e)}
+
+        move_id = None
+        if self.pos_history_file and cmd in RECORDED_MOVES:
+            # Stationary sample the move starts from
+            move_id = "%s-%d" % (cmd, time.time() * 1000)
+            self.record_pos(self._get_info('?POS', max_age=0).get('data'),
+                            move_id)
+
+        self.clear_snapshots()
+        reply = self.move_channel.submit(full_cmd, timeout)
+        checks = MOVE_BUSY.get(cmd)
+
+        # Follow the move until the GXN replies
+        interval = self.move_poll_min
+        while True:
+            try:
+                ret = reply.result(timeout=interval)
+                break
+            except TimeoutError:
+                pass
+            if checks:
+                future.motion = self._motion_state(checks, move_id)[0]
+            interval = min(interval * 1.5, self.move_poll_max)
+
+        self.clear_snapshots()
+        if 'error' in ret:
+            return ret
+        try:
+            code = int(ret['data'].rstrip('\0'))
+        except ValueError:
+            return {"error": "Added output to TCS return string:%s" %
+                             ret['data']}
+        if code != 0:
+            return {"error": self.check_return(code), "code": code}
+
+        # The reply can come before the telescope has settled
+        if checks:
+            deadline = time.time() + self.move_settle_timeout
+            interval = self.move_poll_min
+            while True:
+                future.motion, busy = self._motion_state(checks, move_id)
+                if not busy:
+                    break
+                if time.time() > deadline:
+                    return {"error": "%s still moving after %ss: %s" %
+                                     (cmd, self.move_settle_timeout,
+                                      future.motion)}
+                time.sleep(interval)
+                interval = min(interval * 1.5, self.move_poll_max)
+        return {"data": "Success"}
+
     def takecontrol(self):
         """
         (FAST) requests that TCS control be given to GXN interface.
@@ -801,85 +1252,191 @@ class Telescope:
         else:
             return ret
 
+    def tel_move_async(self, name=None, ra=None, dec=None, equinox=2000,
+                       ra_rate=0, dec_rate=0, motion_flag="", epoch=""):
+        """
+        tel_move_sequence that returns once the coordinates are in and the
+        slew has started, see move_async
+
+        :return: Future of the send_command dictionary
+        """
+        ret = self.coords(name=name, ra=ra, dec=dec, equinox=equinox,
+                          ra_rate=ra_rate, dec_rate=dec_rate,
+                          motion_flag=motion_flag, epoch=epoch)
+        if "error" in ret:
+            future = Future()
+            future.set_result(ret)
+            return future
+        return self.move_async("GOPOS")
+
     # INFORMATION COMMANDS
     def list_to_dict(self, list_str):
         """
-        Given a list convert it to a dictionary based on a delimiter
+        Given a list convert it to a dictionary based on a delimiter, see
+        parse_info
 
         :return: dictionary
         """
+        return parse_info(list_str, self.delimiter)
 
-        list_str = os.linesep.join([s.lower() for s in list_str.splitlines()
-                                    if s and "=" in s])
+    def _get_info(self, cmd, max_age=None):
+        """
+        Reply of an info command, from the snapshot cache when the last one
+        is recent enough
 
-        if len(list_str) <= 1:
-            return False
-        return dict(item.split(self.delimiter) for item in list_str.split("\n"))
+        :param cmd: ?POS, ?STATUS, ?WEATHER or ?FAULTS
+        :param max_age: seconds, None uses the configured snapshot_max_age
+                        of the command and 0 always asks the GXN
+        :return: dictionary with the 'data' and the 'time' it was read
+        """
+        start = time.time()
+        if max_age is None:
+            max_age = self.snapshot_max_age.get(cmd, 0)
+
+        cached = self.snapshots.get(cmd)
+        if cached and max_age and start - cached['time'] <= max_age:
+            return {"elaptime": time.time() - start, "data": cached['data'],
+                    "time": cached['time']}
 
-    def get_weather(self):
+        generation = self.snapshot_generation
+        ret = self.send_command(cmd)
+        if "data" not in ret:
+            return ret
+
+        data = ret['data']
+        if cmd != '?FAULTS':
+            data = self.list_to_dict(data)
+        # Stamped when the command was queued so the age is never
+        # underestimated
+        with self.snapshot_lock:
+            if generation == self.snapshot_generation:
+                self.snapshots[cmd] = {'time': start, 'data': data}
+        return {"elaptime": time.time() - start, "data": data,
+                "time": start}
+
+    def clear_snapshots(self):
+        """
+        Forget the cached info replies, done before any command that
+        moves or changes the telescope
+        """
+        with self.snapshot_lock:
+            self.snapshot_generation += 1
+            self.snapshots = {}
+
+    def get_weather(self, max_age=None):
         """
         Get the weather output and convert it to a dictionary
 
+        :param max_age: oldest cached reply in seconds, see _get_info
         :return: bool, status message
         """
-        start = time.time()
-        ret = self.send_command("?WEATHER")
+        ret = self._get_info("?WEATHER", max_age)
         if "data" in ret:
-            self.weather = self.list_to_dict(ret['data'])
-        else:
-            return ret
+            self.weather = ret['data']
+        return ret
 
-        return {"elaptime": time.time()-start,
-                "data": self.weather}
-
-    def get_status(self, redo=True):
+    def get_status(self, redo=True, max_age=None):
         """
         Get the status output and convert it to a dictionary
 
+        :param max_age: oldest cached reply in seconds, see _get_info
         :return: bool, status message
         """
-
-        start = time.time()
-        ret = self.send_command("?STATUS")
+        ret = self._get_info("?STATUS", max_age)
         if "data" in ret:
-            self.status = self.list_to_dict(ret['data'])
-        else:
-            return ret
-
-        return {"elaptime": time.time() - start,
-                "data": self.status}
+            self.status = ret['data']
+        return ret
 
-    def get_pos(self):
+    def get_pos(self, max_age=None):
         """
         Get the position output and convert it to a dictionary
 
+        :param max_age: oldest cached reply in seconds, see _get_info
         :return: bool, status message
         """
-
-        start = time.time()
-        ret = self.send_command("?POS")
+        ret = self._get_info("?POS", max_age)
         if "data" in ret:
-            self.pos = self.list_to_dict(ret['data'])
-        else:
-            return ret
-        return {"elaptime": time.time() - start,
-                "data": self.pos}
+            self.pos = ret['data']
+        return ret
 
-    def get_faults(self):
+    def record_pos(self, pos=None, move_id=''):
         """
-        Get the faults output and convert it to a dictionary
+        Append a position to the position history file, called while one
+        of the RECORDED_MOVES is watched
 
-        :return: bool, status message
+        :param pos: ?POS dictionary, by default the last position read
+        :param move_id: id of the move the sample belongs to, the slew model
+                        is only fit between samples of the same move
+        :return: bool
         """
-        start = time.time()
-        ret = self.send_command("?FAULTS")
+        pos = pos if pos is not None else self.pos
+        if not self.pos_history_file or not pos:
+            return False
+
+        try:
+            line = ",".join([str(pos.get(key, ''))
+                             for key in self.pos_history_keys] +
+                            [str(move_id)])
+            with open(self.pos_history_file, 'a') as the_file:
+                the_file.write(line + "\n")
+        except Exception as e:
+            logger.error("Unable to record position: %s", str(e))
+            return False
+        return True
 
+    def get_faults(self, max_age=None):
+        """
+        Get the faults output
 
+        :param max_age: oldest cached reply in seconds, see _get_info
+        :return: bool, status message
+        """
+        ret = self._get_info("?FAULTS", max_age)
         if "data" in ret:
+            self.faults = ret['data']
+        return ret
+
+    def get_snapshot(self, max_age=None):
+        """
+        Position, status, weather and faults in one dictionary, the keys
+        the image header needs.  The four info commands are queued
+        together so they go out back to back on the GXN socket.
+
+        :param max_age: oldest cached reply in seconds, see _get_info
+        :return: dictionary with the merged 'data', the replies that
+                 failed are listed in data['snapshot_errors'].  An error
+                 when the position can't be read
+        """
+        start = time.time()
+        futures = {}
+        for name, method in [('pos', self.get_pos),
+                             ('status', self.get_status),
+                             ('weather', self.get_weather),
+                             ('faults', self.get_faults)]:
+            futures[name] = self.snapshot_pool.submit(method,
+                                                      max_age=max_age)
+
+        data = {}
+        errors = {}
+        for name in ['faults', 'weather', 'status', 'pos']:
+            try:
+                ret = futures[name].result()
+            except Exception as e:
+                ret = {'error': str(e)}
+            if 'data' not in ret:
+                errors[name] = ret.get('error')
+            elif name == 'faults':
+                data['faults'] = ret['data']
+            elif ret['data']:
+                data.update(ret['data'])
+
+        if 'pos' in errors:
             return {"elaptime": time.time() - start,
-                    "data": ret['data']}
-        else:
-            return ret
+                    "error": errors['pos']}
+        if errors:
+            logger.error("Snapshot errors: %s", errors)
+            data['snapshot_errors'] = errors
+        return {"elaptime": time.time() - start, "data": data}
 
 if __name__ == "__main__":
     x = Telescope()
@@ -1,9 +1,39 @@
+"""
+Simulator of the P60 GXN interface with realistic timing.
+
+The simulated telescope has a position, dome, focus and shutters that move
+at configurable rates, so slow commands take as long as they would on the
+sky: a GOPOS reply comes back after the HA/Dec slew, the dome rotation and
+the settle time, whichever finishes last.  ?POS, ?STATUS and ?WEATHER are
+generated from that state and can be read on other connections while a
+move is running, as with the real interface.
+
+Faults can be injected to exercise the error handling of tcs.Telescope:
+
+    server.inject_fault('GOPOS', -3, count=2)   next two GOPOS return -3
+    server.lose_control()                       commands return -6 until
+                                                TAKECONTROL
+    fault_rate=0.05                             5% of slow commands -3
+
+or from a client with the SIMFAULT, SIMCONTROL and SIMTIMESCALE commands:
+
+    SIMFAULT GOPOS -3 2
+    SIMCONTROL LOST
+    SIMTIMESCALE 0.1
+
+time_scale < 1 runs every move faster than real time, 0.1 makes a 60s slew
+take 6s.
+
+    python -m observatory.telescope.tcs_sim_server --port 9002 --time-scale 1
+"""
 import logging
 from logging.handlers import TimedRotatingFileHandler
-import json
 import os
+import math
 import time
+import random
 import socket
+import argparse
 import threading
 import yaml
 
@@ -25,151 +55,666 @@ logHandler.setLevel(logging.DEBUG)
 logger.addHandler(logHandler)
 logger.info("Starting Logger: Logger file is %s", 'tcs_simserver.log')
 
+# Palomar
+LATITUDE = 33.3563
+LONGITUDE = -116.8650
+
+# Rates in degrees (mm for the focus) per second and times in seconds,
+# overridden by observatory.tcs.sim in the config and the timing argument
+TIMING = {
+    'ha_rate': 1.0,         # HA axis slew rate
+    'dec_rate': 1.0,        # Dec axis slew rate
+    'accel_time': 4.0,      # extra time to speed up and slow down an axis
+    'dome_rate': 2.0,       # dome rotation
+    'settle_time': 8.0,     # after a slew before TRACKING
+    'offset_settle': 1.5,   # after a PT or N/S/E/W offset
+    'focus_rate': 0.25,     # secondary focus
+    'focus_settle': 1.0,
+    'shutter_time': 60.0,   # dome shutters opening or closing
+    'lamp_time': 3.0,       # LAMPON
+    'init_time': 120.0,     # TELINIT
+    'reply_delay': 0.01     # every command
+}
+
+# Slow commands, their reply waits for the move
+SLOW_COMMANDS = ['TELINIT', 'OPEN', 'CLOSE', 'GOPOS', 'GOREF', 'N', 'S',
+                 'E', 'W', 'ES', 'WS', 'PT', 'STOW', 'INCFOCUS', 'PTS',
+                 'IRATES', 'GOFOCUS', 'GODOME', 'CLOSED', 'LAMPON']
+
+FAST_COMMANDS = ['TAKECONTROL', 'MRATES', 'SAO', 'LAMPOFF', 'LASTX',
+                 'GIVECONTROL', 'STOP', 'X', 'TX', 'Z', 'COORDS', 'INZP',
+                 'RATES', 'RATESS']
+
+# Least number of numeric parameters of each command, fewer gives -2
+NUM_PARAMETERS = {'COORDS': 3, 'STOW': 3, 'PT': 2, 'PTS': 2, 'IRATES': 2,
+                  'RATES': 2, 'RATESS': 2, 'GODOME': 1, 'GOFOCUS': 1,
+                  'INCFOCUS': 1, 'MRATES': 1, 'N': 1, 'S': 1, 'E': 1,
+                  'W': 1, 'ES': 1, 'WS': 1}
+
+
+def sexagesimal(value, plus_sign=False, decimals=1):
+    """
+    Format a number as [+-]DD:MM:SS.s
+    """
+    sign = '-' if value < 0 else ('+' if plus_sign else '')
+    value = abs(value)
+    d = int(value)
+    m = int((value - d) * 60)
+    s = (value - d - m / 60.) * 3600
+    if round(s, decimals) >= 60:
+        s = 0
+        m += 1
+    if m >= 60:
+        m = 0
+        d += 1
+    width = 3 + decimals if decimals else 2
+    return "%s%02d:%02d:%0*.*f" % (sign, d, m, width, decimals, s)
+
+
+def angle_between(a, b):
+    """
+    Shortest angle in degrees between two azimuths
+    """
+    return abs((a - b + 180) % 360 - 180)
+
+
+class TelescopeModel:
+    """
+    State of the simulated telescope.  Positions are interpolated over
+    the length of each move so an info command sent during a slew sees
+    the telescope part of the way there.
+    """
+
+    def __init__(self, timing=None, time_scale=1.0, fault_rate=0.0,
+                 seed=None):
+        """
+        :param timing: dictionary overriding TIMING
+        :param time_scale: multiply every move time by this
+        :param fault_rate: chance of a slow command returning -3
+        :param seed: random seed for the fault rate
+        """
+        self.timing = dict(TIMING, **(timing or {}))
+        self.time_scale = time_scale
+        self.fault_rate = fault_rate
+        self.random = random.Random(seed)
+        self.lock = threading.RLock()
+
+        self.ha = 0.          # hours, positive west
+        self.dec = 109.       # day stow
+        self.dome_az = 40.
+        self.focus = 15.0
+        self.motion = 'STOPPED'
+        self.focus_motion = 'STATIONARY'
+        self.shutter = 'CLOSED'
+        self.lamp = 'OFF'
+        self.control = 'REMOTE'
+        self.initialized = True
+        self.mrate = 25.      # arcsec per second for offsets
+        self.target = {'name': 'Simulated', 'ra': 0., 'dec': 33.,
+                       'equinox': 2000., 'ra_rate': 0., 'dec_rate': 0.}
+        self.offsets = [0., 0.]
+        self.tracking_ra = None
+
+        # Running move of each part: (start, end, from, to)
+        self.moves = {}
+        # Command: [code, count] of injected faults
+        self.faults = {}
+        self.log = []
+
+    # TIME
+    def jd(self, now=None):
+        return (now or time.time()) / 86400. + 2440587.5
+
+    def lst(self, now=None):
+        """
+        Local sidereal time in hours
+        """
+        d = self.jd(now) - 2451545.0
+        gmst = 18.697374558 + 24.06570982441908 * d
+        return (gmst + LONGITUDE / 15.) % 24
+
+    def scaled(self, seconds):
+        return seconds * self.time_scale
+
+    # MOVES
+    def _start(self, part, duration, start_value, end_value):
+        now = time.time()
+        self.moves[part] = (now, now + duration, start_value, end_value)
+
+    def _value(self, part, current):
+        """
+        Interpolated value of a moving part, finishing the move when it is
+        over
+        """
+        if part not in self.moves:
+            return current
+        start, end, a, b = self.moves[part]
+        now = time.time()
+        if now >= end:
+            del self.moves[part]
+            return b
+        frac = (now - start) / (end - start) if end > start else 1.
+        return a + (b - a) * frac
+
+    def update(self):
+        """
+        Bring the positions up to the current time
+        """
+        with self.lock:
+            self.ha = self._value('ha', self.ha)
+            self.dec = self._value('dec', self.dec)
+            self.dome_az = self._value('dome', self.dome_az) % 360
+            self.focus = self._value('focus', self.focus)
+            for part in ['settle', 'shutter']:
+                self._value(part, 0)
+            if not any(p in self.moves for p in ['ha', 'dec', 'settle']) \
+                    and self.motion in ('SLEWING', 'MOVING'):
+                self.motion = self.after_motion
+            if 'focus' not in self.moves:
+                self.focus_motion = 'STATIONARY'
+            if 'shutter' not in self.moves and \
+                    self.shutter in ('OPENING', 'CLOSING'):
+                self.shutter = 'OPEN' if self.shutter == 'OPENING' \
+                    else 'CLOSED'
+            if self.tracking_ra is not None and not self.moves:
+                # Tracking keeps the RA, so the HA follows the sky
+                self.ha = (self.lst() - self.tracking_ra / 15.) % 24
+                if self.ha > 12:
+                    self.ha -= 24
+
+    def slew_time(self, ha, dec, dome_az):
+        """
+        Seconds to reach a position, the longest of the two axes and the
+        dome plus the settle time
+
+        :param ha: hours
+        :param dec: degrees
+        :param dome_az: degrees
+        :return: (telescope seconds, dome seconds)
+        """
+        t = self.timing
+        dha = abs(ha - self.ha) * 15
+        ddec = abs(dec - self.dec)
+        tel = max(dha / t['ha_rate'], ddec / t['dec_rate'])
+        if tel > 0:
+            tel += t['accel_time']
+        dome = angle_between(dome_az, self.dome_az) / t['dome_rate']
+        return self.scaled(tel), self.scaled(dome)
+
+    def goto(self, ha, dec, dome_az, after='TRACKING', tracking_ra=None):
+        """
+        Start a slew
+
+        :return: seconds until the move has settled
+        """
+        with self.lock:
+            self.update()
+            tel, dome = self.slew_time(ha, dec, dome_az)
+            settle = self.scaled(self.timing['settle_time'])
+            self._start('ha', tel, self.ha, ha)
+            self._start('dec', tel, self.dec, dec)
+            self._start('dome', dome, self.dome_az,
+                        self.dome_az + (((dome_az - self.dome_az) + 180)
+                                        % 360 - 180))
+            self._start('settle', max(tel, dome) + settle, 0, 0)
+            self.motion = 'SLEWING'
+            self.after_motion = after
+            self.tracking_ra = tracking_ra
+            self.lamp = 'OFF'
+            return max(tel, dome) + settle
+
+    def offset(self, ra_arcsec, dec_arcsec):
+        """
+        Start a PT style offset at the MRATES rate
+
+        :return: seconds until the move has settled
+        """
+        with self.lock:
+            self.update()
+            distance = math.hypot(ra_arcsec, dec_arcsec)
+            duration = self.scaled(distance / self.mrate +
+                                   self.timing['offset_settle'])
+            cos_dec = max(math.cos(math.radians(self.dec)), 0.01)
+            self._start('ha', duration, self.ha,
+                        self.ha - ra_arcsec / 3600. / 15. / cos_dec)
+            self._start('dec', duration, self.dec,
+                        self.dec + dec_arcsec / 3600.)
+            self.offsets[0] += ra_arcsec
+            self.offsets[1] += dec_arcsec
+            if self.tracking_ra is not None:
+                self.tracking_ra += ra_arcsec / 3600. / cos_dec
+            self.after_motion = self.motion if self.motion not in (
+                'SLEWING', 'MOVING') else 'TRACKING'
+            self.motion = 'MOVING'
+            return duration
+
+    def move_focus(self, position):
+        with self.lock:
+            self.update()
+            duration = self.scaled(abs(position - self.focus) /
+                                   self.timing['focus_rate'] +
+                                   self.timing['focus_settle'])
+            self._start('focus', duration, self.focus, position)
+            self.focus_motion = 'MOVING'
+            return duration
+
+    def move_shutter(self, state):
+        with self.lock:
+            self.update()
+            if self.shutter == state:
+                return 0.
+            duration = self.scaled(self.timing['shutter_time'])
+            self._start('shutter', duration, 0, 0)
+            self.shutter = 'OPENING' if state == 'OPEN' else 'CLOSING'
+            return duration
+
+    def stop(self):
+        with self.lock:
+            self.update()
+            for part in ['ha', 'dec', 'dome', 'settle']:
+                self.moves.pop(part, None)
+            self.motion = 'STOPPED'
+            self.tracking_ra = None
+
+    # FAULTS
+    def inject_fault(self, command, code=-3, count=1):
+        """
+        Make the next count commands of a kind return a code
+
+        :param command: GXN command, '*' for any
+        :param code: -1, -2, -3, -5 or -6
+        :param count: number of commands to fail
+        """
+        with self.lock:
+            self.faults[command.upper()] = [int(code), int(count)]
+
+    def lose_control(self):
+        with self.lock:
+            self.control = 'AVAILABLE'
+
+    def check_fault(self, command):
+        """
+        :return: code to return instead of running the command, or None
+        """
+        with self.lock:
+            if self.control != 'REMOTE' and command not in (
+                    'TAKECONTROL', 'GIVECONTROL'):
+                return -6
+            for key in [command, '*']:
+                fault = self.faults.get(key)
+                if fault:
+                    fault[1] -= 1
+                    if fault[1] <= 0:
+                        del self.faults[key]
+                    return fault[0]
+            if command in SLOW_COMMANDS and self.fault_rate and \
+                    self.random.random() < self.fault_rate:
+                return -3
+        return None
+
+    # INFO REPLIES
+    def altaz(self):
+        ha = math.radians(self.ha * 15)
+        dec = math.radians(self.dec)
+        lat = math.radians(LATITUDE)
+        sin_alt = (math.sin(dec) * math.sin(lat) +
+                   math.cos(dec) * math.cos(lat) * math.cos(ha))
+        alt = math.asin(max(-1., min(1., sin_alt)))
+        az = math.atan2(-math.cos(dec) * math.sin(ha),
+                        math.sin(dec) * math.cos(lat) -
+                        math.cos(dec) * math.sin(lat) * math.cos(ha))
+        return math.degrees(alt), math.degrees(az) % 360
+
+    def utc(self, now):
+        t = time.gmtime(now)
+        return "%s.%d" % (time.strftime("%Y:%j:%H:%M:%S", t),
+                          int((now % 1) * 10))
+
+    def pos(self):
+        with self.lock:
+            self.update()
+            now = time.time()
+            lst = self.lst(now)
+            ra = (lst - self.ha) % 24
+            alt, az = self.altaz()
+            airmass = 1. / math.sin(math.radians(alt)) if alt > 1 else 99.
+            ha = ('W' if self.ha >= 0 else 'E') + sexagesimal(abs(self.ha),
+                                                              decimals=2)
+            lines = [
+                "?POS:",
+                "UTC=%s" % self.utc(now),
+                "LST=%s" % sexagesimal(lst),
+                "Julian_Date=%.7f" % self.jd(now),
+                "Apparent_Equinox=%.2f" % (2000 + (self.jd(now) -
+                                                   2451545.0) / 365.25),
+                "Telescope_Equinox=J2000.0",
+                "Telescope_HA=%s" % ha,
+                "Telescope_RA=%s" % sexagesimal(ra, decimals=2),
+                "Telescope_Dec=%s" % sexagesimal(self.dec, plus_sign=True),
+                "Telescope_RA_Rate=%.2f" % self.target['ra_rate'],
+                "Telescope_Dec_Rate=%.2f" % self.target['dec_rate'],
+                "Telescope_RA_Offset=%.2f" % self.offsets[0],
+                "Telescope_Dec_Offset=%.2f" % self.offsets[1],
+                "Telescope_Azimuth=%.2f" % az,
+                "Telescope_Elevation=%.2f" % alt,
+                "Telescope_Parallactic=0",
+                "Telescope_HA_Speed=%.4f" % (self.timing['ha_rate']
+                                             if 'ha' in self.moves else 0),
+                "Telescope_Dec_Speed=%.4f" % (self.timing['dec_rate']
+                                              if 'dec' in self.moves else 0),
+                "Telescope_HA_Refr(arcsec)=0.00",
+                "Telescope_Dec_Refr(arcsec)=0.00",
+                "Telescope_Motion_Status=%s" % self.motion,
+                "Telescope_Airmass=%.3f" % airmass,
+                "Telescope_Ref_UT=0.0",
+                'Object_Name="%s"' % self.target['name'],
+                "Object_Equinox=J%.1f" % self.target['equinox'],
+                "Object_RA=%s" % sexagesimal(self.target['ra'] / 15.,
+                                             decimals=2),
+                "Object_Dec=%s" % sexagesimal(self.target['dec'],
+                                              plus_sign=True),
+                "Object_RA_Rate=%.2f" % self.target['ra_rate'],
+                "Object_Dec_Rate=%.2f" % self.target['dec_rate'],
+                "Object_RA_Proper_Motion=0.000000",
+                "Object_Dec_Proper_Motion=0.00000",
+                "Focus_Position=%.2f" % self.focus,
+                "Dome_Gap(inch)=%d" % int(angle_between(self.dome_az, az)
+                                          * 10),
+                "Dome_Azimuth=%.1f" % self.dome_az,
+                "Windscreen_Elevation=0",
+                "UTSunset=02:31",
+                "UTSunrise=13:00",
+                "Solar_RA=10:44",
+                "Solar_Dec=+07:58"]
+            return "\n".join(lines) + "\n"
+
+    def status(self):
+        with self.lock:
+            self.update()
+            lines = [
+                "?STATUS:",
+                "UTC=%s" % self.utc(time.time()),
+                "Telescope_ID=60",
+                "Telescope_Control_Status=%s" % self.control,
+                "Lamp_Status=%s" % self.lamp,
+                "Lamp_Current=%.2f" % (4.2 if self.lamp == 'ON' else 0),
+                "Dome_Shutter_Status=%s" % self.shutter,
+                "WS_Motion_Mode=BOTTOM",
+                "Dome_Motion_Mode=%s" % ('MOVING' if 'dome' in self.moves
+                                         else 'ANTICIPATE'),
+                "Telescope_Power_Status=READY",
+                "Oil_Pad_Status=READY",
+                "Weather_Status=OKAY",
+                "Sunlight_Status=OKAY",
+                "Remote_Close_Status=NOT_OKAY",
+                "Telescope_Ready_Status=%s" % ('READY' if self.initialized
+                                               else 'NOT_READY'),
+                "HA_Axis_Hard_Limit_Status=OKAY",
+                "Dec_Axis_Hard_Limit_Status=OKAY",
+                "Focus_Hard_Limit_Status=OKAY",
+                "Focus_Soft_Up_Limit_Value=35.00",
+                "Focus_Soft_Down_Limit_Value=0.50",
+                "Focus_Soft_Limit_Status=OKAY",
+                "Focus_Motion_Status=%s" % self.focus_motion,
+                "East_Soft_Limit_Value=-6.4",
+                "West_Soft_Limit_Value=6.4",
+                "North_Soft_Limit_Value=109.5",
+                "South_Soft_Limit_Value=-41.8",
+                "Horizon_Soft_Limit_Value=10.0",
+                "HA_Axis_Soft_Limit_Status=OKAY",
+                "Dec_Axis_Soft_Limit_Status=OKAY",
+                "Horizon_Soft_Limit_Status=OKAY"]
+            return "\n".join(lines)
+
+    def weather(self):
+        lines = [
+            "?WEATHER:",
+            "UTC=%s" % self.utc(time.time()),
+            "Windspeed_Avg_Threshold=25.0",
+            "Gust_Speed_Threshold=35.0",
+            "Gust_Hold_Time=900",
+            "Outside_DewPt_Threshold=2.0",
+            "Inside_DewPt_Threshold=2.0",
+            "Wetness_Threshold=500",
+            "Wind_Dir_Current=63",
+            "Windspeed_Current=3.7",
+            "Windspeed_Average=5.7",
+            "Outside_Air_Temp=20.5",
+            "Outside_Rel_Hum=65.7",
+            "Outside_DewPt=13.9",
+            "Inside_Air_Temp=21.3",
+            "Inside_Rel_Hum=55.9",
+            "Inside_DewPt=12.1",
+            "Mirror_Temp=21.2",
+            "Floor_Temp=21.7",
+            "Bot_Tube_Temp=21.0",
+            "Mid_Tube_Temp=21.3",
+            "Top_Tube_Temp=21.4",
+            "Top_Air_Temp=21.3",
+            "Primary_Cell_Temp=21.2",
+            "Secondary_Cell_Temp=21.2",
+            "Wetness=-271",
+            "Weather_Status=READY"]
+        return "\n".join(lines)
+
+    def fault_list(self):
+        with self.lock:
+            if self.control != 'REMOTE':
+                return "?FAULTS:\nGXN does not have control\n"
+            if not self.faults:
+                return "0"
+            return "?FAULTS:\n" + "\n".join(
+                "%s returns %s (%s more)" % (k, v[0], v[1])
+                for k, v in self.faults.items()) + "\n"
+
+    # COMMANDS
+    def execute(self, cmd, args):
+        """
+        Run one GXN command
+
+        :param cmd: upper case command
+        :param args: list of parameter strings
+        :return: (reply string, seconds to wait before replying)
+        """
+        delay = self.scaled(self.timing['reply_delay'])
+        if cmd == '?POS':
+            return self.pos(), delay
+        if cmd == '?STATUS':
+            return self.status(), delay
+        if cmd == '?WEATHER':
+            return self.weather(), delay
+        if cmd == '?FAULTS':
+            return self.fault_list(), delay
+
+        if cmd not in SLOW_COMMANDS and cmd not in FAST_COMMANDS:
+            return "-1", delay
+
+        code = self.check_fault(cmd)
+        if code is not None:
+            logger.info("Injected %s for %s", code, cmd)
+            return str(code), delay
+
+        try:
+            values = [float(x) for x in args if not x.startswith('"')]
+        except ValueError:
+            return "-2", delay
+        name = [x.strip('"') for x in args if x.startswith('"')]
+        if len(values) < NUM_PARAMETERS.get(cmd, 0):
+            return "-2", delay
+
+        wait = 0.
+        with self.lock:
+            if cmd == 'TAKECONTROL':
+                self.control = 'REMOTE'
+            elif cmd == 'GIVECONTROL':
+                self.control = 'AVAILABLE'
+            elif cmd == 'COORDS':
+                self.target.update({'ra': values[0] * 15,
+                                    'dec': values[1],
+                                    'equinox': values[2] or 2000.})
+                if len(values) >= 5:
+                    self.target['ra_rate'] = values[3]
+                    self.target['dec_rate'] = values[4]
+                if name:
+                    self.target['name'] = name[0]
+            elif cmd in ('GOPOS', 'GOREF'):
+                ha = (self.lst() - self.target['ra'] / 15.) % 24
+                if ha > 12:
+                    ha -= 24
+                alt, az = self.altaz_of(ha, self.target['dec'])
+                wait = self.goto(ha, self.target['dec'], az,
+                                 tracking_ra=self.target['ra'])
+            elif cmd == 'STOW':
+                if len(values) != 3:
+                    return "-2", delay
+                wait = self.goto(values[0], values[1], values[2],
+                                 after='IN_POSITION')
+            elif cmd == 'GODOME':
+                self.update()
+                dome = self.scaled(angle_between(values[0], self.dome_az) /
+                                   self.timing['dome_rate'])
+                # Shortest way round, as in goto
+                self._start('dome', dome, self.dome_az,
+                            self.dome_az + ((values[0] - self.dome_az + 180)
+                                            % 360 - 180))
+                wait = dome
+            elif cmd in ('PT', 'PTS'):
+                if len(values) != 2:
+                    return "-2", delay
+                ra = values[0] * 15 if cmd == 'PTS' else values[0]
+                wait = self.offset(ra, values[1])
+            elif cmd in ('N', 'S', 'E', 'W'):
+                sign = 1 if cmd in ('N', 'E') else -1
+                if cmd in ('N', 'S'):
+                    wait = self.offset(0, sign * values[0])
+                else:
+                    wait = self.offset(sign * values[0], 0)
+            elif cmd in ('ES', 'WS'):
+                sign = 1 if cmd == 'ES' else -1
+                wait = self.offset(sign * values[0] * 15, 0)
+            elif cmd == 'GOFOCUS':
+                if not 4.5 <= values[0] <= 24:
+                    return "-2", delay
+                wait = self.move_focus(values[0])
+            elif cmd == 'INCFOCUS':
+                wait = self.move_focus(self.focus + values[0])
+            elif cmd == 'OPEN':
+                wait = self.move_shutter('OPEN')
+            elif cmd in ('CLOSE', 'CLOSED'):
+                wait = self.move_shutter('CLOSED')
+            elif cmd == 'STOP':
+                self.stop()
+            elif cmd == 'MRATES':
+                self.mrate = values[0]
+            elif cmd == 'LAMPON':
+                self.lamp = 'ON'
+                wait = self.scaled(self.timing['lamp_time'])
+            elif cmd == 'LAMPOFF':
+                self.lamp = 'OFF'
+            elif cmd == 'TELINIT':
+                self.initialized = True
+                wait = max(self.goto(0., 109., 40., after='IN_POSITION'),
+                           self.scaled(self.timing['init_time']))
+            elif cmd in ('IRATES', 'RATES', 'RATESS'):
+                self.target['ra_rate'] = values[0]
+                self.target['dec_rate'] = values[1]
+
+        if cmd in SLOW_COMMANDS:
+            return "0", delay + wait
+        return "0", delay
+
+    def altaz_of(self, ha, dec):
+        ha_now, dec_now = self.ha, self.dec
+        self.ha, self.dec = ha, dec
+        try:
+            return self.altaz()
+        finally:
+            self.ha, self.dec = ha_now, dec_now
+
+
 class SimServer:
-    def __init__(self, hostname, port):
+    def __init__(self, hostname, port, timing=None, time_scale=1.0,
+                 fault_rate=0.0, seed=None):
+        """
+        :param hostname: address to listen on
+        :param port: port to listen on
+        :param timing: dictionary overriding TIMING
+        :param time_scale: multiply every move time by this
+        :param fault_rate: chance of a slow command returning -3
+        :param seed: random seed for the fault rate
+        """
         self.hostname = hostname
         self.port = port
         self.socket = ""
-        self.cam = None
-        self.pset = "pset"
+        timing = dict(params['observatory']['tcs'].get('sim', {}),
+                      **(timing or {}))
+        self.model = TelescopeModel(timing=timing, time_scale=time_scale,
+                                    fault_rate=fault_rate, seed=seed)
+
+    def inject_fault(self, command, code=-3, count=1):
+        self.model.inject_fault(command, code, count)
+
+    def lose_control(self):
+        self.model.lose_control()
+
+    def sim_command(self, cmd, args):
+        """
+        Commands that change the simulator rather than the telescope
+        """
+        try:
+            if cmd == 'SIMFAULT':
+                self.inject_fault(args[0], int(args[1]),
+                                  int(args[2]) if len(args) > 2 else 1)
+            elif cmd == 'SIMCONTROL':
+                if args and args[0].upper() == 'LOST':
+                    self.lose_control()
+                else:
+                    self.model.control = 'REMOTE'
+            elif cmd == 'SIMTIMESCALE':
+                self.model.time_scale = float(args[0])
+            return "0"
+        except (IndexError, ValueError):
+            return "-2"
+
     def handle(self, connection, address):
         while True:
-            response = {'test': 'test'}
             try:
-
                 data = connection.recv(2048)
-
-                data = data.decode("utf8")
-                logger.info("Received: %s", data)
                 if not data:
                     break
-                print(type(data), data)
-                print(type(self.pset))
-                print(data, self.pset)
-                if self.pset in data:
-
-                    x = data.split()
-                    if x[2] == "1":
-                        ret = '\xff\xfd\x03\xff\xfb\x01\r\nSynaccess Inc. Telnet Session V6.2\n\r>\r\n>pset %s 1\n\r' % x[1]
-                    elif x[2] == "0":
-                        ret = '\xff\xfd\x03\xff\xfb\x01\r\nSynaccess Inc. Telnet Session V6.2\n\r>\r\n>pset %s 0\n\r' % x[1]
-                elif "pshow" in data:
-                    ret = '\xff\xfd\x03\xff\xfb\x01\r\nSynaccess Telnet V6.2\n\r>\r\n>pshow\n\r\n\r\n\rPort | Name       |Status\n\r   1 |    Outlet1 |   OFF|   2 |    Outlet2 |   OFF |\r\n>\x00'
-                elif 'status' in data.lower():
-                    ret = """?STATUS:
-UTC=2019:245:12:13:02.0
-Telescope_ID=60
-Telescope_Control_Status=REMOTE
-Lamp_Status=OFF
-Lamp_Current=0.00
-Dome_Shutter_Status=CLOSED
-WS_Motion_Mode=BOTTOM
-Dome_Motion_Mode=ANTICIPATE
-Telescope_Power_Status=READY
-Oil_Pad_Status=READY
-Weather_Status=OKAY
-Sunlight_Status=OKAY
-Remote_Close_Status=NOT_OKAY
-Telescope_Ready_Status=READY
-HA_Axis_Hard_Limit_Status=OKAY
-Dec_Axis_Hard_Limit_Status=OKAY
-Focus_Hard_Limit_Status=OKAY
-Focus_Soft_Up_Limit_Value=35.00
-Focus_Soft_Down_Limit_Value=0.50
-Focus_Soft_Limit_Status=OKAY
-Focus_Motion_Status=STATIONARY
-East_Soft_Limit_Value=-6.4
-West_Soft_Limit_Value=6.4
-North_Soft_Limit_Value=109.5
-South_Soft_Limit_Value=-41.8
-Horizon_Soft_Limit_Value=10.0
-HA_Axis_Soft_Limit_Status=OKAY
-Dec_Axis_Soft_Limit_Status=OKAY
-Horizon_Soft_Limit_Status=OKAY"""
-
-                elif 'pos' in data.lower() and 'go' not in data.lower():
-                    ret = """?POS:
-UTC=2019:245:12:13:02.2
-LST=03:11:01.3
-Julian_Date=2458729.0090534
-Apparent_Equinox=2019.67
-Telescope_Equinox=J2000.0
-Telescope_HA=E00:51:28.85
-Telescope_RA=04:01:38.90
-Telescope_Dec=-20:31:56.3
-Telescope_RA_Rate=0.00
-Telescope_Dec_Rate=0.00
-Telescope_RA_Offset=13166.08
-Telescope_Dec_Offset=-110.87
-Telescope_Azimuth=165.34
-Telescope_Elevation=34.84
-Telescope_Parallactic=347
-Telescope_HA_Speed=-0.0046
-Telescope_Dec_Speed=0.0000
-Telescope_HA_Refr(arcsec)=-15.25
-Telescope_Dec_Refr(arcsec)=-65.88
-Telescope_Motion_Status=STOPPED
-Telescope_Airmass=1.747
-Telescope_Ref_UT=11.840406
-Object_Name="Simulated"
-Object_Equinox=J2000.0
-Object_RA=03:46:01.55
-Object_Dec=-20:30:27.9
-Object_RA_Rate=0.00
-Object_Dec_Rate=0.00
-Object_RA_Proper_Motion=0.000000
-Object_Dec_Proper_Motion=0.00000
-Focus_Position=15.81
-Dome_Gap(inch)=-240
-Dome_Azimuth=233.3
-Windscreen_Elevation=0
-UTSunset=02:31
-UTSunrise=13:00
-Solar_RA=10:44
-Solar_Dec=+07:58
-"""
+                data = data.decode("utf8").strip()
+                logger.info("Received: %s", data)
+                if not data:
+                    continue
 
-                elif 'weather' in data.lower():
-                    ret = """?WEATHER:
-UTC=2019:245:12:13:02.1
-Windspeed_Avg_Threshold=25.0
-Gust_Speed_Threshold=35.0
-Gust_Hold_Time=900
-Outside_DewPt_Threshold=2.0
-Inside_DewPt_Threshold=2.0
-Wetness_Threshold=500
-Wind_Dir_Current=63
-Windspeed_Current=3.7
-Windspeed_Average=5.7
-Outside_Air_Temp=20.5
-Outside_Rel_Hum=65.7
-Outside_DewPt=13.9
-Inside_Air_Temp=21.3
-Inside_Rel_Hum=55.9
-Inside_DewPt=12.1
-Mirror_Temp=21.2
-Floor_Temp=21.7
-Bot_Tube_Temp=21.0
-Mid_Tube_Temp=21.3
-Top_Tube_Temp=21.4
-Top_Air_Temp=21.3
-Primary_Cell_Temp=21.2
-Secondary_Cell_Temp=21.2
-Wetness=-271
-Weather_Status=READY"""
+                parts = data.split()
+                cmd = parts[0].upper()
+                args = parts[1:]
+                # Quoted names can have spaces
+                if '"' in data:
+                    quoted = data[data.index('"'):data.rindex('"') + 1]
+                    args = data.replace(quoted, '').split()[1:] + [quoted]
 
+                if cmd.startswith('SIM'):
+                    ret, wait = self.sim_command(cmd, args), 0.
                 else:
-                    ret = "0"
-
-                print(ret)
+                    ret, wait = self.model.execute(cmd, args)
+                if wait > 0:
+                    time.sleep(wait)
+                logger.info("Replying to %s after %.2fs: %s", cmd, wait,
+                            ret[:40])
                 connection.sendall(ret.encode('utf-8'))
+            except (ConnectionError, OSError):
+                break
             except Exception as e:
                 print(str(e))
                 logger.error("Big ERROR", exc_info=True)
-                pass
+                connection.sendall(b"-1")
+        connection.close()
 
     def start(self):
-        logger.debug("IFU server now listening for connections on port:%s" % self.port)
+        logger.debug("TCS simulator now listening for connections on "
+                     "port:%s" % self.port)
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self.socket.settimeout(None)
@@ -179,18 +724,24 @@ Weather_Status=READY"""
         while True:
             conn, address = self.socket.accept()
             logger.debug("Got connection from %s:%s" % (conn, address))
-            new_thread = threading.Thread(target=self.handle, args=(conn, address))
+            new_thread = threading.Thread(target=self.handle,
+                                          args=(conn, address), daemon=True)
             new_thread.start()
-            logger.debug("Started process")
+
 
 if __name__ == "__main__":
-    server = SimServer("localhost", 9002)
-    # try:
-    logger.info("Starting Lamp Sim Server")
+    parser = argparse.ArgumentParser(description="Simulated GXN interface")
+    parser.add_argument('--address', default='localhost')
+    parser.add_argument('--port', type=int, default=9002)
+    parser.add_argument('--time-scale', type=float, default=1.0,
+                        help="multiply every move time by this")
+    parser.add_argument('--fault-rate', type=float, default=0.0,
+                        help="chance of a slow command returning -3")
+    parser.add_argument('--seed', type=int, default=None)
+    args = parser.parse_args()
+
+    server = SimServer(args.address, args.port, time_scale=args.time_scale,
+                       fault_rate=args.fault_rate, seed=args.seed)
+    logger.info("Starting TCS Sim Server")
     server.start()
-    # except Exception as e:
-    #    print(str(e))
-    #    logging.exception("Unexpected exception %s", str(e))
-    # finally:
-    #    logging.info("Shutting down IFU server")
     logger.info("All done")
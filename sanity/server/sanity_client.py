@@ -1,6 +1,9 @@
-import socket
 import time
-import json
+from utils.message_client import get_pool
+
+# Commands that are safe to send again when the connection drops before
+# the reply arrives
+IDEMPOTENT = ['CHECKFORFILES']
 
 
 class Sanity:
@@ -16,8 +19,9 @@ class Sanity:
         self.address = address
         self.port = port
         print(self.address, self.port)
-        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.socket.connect((self.address, self.port))
+        # Shared with every other client of the same server
+        self.connection = get_pool(self.address, self.port,
+                                   idempotent=IDEMPOTENT)
 
     def __send_command(self, cmd="", parameters=None, timeout=600,
                        return_before_done=False):
@@ -28,35 +32,9 @@ class Sanity:
         :param timeout: timeout in seconds for waiting for a command
         :return: Tuple (bool,string)
         """
-        start = time.time()
-        try:
-            if timeout:
-                self.socket.settimeout(timeout)
-
-            if parameters:
-                send_str = json.dumps({'command': cmd,
-                                       'parameters': parameters})
-            else:
-                send_str = json.dumps({'command': cmd})
-
-            self.socket.send(b"%s" % send_str.encode('utf-8'))
-
-            if return_before_done:
-
-                return {"elaptime": time.time()-start,
-                        "data": "exiting the loop early"}
-
-            data = self.socket.recv(2048)
-            counter = 0
-            while not data:
-                time.sleep(.1)
-                data = self.socket.recv(2048)
-                counter += 1
-                if counter > 100:
-                    break
-            return json.loads(data.decode('utf-8'))
-        except Exception as e:
-            return {'elaptime': time.time() - start, 'error': str(e)}
+        return self.connection.send_command(
+            cmd=cmd, parameters=parameters, timeout=timeout,
+            return_before_done=return_before_done, start=time.time())
 
     def check_for_files(self, camera, keywords, data_dir="",
                         return_before_done=False):
@@ -77,16 +55,29 @@ class Sanity:
         """
         return self.__send_command(cmd="PING")
 
-    def listen(self):
-        data = self.socket.recv(2048)
-        counter = 0
-        while not data:
-            time.sleep(.1)
-            data = self.socket.recv(2048)
-            counter += 1
-            if counter > 100:
-                break
-        return json.loads(data.decode('utf-8'))
+    def get_metrics(self, command=None, reset=False):
+        """
+        Latency histograms, counts and error counts the server keeps for
+        each command
+        :param command: only return this command
+        :param reset: have the server start counting again
+        :return: dictionary
+        """
+        parameters = {
+            'command': command,
+            'reset': reset
+        }
+        return self.__send_command(cmd="METRICS", parameters=parameters)
+
+    def listen(self, request_id=None, timeout=None):
+        """
+        Wait for the reply of a command sent with return_before_done
+        :param request_id: 'id' of the early return, defaults to the oldest
+                           command still waiting
+        :param timeout: seconds to wait, None waits until the reply arrives
+        :return: dictionary
+        """
+        return self.connection.listen(request_id=request_id, timeout=timeout)
 
 
 if __name__ == '__main__':
@@ -1,5 +1,6 @@
 import socket
-from observatory.telescope import tcs
+from observatory.server import ocs_client
+from utils.framing import FrameReader, send_frame
 import paramiko
 import time
 import json
@@ -13,8 +14,12 @@ SR = os.path.abspath(os.path.dirname(__file__) + '/../../')
 with open(os.path.join(SR, 'config', 'sedm_config.yaml')) as data_file:
     params = yaml.load(data_file, Loader=yaml.FullLoader)
 
-telescope = tcs.Telescope(gxnaddress=(params['observatory']['tcs']['watcher']['ip'],
-                                      params['observatory']['tcs']['watcher']['port']))
+# Read the telescope values the ocs server already polls instead of
+# polling the TCS on a second connection
+ocs = ocs_client.Observatory(params['servers']['observatory']['ip'],
+                             params['servers']['observatory']['port'])
+ocs.subscribe(['pos', 'status', 'weather', 'faults'])
+max_age = params['observatory']['telemetry']['max_age']
 
 
 def sftp_connection(remote_computer='', user='', pwd='',
@@ -109,9 +114,8 @@ def get_camera_info(conn, cam_string='ifu'):
     send_dict = json.dumps({'command': 'STATUS'})
 
 
-    conn.send(b"%s" % send_dict.encode('utf-8'))
-    time.sleep(.05)
-    ret = conn.recv(1024)
+    send_frame(conn, send_dict)
+    ret = FrameReader(conn).read_frame()
 
     try:
         cam_dict = json.loads(ret.decode('utf-8'))
@@ -142,10 +146,10 @@ while True:
     # 1. Start by getting information
     status_dict = {}
     try:
-        pos = telescope.get_pos()
-        status = telescope.get_status()
-        weather = telescope.get_weather()
-        faults = telescope.get_faults()
+        pos = ocs.get_telemetry('pos', max_age['pos'])
+        status = ocs.get_telemetry('status', max_age['status'])
+        weather = ocs.get_telemetry('weather', max_age['weather'])
+        faults = ocs.get_telemetry('faults', max_age['faults'])
 
         print(faults)
         print(type(pos))
@@ -226,4 +230,4 @@ while True:
         pass
         time.sleep(5)
 
-telescope.close_connection()
\ No newline at end of file
+ocs.connection.close()
\ No newline at end of file
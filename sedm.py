@@ -89,6 +89,8 @@ class SEDm:
         self.sanity = None
         self.lamp_dict_status = {'cd': 'off', 'hg': 'off', 'xe': 'off'}
         self.stage_dict = {'ifufocus': -999, 'ifufoc2': -999}
+        self.telemetry_max_age = params['observatory'].get(
+            'telemetry', {}).get('max_age', {})
         self.get_tcs_info = True
         self.get_lamp_info = True
         self.get_stage_info = True
@@ -164,6 +166,9 @@ class SEDm:
                     self.ocs.initialize_stages()
                 if self.run_telescope:
                     self.ocs.initialize_tcs()
+            # The header values are then read from the snapshots the ocs
+            # server polls instead of querying the hardware for each image
+            print(self.ocs.subscribe(['pos', 'status', 'weather']))
         if self.run_sanity:
             logger.info("Initializing sanity server")
             self.sanity = sanity_client.Sanity()
@@ -171,41 +176,74 @@ class SEDm:
         return {'elaptime': time.time() - start, 'data': "System initialized"}
 
     def get_status_dict(self, do_lamps=True, do_stages=True):
-        stat_dict = {}
-
-        ret = self.ocs.check_pos()
-        if 'data' in ret:
+        """
+        Collect the telescope, weather, lamp and stage information for the
+        image header.  All the queries go to the ocs server as one batch so
+        the devices are read at the same time.  Telescope values published
+        by the ocs server less than telemetry max_age seconds ago are used
+        without asking the server.
+
+        :param do_lamps: query the arc lamps, otherwise the last known
+                         states are used
+        :param do_stages: query the stage positions, otherwise the last
+                          known positions are used
+        :return: dictionary
+        """
+        cached = {}
+        commands = []
+        for topic in ['pos', 'weather', 'status']:
+            snapshot = self.ocs.latest(topic,
+                                       self.telemetry_max_age.get(topic, 0))
+            if not snapshot:
+                # One request reads all the tcs info at once
+                cached = {}
+                commands.append({'command': 'OBSSNAPSHOT'})
+                break
+            cached.update(snapshot)
+        if do_lamps:
+            for lamp in ['xe', 'cd', 'hg']:
+                commands.append({'command': 'ARCLAMPSTATUS',
+                                 'key': '%s_lamp' % lamp,
+                                 'parameters': {'lamp': lamp,
+                                                'force_check': True}})
+        if do_stages:
+            for key, stage_id in [('ifufocus', 1), ('ifufoc2', 2)]:
+                commands.append({'command': 'STAGEPOSITION', 'key': key,
+                                 'parameters': {'stage_id': stage_id}})
 
-            stat_dict.update(ret['data'])
+        if commands:
+            ret = self.ocs.batch(commands)
+        else:
+            ret = {'data': {}}
+        if 'data' not in ret:
+            logger.error("Status batch failed: %s", ret)
+            stat_dict = {}
+            errors = {'obssnapshot': ret.get('error')}
         else:
+            stat_dict = ret['data']
+            errors = stat_dict.pop('batch_errors', {})
+            errors.update(stat_dict.pop('snapshot_errors', {}))
+        stat_dict = dict(cached, **stat_dict)
+
+        if errors:
+            print(errors)
+        if 'obssnapshot' in errors:
             ret = self.ocs.check_pos()
             if 'data' in ret:
                 stat_dict.update(ret['data'])
-        try:
-            stat_dict.update(self.ocs.check_weather()['data'])
-            stat_dict.update(self.ocs.check_status()['data'])
-        except Exception as e:
-            print(str(e))
-            pass
-        if do_lamps:
-            stat_dict['xe_lamp'] = self.ocs.arclamp('xe', 'status', force_check=True)['data']
-            self.lamp_dict_status['xe'] = stat_dict['xe_lamp']
-            stat_dict['cd_lamp'] = self.ocs.arclamp('cd', 'status', force_check=True)['data']
-            self.lamp_dict_status['cd'] = stat_dict['cd_lamp']
-            stat_dict['hg_lamp'] = self.ocs.arclamp('hg', 'status', force_check=True)['data']
-            self.lamp_dict_status['hg'] = stat_dict['hg_lamp']
-        else:
-            stat_dict['xe_lamp'] = self.lamp_dict_status['xe']
-            stat_dict['cd_lamp'] = self.lamp_dict_status['cd']
-            stat_dict['hg_lamp'] = self.lamp_dict_status['hg']
-        if do_stages:
-            stat_dict['ifufocus'] = self.ocs.stage_position(1)['data']
-            self.stage_dict['ifufocus'] = stat_dict['ifufocus']
-            stat_dict['ifufoc2'] = self.ocs.stage_position(2)['data']
-            self.stage_dict['ifufoc2'] = stat_dict['ifufoc2']
-        else:
-            stat_dict['ifufocus'] = self.stage_dict['ifufocus']
-            stat_dict['ifufoc2'] = self.stage_dict['ifufoc2']
+
+        for lamp in ['xe', 'cd', 'hg']:
+            key = '%s_lamp' % lamp
+            if do_lamps and key in stat_dict:
+                self.lamp_dict_status[lamp] = stat_dict[key]
+            else:
+                stat_dict[key] = self.lamp_dict_status[lamp]
+
+        for key in ['ifufocus', 'ifufoc2']:
+            if do_stages and key in stat_dict:
+                self.stage_dict[key] = stat_dict[key]
+            else:
+                stat_dict[key] = self.stage_dict[key]
         return stat_dict
 
     def take_image(self, cam, exptime=0, shutter='normal', readout=2.0,
@@ -281,8 +319,10 @@ class SEDm:
         obsdict.update(self.get_status_dict(do_stages=do_stages, do_lamps=do_lamps))
         if not object_ra or not object_dec:
             print("Using TCS RA and DEC")
-            object_ra = obsdict['telescope_ra']
-            object_dec = obsdict['telescope_dec']
+            object_ra = obsdict.get('telescope_ra_deg',
+                                    obsdict['telescope_ra'])
+            object_dec = obsdict.get('telescope_dec_deg',
+                                     obsdict['telescope_dec'])
 
         obsdict.update(self.header.set_project_keywords(test=test,
                                                         imgtype=imgtype,
@@ -344,9 +384,9 @@ class SEDm:
             fdate += datetime.timedelta(seconds=1)
             diff = (fdate - start_time).seconds
 
-            # Re-establish the camera connection just to make sure the
-            # issue isn't with them
-            print(self.initialize())
+            # The client pool replaces a dropped camera connection, check
+            # the camera server answers instead of initializing everything
+            print(cam.check_socket())
 
             if diff < 10:
                 print("Add the header")
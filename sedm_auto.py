@@ -172,7 +172,12 @@ def run_observing_loop(  # do_focus=True, do_standard=True,
             os.remove("manual.json")
 
         try:
-            ret = robot.sky.get_next_observable_target(return_type='json')
+            # Takes the next target planned during the last exposure, the
+            # server does a full search when the plan is empty
+            pos = robot.ocs.check_pos()
+            if 'data' in pos:
+                robot.sky.set_telescope_position(pos=pos['data'])
+            ret = robot.sky.get_planned_target(completed=done_list)
             print(ret)
         except Exception as ex:
             print(str(ex), "ERROR getting target")
@@ -202,6 +207,11 @@ def run_observing_loop(  # do_focus=True, do_standard=True,
                 print(ret)
                 time.sleep(600)
                 continue
+            # Plan the next targets while this one is being observed
+            print(robot.sky.start_planning(obsdatetime=end_time.isoformat(),
+                                           exclude=done_list +
+                                           [obsdict['req_id']],
+                                           after_req_id=obsdict['req_id']))
             ret = robot.observe_by_dict(obsdict)
             done_list.append(obsdict['req_id'])
             
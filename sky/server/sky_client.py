@@ -1,76 +1,25 @@
-import socket
 import time
 import json
+from utils.message_client import get_pool, client_command
+from utils.async_client import AsyncClient, async_command
 
+# Commands that are safe to send again when the connection drops before
+# the reply arrives
+IDEMPOTENT = ['GETTARGET', 'GETPLAN', 'GETSTANDARD', 'GETFOCUSCOORDS',
+              'GETTWILIGHTCOORDS', 'GETTWILIGHTEXPTIME', 'GETOFFSETS',
+              'GETRCFOCUS', 'GETBESTFOCUS', 'SETTELPOS']
 
-class Sky:
 
-    def __init__(self, address='localhost', port=5004, timeout=300):
-        """
+class SkyRequests:
+    """
+    Command and parameters of each sky server request.  Sky and AsyncSky
+    both send what these return, so the blocking and asyncio clients can't
+    drift apart.
+    """
 
-        :param camera:
-        :param address:
-        :param port:
-        """
-
-        self.address = address
-        self.port = port
-        self.default_timeout = timeout
-        self.timeout = timeout
-        print(self.address, self.port)
-        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.socket.connect((self.address, self.port))
-
-    def __send_command(self, cmd="", parameters=None, timeout=180,
-                       return_before_done=False):
-        """
-
-        :param cmd: string command to send to the camera socket
-        :param parameters: list of parameters associated with cmd
-        :param timeout: timeout in seconds for waiting for a command
-        :return: Tuple (bool,string)
-        """
-        start = time.time()
-        try:
-            if timeout:
-
-                self.socket.settimeout(self.timeout)
-                self.timeout = self.default_timeout
-
-            if parameters:
-                send_str = json.dumps({'command': cmd,
-                                       'parameters': parameters})
-            else:
-                send_str = json.dumps({'command': cmd})
-
-            self.socket.send(b"%s" % send_str.encode('utf-8'))
-
-            if return_before_done:
-
-                return {"elaptime": time.time()-start,
-                        "command": cmd,
-                        "data": "exiting the loop early"}
-
-            data = self.socket.recv(2048)
-            counter = 0
-            while not data:
-                time.sleep(.1)
-                data = self.socket.recv(2048)
-                counter += 1
-                if counter > 100:
-                    break
-
-            ret_dict = json.loads(data.decode('utf-8'))
-            if isinstance(ret_dict, dict):
-                if 'command' not in ret_dict:
-                    ret_dict['command'] = cmd
-                return ret_dict
-        except Exception as e:
-            return {'elaptime': time.time() - start, 'error': str(e)}
-
-    def solve_offset_new(self, raw_image, overwrite=True,
+    @staticmethod
+    def solve_offset_new(raw_image, overwrite=True,
                          parse_directory_from_file=False,
-                         return_before_done=False,
                          base_dir='/data2/sedm/'):
         parameters = {
             'raw_image': raw_image, 'overwrite': overwrite,
@@ -78,31 +27,17 @@ class Sky:
             'base_dir': base_dir
 
         }
+        return "GETOFFSETS", parameters
 
-        return self.__send_command(cmd="GETOFFSETS",
-                                   return_before_done=return_before_done,
-                                   parameters=parameters)
-
-    def check_socket(self):
-        """
-        Try sending a command to the camera program
-        :return:(bool,response)
-        """
-        return self.__send_command(cmd="PING")
-
-    def reinit(self):
-        """
-        Try sending a command to the camera program
-        :return:(bool,response)
-        """
-        return self.__send_command(cmd='REINT')
+    @staticmethod
+    def reinit():
+        return "REINT", None
 
-    def start_guider(self, start_time=None, end_time=None, exptime=30,
+    @staticmethod
+    def start_guider(start_time=None, end_time=None, exptime=30,
                      image_prefix="rc", max_move=None, min_move=None,
-                     data_dir=None, debug=False, wait_time=5,
-                     return_before_done=True):
+                     data_dir=None, debug=False, wait_time=5):
         """
-        :param return_before_done:
         :param start_time:
         :param end_time:
         :param exptime:
@@ -118,30 +53,24 @@ class Sky:
                           exptime=exptime, image_prefix=image_prefix,
                           max_move=max_move, min_move=min_move,
                           data_dir=data_dir, debug=debug, wait_time=wait_time)
+        return "STARTGUIDER", parameters
 
-        return self.__send_command(cmd="STARTGUIDER",
-                                   parameters=parameters,
-                                   return_before_done=return_before_done)
-
-    def get_standard(self, name="zenith", obsdate=""):
+    @staticmethod
+    def get_standard(name="zenith", obsdate=""):
         """
 
         :param name:
-        :param ra:
-        :param dec:
         :param obsdate:
         :return:
         """
-
         parameters = {
             "name": name,
             "obsdate": obsdate
         }
+        return "GETSTANDARD", parameters
 
-        return self.__send_command(cmd="GETSTANDARD",
-                                   parameters=parameters)
-
-    def get_next_observable_target(self, target_list=None, obsdatetime=None,
+    @staticmethod
+    def get_next_observable_target(target_list=None, obsdatetime=None,
                                    airmass=(1, 2.5), moon_sep=(30, 180),
                                    altitude_min=15, ha=(18.75, 5.75),
                                    return_type='json',
@@ -149,7 +78,8 @@ class Sky:
                                    sort_columns=('priority', 'start_alt'),
                                    sort_order=(False, False), save=True,
                                    save_as='',
-                                   check_end_of_night=True, update_coords=True):
+                                   check_end_of_night=True,
+                                   update_coords=True):
         parameters = {
             'target_list': target_list,
             'obsdatetime': obsdatetime,
@@ -166,31 +96,118 @@ class Sky:
             'check_end_of_night': check_end_of_night,
             'update_coords': update_coords
         }
+        return "GETTARGET", parameters
+
+    @staticmethod
+    def start_planning(n=5, obsdatetime=None, exclude=None,
+                       after_req_id=None, airmass=(1, 2.5), moon_sep=(30, 180),
+                       altitude_min=15, ha=(18.75, 5.75),
+                       sort_columns=('priority', 'start_alt'),
+                       sort_order=(False, False)):
+        """
+        Start planning the next n observations on the server.  Returns as
+        soon as the planning has started.
+
+        :param n: number of observations to plan
+        :param obsdatetime: iso string of the predicted start of the first
+                            observation, normally the end of the current one
+        :param exclude: list of request ids to leave out of the plan
+        :param after_req_id: request id of the current observation, the
+                             plan starts from its position
+        :return: dictionary
+        """
+        parameters = {
+            'n': n,
+            'obsdatetime': obsdatetime,
+            'exclude': exclude,
+            'after_req_id': after_req_id,
+            'airmass': airmass,
+            'moon_sep': moon_sep,
+            'altitude_min': altitude_min,
+            'ha': ha,
+            'sort_columns': sort_columns,
+            'sort_order': sort_order
+        }
+        return "STARTPLAN", parameters
 
-        return self.__send_command(cmd="GETTARGET",
-                                   parameters=parameters)
+    @staticmethod
+    def get_plan(wait=0):
+        """
+        Get the latest plan of observations
 
-    def get_best_focus(self, files, ifu=False):
+        :param wait: seconds to wait for a running plan to finish
+        :return: dictionary
+        """
         parameters = {
-            'files': files,
-            'ifu': ifu
+            'wait': wait
         }
-        ret, focus = self.__send_command(cmd="GETBESTFOCUS",
-                                         parameters=parameters)
+        return "GETPLAN", parameters
 
-        try:
-            x = json.loads(focus)
-        except Exception as e:
-            print(str(e))
-            print("Error above")
-            x = ''
-        return ret, x
+    @staticmethod
+    def get_planned_target(obsdatetime=None, completed=None, wait=30,
+                           return_type='json', save=True, save_as='',
+                           airmass=(1, 2.5), moon_sep=(30, 180),
+                           altitude_min=15, ha=(18.75, 5.75)):
+        """
+        Get the next target from the plan, revalidated at obsdatetime.  The
+        server falls back to a full target search when the plan is empty.
+
+        :param obsdatetime: iso string of the start time, defaults to now
+        :param completed: list of request ids that were already observed
+        :param wait: seconds to wait for a running plan to finish
+        :return: same as get_next_observable_target
+        """
+        parameters = {
+            'obsdatetime': obsdatetime,
+            'completed': completed,
+            'wait': wait,
+            'return_type': return_type,
+            'save': save,
+            'save_as': save_as,
+            'airmass': airmass,
+            'moon_sep': moon_sep,
+            'altitude_min': altitude_min,
+            'ha': ha
+        }
+        return "GETPLANNEDTARGET", parameters
+
+    @staticmethod
+    def set_telescope_position(pos=None, ha=None, dec=None, domeaz=None):
+        """
+        Tell the scheduler where the telescope and dome are
+
+        :param pos: position dictionary returned by the ocs OBSPOS command
+        :param ha: hour angle in hours
+        :param dec: declination in degrees
+        :param domeaz: dome azimuth in degrees
+        :return: dictionary
+        """
+        parameters = {
+            'pos': pos,
+            'ha': ha,
+            'dec': dec,
+            'domeaz': domeaz
+        }
+        return "SETTELPOS", parameters
 
-    def get_focus(self, obs_list, header_field='FOCPOS',
-                  overwrite=False,
-                  catalog_field='FWHM_IMAGE',
-                  filter_catalog=True):
+    @staticmethod
+    def fit_slew_model(history_file=None, min_moves=5):
+        """
+        Refit the scheduler slew model from the TCS position history
 
+        :param history_file: csv file with the position history
+        :param min_moves: minimum number of moves needed to fit an axis
+        :return: dictionary
+        """
+        parameters = {
+            'history_file': history_file,
+            'min_moves': min_moves
+        }
+        return "FITSLEWMODEL", parameters
+
+    @staticmethod
+    def get_focus(obs_list, header_field='FOCPOS', overwrite=False,
+                  catalog_field='FWHM_IMAGE', filter_catalog=True):
         parameters = {
             'obs_list': obs_list,
             'header_field': header_field,
@@ -198,30 +215,28 @@ class Sky:
             'catalog_field': catalog_field,
             'filter_catalog': filter_catalog
         }
-        return self.__send_command(cmd="GETRCFOCUS",
-                                   parameters=parameters)
+        return "GETRCFOCUS", parameters
 
-    def get_standard_request_id(self, name="", exptime=90):
+    @staticmethod
+    def get_standard_request_id(name="", exptime=90):
         parameters = {
             'name': name,
             'exptime': exptime
         }
-        return self.__send_command(cmd="GETSTANDARDREQUESTID",
-                                       parameters=parameters)
+        return "GETSTANDARDREQUESTID", parameters
 
-    def get_calib_request_id(self, camera='ifu', N=1, object_id="",
-                             exptime=0):
+    @staticmethod
+    def get_calib_request_id(camera='ifu', N=1, object_id="", exptime=0):
         parameters = {
             'camera': camera,
             'N': N,
             'object_id': object_id,
             'exptime': exptime
         }
-        return self.__send_command(cmd="GETCALIBREQUESTID",
-                                   parameters=parameters)
+        return "GETCALIBREQUESTID", parameters
 
-    def update_growth(self, growth_id=None, request_id=None,
-                      message="PENDING"):
+    @staticmethod
+    def update_growth(growth_id=None, request_id=None, message="PENDING"):
         """
 
         :param growth_id:
@@ -234,43 +249,148 @@ class Sky:
             'request_id': request_id,
             'message': message
         }
+        return "UPDATEGROWTH", parameters
 
-        return self.__send_command(cmd="UPDATEGROWTH",
-                                   parameters=parameters)
-
-    def update_target_request(self, request_id, status="COMPLETED"):
-
+    @staticmethod
+    def update_target_request(request_id, status="COMPLETED"):
         parameters = {
             'request_id': request_id,
             'status': status
         }
-        return self.__send_command(cmd="UPDATEREQUEST",
-                                   parameters=parameters)
+        return "UPDATEREQUEST", parameters
 
-    def get_focus_coords(self, obsdatetime="", dec=33.33):
+    @staticmethod
+    def get_focus_coords(obsdatetime="", dec=33.33):
         parameters = {
             'obsdatetime': obsdatetime,
             'dec': dec
         }
+        return "GETFOCUSCOORDS", parameters
 
-        return self.__send_command(cmd="GETFOCUSCOORDS",
-                                   parameters=parameters)
-
-    def get_twilight_coords(self, obsdatetime="", dec=33.33):
+    @staticmethod
+    def get_twilight_coords(obsdatetime="", dec=33.33):
         parameters = {
             'obsdatetime': obsdatetime,
             'dec': dec
         }
-        return self.__send_command(cmd="GETTWILIGHTCOORDS",
-                                   parameters=parameters)
+        return "GETTWILIGHTCOORDS", parameters
 
-    def get_twilight_exptime(self, obsdatetime=""):
+    @staticmethod
+    def get_twilight_exptime(obsdatetime=""):
         parameters = {
             'obsdatetime': obsdatetime
         }
+        return "GETTWILIGHTEXPTIME", parameters
+
+
+class Sky:
+
+    def __init__(self, address='localhost', port=5004, timeout=300):
+        """
 
-        return self.__send_command(cmd="GETTWILIGHTEXPTIME",
-                                   parameters=parameters)
+        :param camera:
+        :param address:
+        :param port:
+        """
+
+        self.address = address
+        self.port = port
+        self.default_timeout = timeout
+        self.timeout = timeout
+        print(self.address, self.port)
+        # Shared with every other client of the same server
+        self.connection = get_pool(self.address, self.port,
+                                   idempotent=IDEMPOTENT)
+
+    def __send_command(self, cmd="", parameters=None, timeout=180,
+                       return_before_done=False):
+        """
+
+        :param cmd: string command to send to the camera socket
+        :param parameters: list of parameters associated with cmd
+        :param timeout: timeout in seconds for waiting for a command
+        :return: Tuple (bool,string)
+        """
+        start = time.time()
+        if timeout:
+            timeout = self.timeout
+            self.timeout = self.default_timeout
+
+        ret_dict = self.connection.send_command(
+            cmd=cmd, parameters=parameters, timeout=timeout,
+            return_before_done=return_before_done, start=start)
+        if isinstance(ret_dict, dict) and 'command' not in ret_dict:
+            ret_dict['command'] = cmd
+        return ret_dict
+
+    def send_request(self, cmd, parameters=None, **options):
+        """
+        Send a command made by SkyRequests, see client_command
+        """
+        return self.__send_command(cmd=cmd, parameters=parameters, **options)
+
+    solve_offset_new = client_command(SkyRequests.solve_offset_new,
+                                      return_before_done=False)
+
+    def check_socket(self):
+        """
+        Try sending a command to the camera program
+        :return:(bool,response)
+        """
+        return self.__send_command(cmd="PING")
+
+    def get_metrics(self, command=None, reset=False):
+        """
+        Latency histograms, counts and error counts the server keeps for
+        each command
+        :param command: only return this command
+        :param reset: have the server start counting again
+        :return: dictionary
+        """
+        parameters = {
+            'command': command,
+            'reset': reset
+        }
+        return self.__send_command(cmd="METRICS", parameters=parameters)
+
+    reinit = client_command(SkyRequests.reinit)
+    start_guider = client_command(SkyRequests.start_guider,
+                                  return_before_done=True)
+    get_standard = client_command(SkyRequests.get_standard)
+    get_next_observable_target = client_command(
+        SkyRequests.get_next_observable_target)
+    start_planning = client_command(SkyRequests.start_planning)
+    get_plan = client_command(SkyRequests.get_plan)
+    get_planned_target = client_command(SkyRequests.get_planned_target)
+    set_telescope_position = client_command(
+        SkyRequests.set_telescope_position)
+    fit_slew_model = client_command(SkyRequests.fit_slew_model)
+
+    def get_best_focus(self, files, ifu=False):
+        parameters = {
+            'files': files,
+            'ifu': ifu
+        }
+        ret, focus = self.__send_command(cmd="GETBESTFOCUS",
+                                         parameters=parameters)
+
+        try:
+            x = json.loads(focus)
+        except Exception as e:
+            print(str(e))
+            print("Error above")
+            x = ''
+        return ret, x
+
+    get_focus = client_command(SkyRequests.get_focus)
+    get_standard_request_id = client_command(
+        SkyRequests.get_standard_request_id)
+    get_calib_request_id = client_command(SkyRequests.get_calib_request_id)
+    update_growth = client_command(SkyRequests.update_growth)
+    update_target_request = client_command(SkyRequests.update_target_request)
+    get_focus_coords = client_command(SkyRequests.get_focus_coords)
+    get_twilight_coords = client_command(SkyRequests.get_twilight_coords)
+    get_twilight_exptime = client_command(SkyRequests.get_twilight_exptime)
 
     def wait_for_solution(self, abpair=True):
         parameters = {
@@ -280,16 +400,65 @@ class Sky:
                                            parameters=parameters)
         return ret, offsets
 
-    def listen(self):
-        data = self.socket.recv(2048)
-        counter = 0
-        while not data:
-            time.sleep(.1)
-            data = self.socket.recv(2048)
-            counter += 1
-            if counter > 100:
-                break
-        return json.loads(data.decode('utf-8'))
+    def listen(self, request_id=None, timeout=None):
+        """
+        Wait for the reply of a command sent with return_before_done
+        :param request_id: 'id' of the early return, defaults to the oldest
+                           command still waiting
+        :param timeout: seconds to wait, None waits until the reply arrives
+        :return: dictionary
+        """
+        return self.connection.listen(request_id=request_id, timeout=timeout)
+
+
+class AsyncSky(AsyncClient):
+    """
+    asyncio version of Sky for the commands a sequence waits on.  Start a
+    long command such as STARTGUIDER as a task instead of using
+    return_before_done.
+    """
+
+    IDEMPOTENT = IDEMPOTENT
+
+    def __init__(self, address='localhost', port=5004, timeout=300,
+                 encodings=None):
+        super().__init__(address, port, encodings=encodings)
+        self.default_timeout = timeout
+
+    async def send_command(self, cmd="", parameters=None, timeout=None):
+        """
+        Same as AsyncClient.send_command with the 'command' added to the
+        reply, as Sky returns it
+        """
+        ret_dict = await super().send_command(
+            cmd, parameters,
+            timeout=timeout if timeout else self.default_timeout)
+        if isinstance(ret_dict, dict) and 'command' not in ret_dict:
+            ret_dict['command'] = cmd
+        return ret_dict
+
+    solve_offset_new = async_command(SkyRequests.solve_offset_new,
+                                     timeout=None)
+    reinit = async_command(SkyRequests.reinit)
+    # Runs the guider until end_time, the reply comes when it stops
+    start_guider = async_command(SkyRequests.start_guider, timeout=None)
+    get_standard = async_command(SkyRequests.get_standard)
+    get_next_observable_target = async_command(
+        SkyRequests.get_next_observable_target)
+    start_planning = async_command(SkyRequests.start_planning)
+    get_plan = async_command(SkyRequests.get_plan)
+    get_planned_target = async_command(SkyRequests.get_planned_target)
+    set_telescope_position = async_command(SkyRequests.set_telescope_position)
+    fit_slew_model = async_command(SkyRequests.fit_slew_model)
+    get_focus = async_command(SkyRequests.get_focus)
+    get_standard_request_id = async_command(
+        SkyRequests.get_standard_request_id)
+    get_calib_request_id = async_command(SkyRequests.get_calib_request_id)
+    update_growth = async_command(SkyRequests.update_growth)
+    update_target_request = async_command(SkyRequests.update_target_request)
+    get_focus_coords = async_command(SkyRequests.get_focus_coords)
+    get_twilight_coords = async_command(SkyRequests.get_twilight_coords)
+    get_twilight_exptime = async_command(SkyRequests.get_twilight_exptime)
 
 
 if __name__ == '__main__':
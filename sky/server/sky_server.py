@@ -1,8 +1,5 @@
 import os
-import json
 import time
-import socket
-import threading
 from sky.astrometry import solver
 from sky.targets.scheduler import dbscheduler
 from sky.astrometry.sextractor import run
@@ -12,8 +9,7 @@ from sky.targets.marshals.growth import marshal
 import yaml
 
 from utils.sedmlogging import setup_logger
-from utils.message_server import (message_handler, response_handler,
-                                  error_handler)
+from utils.command_server import CommandServer
 
 # Open the config file
 SR = os.path.abspath(os.path.dirname(__file__) + '/../../')
@@ -25,12 +21,16 @@ name = "skyLogger"
 logfile = os.path.join(params['logging']['logpath'], 'sky_server.log')
 logger = setup_logger(name, log_file=logfile)
 
+# Command latency metrics
+metrics_file = os.path.join(params['logging']['logpath'],
+                            'sky_metrics.jsonl')
+metrics_interval = params['logging'].get('metrics_interval', 900)
+
 
 class SkyServer:
     def __init__(self, hostname, port, do_connect=True):
         self.hostname = hostname
         self.port = port
-        self.socket = ""
         self.cam = None
         self.sex = run.Sextractor()
         self.do_connect = do_connect
@@ -38,80 +38,67 @@ class SkyServer:
         self.marshals = marshal.interface()
         self.guider = rcguider.Guide(do_connect=do_connect)
 
-    def handle(self, connection, address):
-        while True:
-            starttime = time.time()
-            data = message_handler(connection, starttime=starttime)
-            ret = ''
-            logger.info("Data Received: %s", data)
-
-            # Check the data return if it's False then there was an error and
-            # we should exit the loop.  Or if the data is not in dictionary
-            # form then we should exit
-            if isinstance(data, bool) or not isinstance(data, dict):
-                print(data, "Bad return from message_handler")
-                print(connection, address)
-                break
-
-            if 'command' in data:
-                if data['command'].upper() == 'GETOFFSETS':
-                    ret = solver.calculate_offset(**data['parameters'])
-                elif data['command'].upper() == 'REINT':
-                    self.sex = run.Sextractor()
-                    self.scheduler = dbscheduler.Scheduler()
-                    self.marshals = interface
-                    self.guider = rcguider.Guide(do_connect=self.do_connect)
-                    ret = {'elaptime': time.time()-starttime,
-                                'data': 'System reinitialized'}
-                elif data['command'].upper() == 'GETCALIBREQUESTID':
-                    ret = self.scheduler.get_calib_request_id(**data['parameters'])
-                elif data['command'].upper() == "GETSTANDARD":
-                    ret = self.scheduler.get_standard(**data['parameters'])
-                elif data['command'].upper() == "GETFOCUSCOORDS":
-                    ret = self.scheduler.get_focus_coords(**data['parameters'])
-                elif data['command'].upper() == "GETRCFOCUS":
-                    ret = self.sex.run_loop(**data['parameters'])
-                elif data['command'].upper() == 'STARTGUIDER':
-                    ret = self.guider.start_guider(**data['parameters'])
-                    ret = {"elaptime": time.time()-starttime, "data": "guider started"}
-                elif data['command'].upper() == 'GETTARGET':
-                    ret = self.scheduler.get_next_observable_target(**data['parameters'])
-                elif data['command'].upper() == 'PING':
-                    ret = {'elaptime': time.time()-starttime,
-                            'data': 'PONG'}
-                elif data['command'].upper() == "UPDATEGROWTH":
-                    ret = self.marshals.update_status_request(**data['parameters'])
-                elif data['command'].upper() == "UPDATEREQUEST":
-                    ret = self.scheduler.update_request(**data['parameters'])
-                elif data['command'].upper() == "GETGROWTHID":
-                    ret = self.marshals.get_marshal_id_from_pharos(**data['parameters'])
-                elif data['command'].upper() == 'GETTWILIGHTEXPTIME':
-                    ret = self.scheduler.get_twilight_exptime(**data['parameters'])
-
-            else:
-                ret = {'elaptime': time.time()-starttime,
-                       'error': "Command not found"}
-
-            response = response_handler(ret, inputdata=data,
-                                        starttime=starttime)
-            logger.info("Response: %s", response)
-            jsonstr = json.dumps(response)
-            connection.sendall(jsonstr.encode('utf-8'))
+        self.server = CommandServer(hostname, port, logger=logger,
+                                    pools={'scheduler': 2, 'astrometry': 2,
+                                           'marshals': 2},
+                                    metrics_file=metrics_file,
+                                    metrics_interval=metrics_interval)
+        self.register_commands()
+
+    def register_commands(self):
+        register = self.server.register
+
+        register('GETOFFSETS', solver.calculate_offset, pool='astrometry')
+        register('GETRCFOCUS', lambda **p: self.sex.run_loop(**p),
+                 pool='astrometry')
+        register('REINT', self.reinitialize)
+        register('STARTGUIDER', self.start_guider)
+
+        for name, method in [('GETCALIBREQUESTID', 'get_calib_request_id'),
+                             ('GETSTANDARD', 'get_standard'),
+                             ('GETFOCUSCOORDS', 'get_focus_coords'),
+                             ('GETTARGET', 'get_next_observable_target'),
+                             ('STARTPLAN', 'start_planning'),
+                             ('GETPLAN', 'get_plan'),
+                             ('GETPLANNEDTARGET', 'get_planned_target'),
+                             ('SETTELPOS', 'set_telescope_position'),
+                             ('FITSLEWMODEL', 'fit_slew_model'),
+                             ('UPDATEREQUEST', 'update_request'),
+                             ('GETTWILIGHTEXPTIME', 'get_twilight_exptime')]:
+            register(name, self._scheduler_command(method), pool='scheduler')
+
+        register('UPDATEGROWTH',
+                 lambda **p: self.marshals.update_status_request(**p),
+                 pool='marshals')
+        register('GETGROWTHID',
+                 lambda **p: self.marshals.get_marshal_id_from_pharos(**p),
+                 pool='marshals')
+
+    def _scheduler_command(self, method):
+        """
+        Command calling a Scheduler method, looked up at call time as REINT
+        replaces the scheduler
+        """
+        return lambda **parameters: getattr(self.scheduler,
+                                            method)(**parameters)
+
+    def reinitialize(self):
+        starttime = time.time()
+        self.sex = run.Sextractor()
+        self.scheduler = dbscheduler.Scheduler()
+        self.marshals = interface
+        self.guider = rcguider.Guide(do_connect=self.do_connect)
+        return {'elaptime': time.time()-starttime,
+                'data': 'System reinitialized'}
+
+    def start_guider(self, **parameters):
+        starttime = time.time()
+        self.guider.start_guider(**parameters)
+        return {"elaptime": time.time()-starttime, "data": "guider started"}
 
     def start(self):
         logger.debug("Sky server now listening for connections on port:%s" % self.port)
-        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        self.socket.settimeout(None)
-        self.socket.bind((self.hostname, self.port))
-        self.socket.listen(5)
-
-        while True:
-            conn, address = self.socket.accept()
-            logger.debug("Got connection from %s:%s" % (conn, address))
-            new_thread = threading.Thread(target=self.handle, args=(conn, address))
-            new_thread.start()
-            logger.debug("Started process")
+        self.server.start()
 
 
 if __name__ == "__main__":
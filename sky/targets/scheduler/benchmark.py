@@ -0,0 +1,319 @@
+"""
+Benchmarks for the scheduler stages against synthetic request tables.
+
+The pharos tables used by Scheduler.query are recreated in a SQLite file
+attached as the "public" schema, filled with N random targets and every
+stage is run with its wall time and peak python/numpy memory recorded.
+Results are appended to a json lines file and compared against the last
+run of the same size.
+
+    python -m sky.targets.scheduler.benchmark 100 1000 10000
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import datetime
+import tempfile
+import tracemalloc
+import numpy as np
+import pandas as pd
+import yaml
+from astropy.time import TimeDelta
+from sqlalchemy import create_engine, event
+
+from sky.targets.scheduler import dbscheduler
+
+# Open the config file
+SR = os.path.abspath(os.path.dirname(__file__) + '/../../../')
+with open(os.path.join(SR, 'config', 'sedm_config.yaml')) as data_file:
+    params = yaml.load(data_file, Loader=yaml.FullLoader)
+
+DEFAULT_SIZES = [100, 1000, 10000]
+DEFAULT_RESULTS = os.path.join(params['logging']['logpath'],
+                               'scheduler_benchmark.jsonl')
+
+# Largest target list the astroplan fallback is run for
+MAX_ASTROPLAN = 1000
+
+TABLES = [
+    """CREATE TABLE public.request (id INTEGER PRIMARY KEY, object_id INTEGER,
+       user_id INTEGER, marshal_id INTEGER, exptime TEXT, maxairmass REAL,
+       max_fwhm REAL, min_moon_dist REAL, max_moon_illum REAL,
+       max_cloud_cover REAL, status TEXT, priority REAL, inidate TEXT,
+       enddate TEXT, cadence REAL, phasesamples REAL, sampletolerance REAL,
+       filters TEXT, nexposures TEXT, obs_seq TEXT, seq_repeats INTEGER,
+       seq_completed INTEGER, last_obs_jd REAL, creationdate TEXT,
+       lastmodified TEXT, allocation_id INTEGER, phase REAL)""",
+    """CREATE TABLE public.object (id INTEGER PRIMARY KEY, name TEXT,
+       iauname TEXT, ra REAL, "dec" REAL, typedesig TEXT, epoch TEXT,
+       magnitude REAL, creationdate TEXT)""",
+    """CREATE TABLE public.users (id INTEGER PRIMARY KEY, email TEXT)""",
+    """CREATE TABLE public.allocation (id INTEGER PRIMARY KEY, inidate TEXT,
+       enddate TEXT, time_spent REAL, designator TEXT, time_allocated REAL,
+       program_id INTEGER, active INTEGER)""",
+    """CREATE TABLE public.program (id INTEGER PRIMARY KEY, designator TEXT,
+       name TEXT, group_id INTEGER, pi TEXT, time_allocated REAL,
+       inidate TEXT, enddate TEXT)""",
+    """CREATE TABLE public.periodic (id INTEGER PRIMARY KEY,
+       object_id INTEGER, mjd0 REAL, phasedays REAL, phi REAL)"""]
+
+# Observing sequences and exposure times picked at random for each request
+SEQUENCES = [(['1ifu'], ['1800']),
+             (['1ifu'], ['60']),
+             (['1ifu', '1r', '1g', '1i'], ['1800', '120', '120', '120']),
+             (['1r', '1g', '1i'], ['90', '90', '90']),
+             (['2r', '2g'], ['60', '60'])]
+
+
+class SyntheticPharos:
+    """
+    SQLite stand-in for the pharos database with the same schema names as
+    Scheduler.query, usable as the db argument of Scheduler
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.connect = create_engine('sqlite://')
+        event.listen(self.connect, 'connect', self._attach)
+
+        with self.connect.begin() as conn:
+            for table in TABLES:
+                conn.exec_driver_sql(table)
+
+    def _attach(self, dbapi_connection, connection_record):
+        dbapi_connection.execute("ATTACH DATABASE '%s' AS public" %
+                                 self.path)
+
+    def fill(self, n, seed=0, now=None):
+        """
+        Insert n random pending requests active tonight
+
+        :param n: number of targets
+        :param seed: random seed so runs are comparable
+        :param now: datetime the requests are active around
+        """
+        rng = np.random.default_rng(seed)
+        if not now:
+            now = datetime.datetime.utcnow()
+
+        fmt = "%Y-%m-%d %H:%M:%S"
+        inidate = (now - datetime.timedelta(days=5)).strftime(fmt)
+        enddate = (now + datetime.timedelta(days=10)).strftime(fmt)
+        modified = now.strftime(fmt)
+
+        ids = np.arange(n) + 1000
+        seqs = rng.integers(0, len(SEQUENCES), n)
+
+        objects = pd.DataFrame({
+            'id': ids, 'name': ['ZTF%07d' % i for i in ids],
+            'iauname': '', 'ra': rng.uniform(0, 360, n),
+            'dec': np.degrees(np.arcsin(rng.uniform(-0.5, 1, n))),
+            'typedesig': 'f', 'epoch': '2000',
+            'magnitude': rng.uniform(14, 20, n), 'creationdate': modified})
+
+        requests = pd.DataFrame({
+            'id': ids, 'object_id': ids, 'user_id': 1, 'marshal_id': -1,
+            'exptime': [json.dumps(SEQUENCES[i][1]) for i in seqs],
+            'maxairmass': 2.5, 'max_fwhm': 10, 'min_moon_dist': 30,
+            'max_moon_illum': 1, 'max_cloud_cover': 1, 'status': 'PENDING',
+            'priority': rng.integers(1, 6, n).astype(float),
+            'inidate': inidate, 'enddate': enddate, 'cadence': None,
+            'phasesamples': None, 'sampletolerance': None, 'filters': '',
+            'nexposures': '',
+            'obs_seq': [json.dumps(SEQUENCES[i][0]) for i in seqs],
+            'seq_repeats': 1, 'seq_completed': 0, 'last_obs_jd': None,
+            'creationdate': modified, 'lastmodified': modified,
+            'allocation_id': rng.integers(1, 6, n), 'phase': None})
+
+        allocations = pd.DataFrame({
+            'id': np.arange(1, 6), 'inidate': inidate, 'enddate': enddate,
+            'time_spent': 0, 'designator': ['2020A-%d' % i for i in
+                                            range(1, 6)],
+            'time_allocated': 100, 'program_id': np.arange(1, 6),
+            'active': 1})
+
+        programs = pd.DataFrame({
+            'id': np.arange(1, 6), 'designator': ['PROG%d' % i for i in
+                                                  range(1, 6)],
+            'name': 'Synthetic', 'group_id': 1, 'pi': 'SEDm',
+            'time_allocated': 100, 'inidate': inidate, 'enddate': enddate})
+
+        users = pd.DataFrame({'id': [1], 'email': ['sedm@example.com']})
+
+        with self.connect.begin() as conn:
+            for name, df in [('request', requests), ('object', objects),
+                             ('allocation', allocations),
+                             ('program', programs), ('users', users)]:
+                conn.exec_driver_sql("DELETE FROM public.%s" % name)
+                df.to_sql(name, conn, schema='public', if_exists='append',
+                          index=False)
+
+
+def measure(func, *args, **kwargs):
+    """
+    Run a function and record its wall time and peak traced memory
+
+    :return: (function return, dictionary with wall_time in seconds and
+             peak_mb)
+    """
+    tracemalloc.start()
+    start = time.perf_counter()
+    try:
+        ret = func(*args, **kwargs)
+    finally:
+        wall = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return ret, {'wall_time': wall, 'peak_mb': peak / 1e6}
+
+
+def run_benchmark(n, work_dir, seed=0):
+    """
+    Run every scheduler stage for n synthetic targets
+
+    :param n: number of targets
+    :param work_dir: directory for the synthetic database and scheduler
+                     files
+    :param seed: random seed
+    :return: dictionary of stage: measurements
+    """
+    db = SyntheticPharos(os.path.join(work_dir, 'public_%d.db' % n))
+    db.fill(n, seed=seed)
+
+    config = os.path.join(work_dir, 'scheduler.json')
+    with open(config, 'w') as outfile:
+        json.dump({'standard_db': params['setup']['standards_db']['path'],
+                   'target_dir': work_dir,
+                   'slew_model': os.path.join(work_dir, 'slew_model.json')},
+                  outfile)
+
+    sched = dbscheduler.Scheduler(config=config, db=db,
+                                  save_as=os.path.join(work_dir,
+                                                       'targets.json'))
+    obstime = sched.obs_times['evening_nautical'] + TimeDelta(3600,
+                                                               format='sec')
+    stages = {}
+
+    ret, stages['query'] = measure(sched.get_active_targets,
+                                   save_copy=False)
+    targets = ret['data']
+
+    # SQLite has no array type, the sequences are stored as json
+    for col in ['obs_seq', 'exptime']:
+        targets[col] = [json.loads(x) for x in targets[col]]
+
+    ret, stages['initialize_targets'] = measure(sched.initialize_targets,
+                                                targets, obstime=obstime)
+    targets = ret['data']
+
+    ret, stages['update_targets_coords'] = measure(
+        sched.update_targets_coords, targets,
+        obstime + TimeDelta(600, format='sec'))
+    targets = ret['data']
+
+    _, stages['build_visibility_grid'] = measure(sched.build_visibility_grid,
+                                                 targets)
+
+    _, stages['next_target_grid'] = measure(
+        sched.get_next_observable_target, targets, obsdatetime=obstime,
+        return_type='json', update_coords=False, use_grid=True)
+
+    if n <= MAX_ASTROPLAN:
+        _, stages['next_target_astroplan'] = measure(
+            sched.get_next_observable_target, targets, obsdatetime=obstime,
+            return_type='json', update_coords=False, use_grid=False)
+
+    _, stages['simulate_night_grid'] = measure(
+        sched.simulate_night, start_time=sched.obs_times['evening_nautical'],
+        end_time=sched.obs_times['morning_nautical'], target_list=targets,
+        return_type='json', use_grid=True)
+
+    _, stages['plan_observations'] = measure(sched.plan_observations, n=5,
+                                             obsdatetime=obstime,
+                                             target_list=targets)
+
+    return stages
+
+
+def load_results(results_file):
+    """
+    Read all previous benchmark runs
+
+    :param results_file: json lines file
+    :return: list of dictionaries
+    """
+    if not os.path.exists(results_file):
+        return []
+    with open(results_file) as data_file:
+        return [json.loads(line) for line in data_file if line.strip()]
+
+
+def save_result(results_file, result):
+    """
+    Append a benchmark run to the results file
+    """
+    with open(results_file, 'a') as outfile:
+        outfile.write(json.dumps(result) + "\n")
+
+
+def report(result, previous=None):
+    """
+    Print a table of the stages, with the change in wall time relative to
+    the previous run of the same size when there is one
+
+    :param result: dictionary from run_benchmarks
+    :param previous: earlier result for the same number of targets
+    """
+    print("%d targets (%s)" % (result['ntargets'], result['date']))
+    print("%-25s %10s %10s %10s" % ('stage', 'wall (s)', 'peak (MB)',
+                                    'vs last'))
+    for stage, values in result['stages'].items():
+        change = ''
+        if previous and stage in previous['stages']:
+            last = previous['stages'][stage]['wall_time']
+            if last > 0:
+                change = "%+.0f%%" % (100 * (values['wall_time'] / last - 1))
+        print("%-25s %10.3f %10.1f %10s" % (stage, values['wall_time'],
+                                            values['peak_mb'], change))
+
+
+def run_benchmarks(sizes=None, results_file=DEFAULT_RESULTS, seed=0,
+                   keep_files=False):
+    """
+    Run the benchmark for every size, report and keep the results
+
+    :param sizes: list of target counts
+    :param results_file: json lines file the results are appended to
+    :param seed: random seed
+    :param keep_files: keep the synthetic database and scheduler files
+    :return: list of results
+    """
+    if not sizes:
+        sizes = DEFAULT_SIZES
+
+    history = load_results(results_file)
+    work_dir = tempfile.mkdtemp(prefix='sched_bench_')
+    results = []
+
+    try:
+        for n in sizes:
+            result = {'date': datetime.datetime.utcnow().isoformat(),
+                      'ntargets': n, 'seed': seed,
+                      'stages': run_benchmark(n, work_dir, seed=seed)}
+
+            previous = [r for r in history if r['ntargets'] == n and
+                        r['seed'] == seed]
+            report(result, previous[-1] if previous else None)
+            save_result(results_file, result)
+            results.append(result)
+    finally:
+        if not keep_files:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    return results
+
+
+if __name__ == "__main__":
+    run_benchmarks([int(x) for x in sys.argv[1:]] or DEFAULT_SIZES)
@@ -1,18 +1,23 @@
 import json
+import heapq
 from string import Template
 import datetime
+import numpy as np
 import pandas as pd
 import astroplan
 from astropy.time import Time, TimeDelta
-from astropy.coordinates import SkyCoord, EarthLocation, AltAz
+from astropy.coordinates import SkyCoord, EarthLocation
 import astropy.units as u
 import os
 import time
+import threading
+import functools
 from utils import obstimes
 from utils.db import dbconnect
 import sqlite3
 import yaml
 from sky.targets.marshals import interface
+from sky.targets.scheduler import ephemeris, visibility, snapshot, slew
 
 # Open the config file
 SR = os.path.abspath(os.path.dirname(__file__) + '/../../../')
@@ -20,6 +25,19 @@ with open(os.path.join(SR, 'config', 'sedm_config.yaml')) as data_file:
     params = yaml.load(data_file, Loader=yaml.FullLoader)
 
 
+def _locked(method):
+    """
+    Run a Scheduler method holding the state lock, the target table,
+    visibility grid and plan are shared by the planning thread and the
+    sky server workers
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.state_lock:
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
 # noinspection SqlNoDataSourceInspection
 class Scheduler:
     """
@@ -27,7 +45,16 @@ class Scheduler:
     """
     def __init__(self, config='',
                  site_name='Palomar', obsdatetime=None,
-                 save_as="targets.json"):
+                 save_as="targets.json", db=None):
+        """
+        :param config: json file with the scheduler parameters, defaults to
+                       the sedm config file
+        :param site_name: astropy site name of the observatory
+        :param obsdatetime:
+        :param save_as: file the active targets are saved to
+        :param db: database connection with a sqlalchemy engine as its
+                   connect attribute, defaults to pharos
+        """
 
         self.scheduler_config_file = config
 
@@ -39,7 +66,8 @@ class Scheduler:
         self.standards_db_path = self.params["standard_db"]
         self.target_dir = self.params["target_dir"]
         self.standard_dict = {}
-        self.standard_star_list = []
+        self.standards = None
+        self.standards_mtime = None
 
         self.site_name = site_name
         self.times = obstimes.get_science_times()
@@ -48,9 +76,26 @@ class Scheduler:
         self.obs_site_plan = astroplan.Observer.at_site(site_name=self.site_name)
         self.obsdatetime = obsdatetime
         self.save_as = save_as
-        self.ph_db = dbconnect()
+        self.ph_db = db if db is not None else dbconnect()
         self.marshals = interface
         self.horizon_limit = params['scheduler']['sky']['horizon_limit']
+        self.visibility = None
+        self.grid_resolution = 0.1
+        self.target_table = None
+        self.sync_window = None
+        self.last_sync = None
+        self.snapshot_dir = os.path.join(self.target_dir, 'snapshots')
+        self.slew_model_path = self.params.get(
+            "slew_model", os.path.join(self.target_dir, 'slew_model.json'))
+        self.slew_model = slew.SlewModel.load(self.slew_model_path)
+        self.telescope_pos = None
+        self.plan = None
+        # Guards target_table, visibility and plan, reentrant as the
+        # locked methods call each other
+        self.state_lock = threading.RLock()
+        self.plan_thread = None
+        # Guards starting the planning thread
+        self.plan_thread_lock = threading.Lock()
 
         self.query = Template("SELECT r.id AS req_id, r.object_id AS obj_id, \n"
                               "r.user_id, r.marshal_id, r.exptime, r.maxairmass,\n"
@@ -98,53 +143,66 @@ class Scheduler:
                                </tr>""")
 
 
-    def __load_targets_from_db(self):
+    def __load_standards_from_db(self):
         """
-        Open the sqlite database of targets
+        Load the sqlite database of standard stars into arrays.  The file is
+        only re-read when its modification time changes.
 
-        :return:
+        :return: dictionary of catalog arrays
         """
+        mtime = os.path.getmtime(self.standards_db_path)
+        if self.standards is not None and mtime == self.standards_mtime:
+            return self.standards
 
         # Open the connection to the sqlite database containing the standard stars
         conn = sqlite3.connect(self.standards_db_path)
-        cur = conn.cursor()
+        try:
+            standards = conn.execute("SELECT * FROM standards").fetchall()
+        finally:
+            conn.close()
 
-        # Get all the standards
-        results = cur.execute("SELECT * FROM standards")
-        standards = results.fetchall()
-
-        # Loop through the standards and create an astroplan object for each
-        # target
+        names, ra, dec, exptime = [], [], [], []
+        self.standard_dict = {}
         for s in standards:
-            name, ra, dec, exptime = s[0].rstrip().encode('utf8'), s[3], s[4], s[5]
+            name = s[0].rstrip()
 
             # Skip any unwanted standards
             # TODO remove these from the standards from the sqlite database
             if name.upper() == 'LB227':
                 continue
 
-            coords = SkyCoord(ra=ra, dec=dec, unit='deg')
-            obj = astroplan.FixedTarget(name=name, coord=coords)
-            self.standard_star_list.append(obj)
+            names.append(name)
+            ra.append(s[3])
+            dec.append(s[4])
+            exptime.append(s[5])
             self.standard_dict[name] = {
                 'name': name,
-                'ra': ra,
-                'dec': dec,
-                'exptime': exptime
+                'ra': s[3],
+                'dec': s[4],
+                'exptime': s[5]
             }
 
+        self.standards = {'name': np.array(names),
+                          'ra': np.array(ra, dtype=float),
+                          'dec': np.array(dec, dtype=float),
+                          'exptime': np.array(exptime, dtype=float),
+                          'coords': ephemeris.target_coords(ra, dec)}
+        self.standards_mtime = mtime
+        return self.standards
+
     def get_standard(self, name='', obsdate=None):
         """
         If the name is not given find the closest standard star to zenith
 
-        :param name: str with name of standard wanted
+        :param name: str with name of standard wanted, 'zenith' for the
+                     standard closest to zenith (lowest airmass)
         :param obsdate: datetime object
         :return: dictionary with elapsed time and the closest matching
                  standard
         """
 
         start = time.time()
-        self.__load_targets_from_db()
+        standards = self.__load_standards_from_db()
 
         if not obsdate:
             obsdate = datetime.datetime.utcnow()
@@ -153,20 +211,22 @@ class Scheduler:
             name = 'zenith'
 
         if name.lower() == 'zenith':
-            sairmass = 100
-            for standard in self.standard_star_list:
-
-                airmass = self.obs_site_plan.altaz(obsdate, standard).secz
+            # Evaluate every standard in one transform and take the one with
+            # the lowest airmass, which is the one closest to zenith
+            alt, airmass = ephemeris.altitude_airmass(standards['coords'],
+                                                      Time(obsdate),
+                                                      self.site)
+            if not np.isfinite(airmass).any():
+                return {'elaptime': time.time() - start,
+                        'error': 'No standards above the horizon'}
+            name = standards['name'][np.argmin(airmass)]
+
+        if name not in self.standard_dict:
+            return {'elaptime': time.time() - start,
+                    'error': 'Standard %s not found' % name}
 
-                if airmass < sairmass and airmass > 0:
-                    target = standard
-                    sairmass = airmass
-                    name = target.name
-
-        std = self.standard_dict[name]
-        std['name'] = std['name'].decode('utf-8')
         return {'elaptime': time.time() - start,
-                'data': std}
+                'data': dict(self.standard_dict[name])}
 
     def _set_obs_seq(self, row):
         """
@@ -283,74 +343,510 @@ class Scheduler:
         return astroplan.FixedTarget(name=row['objname'],
                                      coord=row['SkyCoords'])
 
-    def _set_end_time(self, row):
+    def _set_ephemeris(self, df, obstime):
         """
-        Calculate the end time of an observation by adding the total
-        exposures time to the start time
-        :param row: dataframe row
-        :return: dataframe column
+        Set the start/end times (JD), altitudes (deg), hour angles (hours) and
+        airmasses of every fixed target in one batched calculation
+        :param df: dataframe of targets
+        :param obstime: time to set the ephemeris to
+        :return: dataframe
         """
-        return row['start_obs'] + TimeDelta(row['obs_seq']['total'],
-                                            format='sec')
+        mask = (df['typedesig'] == 'f').values
+
+        for col in ephemeris.COLUMNS:
+            df[col] = np.nan
 
-    def _set_start_altaz(self, row):
+        if not mask.any():
+            return df
+
+        valid = df[mask]
+        durations = [seq['total'] for seq in valid['obs_seq']]
+        coords = ephemeris.target_coords(valid['ra'].values,
+                                         valid['dec'].values)
+
+        eph = ephemeris.compute_ephemeris(coords, Time(obstime), durations,
+                                          self.site)
+        for col, values in eph.items():
+            df.loc[mask, col] = values
+
+        return df
+
+    def _set_rise_set_times(self, df, obstime):
         """
-        Calculate the start altitude and azimuth of a target
-        :param row: dataframe row
-        :return: dataframe column
+        Calculate the next rise and set time (JD) of all fixed targets with a
+        single astroplan call each
+        :param df: dataframe of targets
+        :param obstime: time to start the search from
+        :return: dataframe
         """
-        return row['SkyCoords'].transform_to(AltAz(obstime=row['start_obs'],
-                                                   location=self.site)).alt
+        mask = (df['typedesig'] == 'f').values
+        df['rise_time'] = np.nan
+        df['set_time'] = np.nan
+
+        if not mask.any():
+            return df
 
-    def _set_end_altaz(self, row):
+        coords = ephemeris.target_coords(df.loc[mask, 'ra'].values,
+                                         df.loc[mask, 'dec'].values)
+        horizon = self.horizon_limit * u.degree
+
+        rise = self.obs_site_plan.target_rise_time(Time(obstime), coords,
+                                                   horizon=horizon,
+                                                   which="next")
+        sets = self.obs_site_plan.target_set_time(Time(obstime), coords,
+                                                  horizon=horizon,
+                                                  which="next")
+
+        df.loc[mask, 'rise_time'] = ephemeris.time_to_jd(rise)
+        df.loc[mask, 'set_time'] = ephemeris.time_to_jd(sets)
+        return df
+
+    @_locked
+    def build_visibility_grid(self, target_df=None, start_time=None,
+                              end_time=None, resolution=None):
         """
-        Calculate the end altitude and azimuth of a target
-        :param row: dataframe row
-        :return: dataframe column
+        Precompute the nightly (targets x time-bins) visibility grid from
+        evening to morning twilight
+
+        :param target_df: dataframe of targets to add to the grid
+        :param start_time: start of the grid, defaults to evening nautical
+        :param end_time: end of the grid, defaults to morning nautical
+        :param resolution: bin size in hours
+        :return: dictionary with elapsed time and number of gridded targets
+        """
+        start = time.time()
+
+        if not start_time:
+            start_time = self.obs_times['evening_nautical']
+        if not end_time:
+            end_time = self.obs_times['morning_nautical']
+        if not resolution:
+            resolution = self.grid_resolution
+
+        self.visibility = visibility.VisibilityGrid(start_time, end_time,
+                                                    self.site,
+                                                    resolution=resolution)
+        if isinstance(target_df, pd.DataFrame):
+            self.add_to_visibility_grid(target_df)
+
+        if self.target_table is not None:
+            self.add_to_visibility_grid(self.target_table)
+            self.save_state()
+
+        return {'elaptime': time.time() - start,
+                'data': len(self.visibility)}
+
+    @_locked
+    def add_to_visibility_grid(self, target_df):
         """
-        return row['SkyCoords'].transform_to(AltAz(obstime=row['end_obs'],
-                                                   location=self.site)).alt
+        Add any fixed targets not already in the visibility grid
 
-    def _set_start_ha(self, row):
+        :param target_df: dataframe of targets
+        :return: number of targets added
         """
-        Calculate the start hour angle of a target
-        :param row: dataframe row
-        :return: dataframe column
+        if self.visibility is None or len(target_df) == 0:
+            return 0
+
+        fixed = target_df[target_df['typedesig'] == 'f']
+        return self.visibility.add_targets(fixed['req_id'].values,
+                                           fixed['ra'].values,
+                                           fixed['dec'].values)
+
+    def fit_slew_model(self, history_file=None, min_moves=5):
         """
-        return self.obs_site_plan.target_hour_angle(row['start_obs'],
-                                                    row['fixed_object'])
+        Refit the slew model from the TCS position history and save it
 
-    def _set_end_ha(self, row):
+        :param history_file: csv written by tcs.Telescope.record_pos
+        :param min_moves: minimum number of moves needed to fit an axis
+        :return: dictionary with the fitted model parameters
         """
-        Calculate the end hour angle of a target
-        :param row: dataframe row
-        :return: dataframe column
+        start = time.time()
+
+        if not history_file:
+            history_file = params['observatory']['tcs'].get('pos_history')
+        if not history_file or not os.path.exists(history_file):
+            return {'elaptime': time.time() - start,
+                    'error': 'No position history found: %s' % history_file}
+
+        model = slew.SlewModel(latitude=self.site.lat.deg)
+        model.fit(slew.load_history(history_file), min_moves=min_moves)
+        model.save(self.slew_model_path)
+        self.slew_model = model
+
+        return {'elaptime': time.time() - start, 'data': model.to_dict()}
+
+    def set_telescope_position(self, pos=None, ha=None, dec=None,
+                               domeaz=None):
         """
-        return self.obs_site_plan.target_hour_angle(row['end_obs'],
-                                                    row['fixed_object'])
+        Set the current telescope and dome position used to rank targets by
+        their time to first photon
 
-    def _set_rise_time(self, row):
+        :param pos: position dictionary from tcs.Telescope.get_pos
+        :param ha: hour angle in hours
+        :param dec: declination in degrees
+        :param domeaz: dome azimuth in degrees
+        :return: dictionary
         """
-        Calculate the rise time of a target
-        :param row: dataframe row
-        :return: dataframe column
+        start = time.time()
+
+        if pos and pos.get('telescope_ha_deg') is not None:
+            # Already converted by the tcs parser
+            ha = pos['telescope_ha_deg'] / 15.
+            dec = pos['telescope_dec_deg']
+            domeaz = pos['dome_azimuth']
+        elif pos:
+            ha = slew.sexagesimal_to_float(pos['telescope_ha'])
+            dec = slew.sexagesimal_to_float(pos['telescope_dec'])
+            domeaz = float(pos['dome_azimuth'])
+
+        if None in (ha, dec, domeaz):
+            self.telescope_pos = None
+            return {'elaptime': time.time() - start,
+                    'error': 'Incomplete telescope position'}
+
+        self.telescope_pos = {'ha': float(ha), 'dec': float(dec),
+                              'domeaz': float(domeaz)}
+        return {'elaptime': time.time() - start, 'data': self.telescope_pos}
+
+    def _slew_sort(self, sort_columns, sort_order):
         """
+        Rank targets of equal priority by their time to first photon by
+        putting the slew_time column after the first sort column
 
-        return self.obs_site_plan.target_rise_time(row['start_obs'],
-                                                   row['fixed_object'],
-                                                   horizon=self.horizon_limit * u.degree,
-                                                   which="next")
+        :return: (list of sort columns, list of sort orders)
+        """
+        sort_columns = list(sort_columns)
+        sort_order = list(sort_order)
+        return (sort_columns[:1] + ['slew_time'] + sort_columns[1:],
+                sort_order[:1] + [True] + sort_order[1:])
 
-    def _set_set_time(self, row):
+    def _grid_rejections(self, target_df, obsdatetime, **constraints):
         """
-        Calculate the set time of a target
+        Look up the rejection mask of all fixed targets in the visibility
+        grid.  The grid is built on first use and new targets are added
+        incrementally.
+
+        :param target_df: dataframe of targets
+        :param obsdatetime: astropy Time of the start of the observation
+        :param constraints: keyword arguments for
+                            VisibilityGrid.rejection_masks
+        :return: dictionary of req_id: rejection mask for every target the
+                 grid covers, a mask of 0 means observable
+        """
+        if self.visibility is None:
+            self.build_visibility_grid()
+
+        if not self.visibility.covers(obsdatetime):
+            return {}
+
+        fixed = target_df[target_df['typedesig'] == 'f']
+        if len(fixed) == 0:
+            return {}
+
+        self.add_to_visibility_grid(fixed)
+
+        req_ids = fixed['req_id'].values
+        durations = [seq['total'] for seq in fixed['obs_seq']]
+        finish = obsdatetime + TimeDelta(durations, format='sec')
+        covered = finish.jd <= self.visibility.jd[-1] + self.visibility.step
+
+        masks, valid = self.visibility.rejection_masks(req_ids, obsdatetime,
+                                                       finish, **constraints)
+        return {r: int(m) for r, m, v, c in
+                zip(req_ids, masks, valid, covered) if v and c}
+
+    def _astroplan_rejections(self, target_df, obsdatetime, constraints,
+                              resolution=0.1):
+        """
+        Rejection masks for targets the visibility grid does not cover.
+        Each astroplan constraint is evaluated once as a (targets x times)
+        boolean matrix on a common time grid and the windows are cut out of
+        that.
+
+        :param target_df: dataframe of fixed targets
+        :param obsdatetime: astropy Time of the start of the observation
+        :param constraints: dictionary of constraint name: astroplan
+                            constraint, names as in visibility.CONSTRAINT_BITS
+        :param resolution: time grid resolution in hours
+        :return: dictionary of req_id: rejection mask
+        """
+        if len(target_df) == 0:
+            return {}
+
+        durations = np.array([seq['total'] for seq in target_df['obs_seq']],
+                             dtype=float)
+        step = resolution * 3600
+        offsets = np.arange(0, durations.max() + step, step)
+        times = obsdatetime + TimeDelta(offsets, format='sec')
+        in_window = offsets[np.newaxis, :] <= durations[:, np.newaxis]
+
+        targets = list(target_df['fixed_object'])
+        masks = np.zeros(len(target_df), dtype=int)
+        for name, constraint in constraints.items():
+            ok = np.asarray(constraint(self.obs_site_plan, targets,
+                                       times=times, grid_times_targets=True))
+            failed = np.any(~ok & in_window, axis=1)
+            masks |= failed * visibility.CONSTRAINT_BITS[name]
+
+        return {r: int(m) for r, m in zip(target_df['req_id'], masks)}
+
+    def _html_row(self, row, obstime, start_ha, end_ha, rejects=""):
+        """
+        Format a target as a row of the scheduler webpage table
         :param row: dataframe row
-        :return: dataframe column
+        :param obstime: iso string of the expected observation time
+        :param start_ha: start hour angle in hours
+        :param end_ha: end hour angle in hours
+        :param rejects: html string of rejected targets, see _rejects_html
+        :return: str
         """
-        return self.obs_site_plan.target_set_time(row['start_obs'],
-                                                  row['fixed_object'],
-                                                  horizon=self.horizon_limit * u.degree,
-                                                  which="next")
+        if row.obs_seq['rc']:
+            rc_seq = row.obs_seq['rc_obs_dict']['obs_order'],
+            rc_exptime = row.obs_seq['rc_obs_dict']['obs_exptime'],
+        else:
+            rc_seq = 'NA'
+            rc_exptime = 'NA'
+
+        return self.tr_row.substitute({'allocation': row.allocation_id,
+                                       'obstime': obstime,
+                                       'objname': row.objname,
+                                       'priority': row.priority,
+                                       'project': row.designator,
+                                       'ra': row.ra,
+                                       'dec': row.dec,
+                                       'start_ha': round(start_ha, 2),
+                                       'end_ha': round(end_ha, 2),
+                                       'ifu_exptime': row.obs_seq['ifu_exptime'],
+                                       'rc_seq': rc_seq,
+                                       'rc_exptime': rc_exptime,
+                                       'total': row.obs_seq['total'],
+                                       'request_id': row.req_id,
+                                       'rejects': rejects})
+
+    def _standard_html_row(self, obstime):
+        """
+        Row of the scheduler webpage table used when no target is found
+        :param obstime: iso string of the expected observation time
+        :return: str
+        """
+        return self.tr_row.substitute({'allocation': "",
+                                       'obstime': obstime,
+                                       'objname': "Standard",
+                                       'priority': "",
+                                       'project': "Calib",
+                                       'ra': "",
+                                       'dec': "",
+                                       'start_ha': "",
+                                       'end_ha': "",
+                                       'ifu_exptime': 300,
+                                       'rc_seq': "",
+                                       'rc_exptime': "",
+                                       'total': 300,
+                                       'request_id': "NA",
+                                       'rejects': ""})
+
+    @staticmethod
+    def _rejects_html(rejects):
+        """
+        Format rejected targets for the reject reasons column of the
+        scheduler webpage
+        :param rejects: list of rejection dictionaries
+        :return: str
+        """
+        return "".join(["%s: %s<br>" % (rej['objname'], ','.join(rej['failed']))
+                        for rej in rejects])
+
+    def _simulate_night_grid(self, targets, start_time, end_time,
+                             do_focus=True, do_standard=True,
+                             sort_columns=('priority', 'start_alt'),
+                             sort_order=(False, False), overhead=60,
+                             max_observations=None, slew_model=None,
+                             position=None, grid=None, **constraints):
+        """
+        Greedy night simulation on the precomputed visibility grid.  Follows
+        the same policy as simulate_night/get_next_observable_target but
+        keeps the remaining targets in a boolean mask, picks candidates from
+        a heap and does all ephemeris lookups on the grid.
+
+        :param targets: initialized dataframe of targets
+        :param start_time: astropy Time of the start of the simulation
+        :param end_time: astropy Time of the end of the simulation
+        :param do_focus: add 5min for a focus at the start
+        :param do_standard: add 5min for a standard at the start
+        :param sort_columns: numeric columns to rank the targets by
+        :param sort_order: ascending (True) or descending (False) per column
+        :param overhead: seconds added after each target
+        :param max_observations: stop after this many scheduled entries
+        :param slew_model: SlewModel, when given targets of equal rank in the
+                           first sort column are ordered by time to first
+                           photon and the slew time replaces the overhead
+        :param position: starting telescope position (see
+                         set_telescope_position), defaults to the first
+                         target
+        :param grid: visibility grid to use, defaults to self.visibility.
+                     Targets missing from it are added to it
+        :param constraints: keyword arguments for VisibilityGrid.constraint_mask
+        :return: list of dictionaries, one per scheduled observation.  The
+                 'index' key is the positional index into targets and
+                 'rejects' lists the priority 4+ targets that failed a
+                 constraint, with their rejection mask
+        """
+        start_time = Time(start_time)
+        end_time = Time(end_time)
+
+        if grid is None:
+            grid = self.visibility
+        if grid is None or not grid.covers(start_time, end_time):
+            grid = visibility.VisibilityGrid(start_time, end_time, self.site,
+                                             resolution=self.grid_resolution)
+
+        n = len(targets)
+        fixed = (targets['typedesig'] == 'f').values
+        req_ids = targets['req_id'].tolist()
+        req_arr = targets['req_id'].values
+        ra = pd.to_numeric(targets['ra'], errors='coerce').values
+        dec = pd.to_numeric(targets['dec'], errors='coerce').values
+        if fixed.any():
+            grid.add_targets(req_arr[fixed], ra[fixed], dec[fixed])
+
+        rows = np.where(fixed, grid.rows(req_ids), -1)
+        durations = np.array([seq['total'] for seq in targets['obs_seq']],
+                             dtype=float)
+        priority = targets['priority'].tolist()
+        objname = targets['objname'].tolist()
+
+        # The constraint masks don't depend on the start time, so the failure
+        # tables are built once for the whole night
+        tables = grid.failure_tables(**constraints)
+
+        lst0 = start_time.sidereal_time('apparent',
+                                        longitude=self.site.lon).hour
+
+        def hour_angle(jd):
+            ha = lst0 + (jd - start_time.jd) * 24 * ephemeris.SIDEREAL_RATE
+            return (ha - ra / 15.) % 24
+
+        if slew_model is not None:
+            sort_columns, sort_order = self._slew_sort(sort_columns,
+                                                       sort_order)
+
+        remaining = np.ones(n, dtype=bool)
+        current = start_time.jd
+        end_jd = end_time.jd
+        schedule = []
+
+        while current <= end_jd:
+            if max_observations and len(schedule) >= max_observations:
+                break
+
+            # Ranking values are taken before the calibration offsets are
+            # added, as in simulate_night
+            sort_jd = current
+            if do_focus:
+                current += 300 / 86400.
+                do_focus = False
+            if do_standard:
+                current += 300 / 86400.
+                do_standard = False
+
+            if end_jd - current <= 0:
+                break
+
+            finish_jd = sort_jd + durations / 86400.
+            dynamic = {'start_alt': grid.interpolate(grid.alt, rows, sort_jd),
+                       'end_alt': grid.interpolate(grid.alt, rows, finish_jd),
+                       'start_ha': hour_angle(sort_jd),
+                       'end_ha': hour_angle(finish_jd)}
+
+            # Time to first photon for all candidates from the last position
+            slew_time = np.zeros(n)
+            if slew_model is not None and position is not None:
+                slew_time = slew_model.cost_matrix(position['ha'],
+                                                   position['dec'],
+                                                   position['domeaz'],
+                                                   dynamic['start_ha'], dec)
+            dynamic['slew_time'] = slew_time
+
+            keys = []
+            for col, ascending in zip(sort_columns, sort_order):
+                if col in dynamic:
+                    values = dynamic[col]
+                else:
+                    values = pd.to_numeric(targets[col],
+                                           errors='coerce').values
+                values = values if ascending else -values
+                keys.append(np.where(np.isnan(values), np.inf, values))
+
+            idx = np.flatnonzero(remaining)
+            heap = list(zip(*[k[idx] for k in keys], idx))
+            heapq.heapify(heap)
+
+            start_bin = grid.bins(current)[0]
+            end_bins = grid.bins(current + durations / 86400.)
+
+            choice = None
+            rejects = []
+            target_reorder = False
+            while heap:
+                i = heapq.heappop(heap)[-1]
+
+                # Same quirk as get_next_observable_target, the first
+                # priority <= 2 target triggers a reorder and is skipped
+                if priority[i] <= 2 and not target_reorder:
+                    target_reorder = True
+                    continue
+
+                if not fixed[i]:
+                    continue
+
+                mask = int(grid.rejection_from_tables(tables, rows[i],
+                                                      start_bin,
+                                                      end_bins[i]))
+                if mask == 0:
+                    if 18.75 > dynamic['start_ha'][i] > 5.75:
+                        continue
+                    if 18.75 > dynamic['end_ha'][i] > 5.75:
+                        continue
+                    choice = i
+                    break
+                elif priority[i] >= 4:
+                    rejects.append({'req_id': req_ids[i],
+                                    'objname': objname[i],
+                                    'priority': priority[i],
+                                    'mask': mask,
+                                    'failed': visibility.describe_mask(mask)})
+
+            obstime = Time(current, format='jd').iso
+            if choice is None:
+                schedule.append({'obstime': obstime, 'index': None,
+                                 'req_id': None, 'objname': 'Standard',
+                                 'priority': None, 'start_ha': None,
+                                 'end_ha': None, 'total': 300,
+                                 'slew_time': 0., 'rejects': rejects})
+                current += 300 / 86400.
+            else:
+                schedule.append({'obstime': obstime, 'index': int(choice),
+                                 'req_id': req_ids[choice],
+                                 'objname': objname[choice],
+                                 'priority': priority[choice],
+                                 'start_ha': float(dynamic['start_ha'][choice]),
+                                 'end_ha': float(dynamic['end_ha'][choice]),
+                                 'total': float(durations[choice]),
+                                 'slew_time': float(slew_time[choice]),
+                                 'rejects': rejects})
+                remaining &= (req_arr != req_arr[choice])
+                if slew_model is not None:
+                    current += (durations[choice] +
+                                slew_time[choice]) / 86400.
+                    end_ha = dynamic['end_ha'][choice]
+                    position = {'ha': end_ha, 'dec': dec[choice],
+                                'domeaz': slew.hadec_to_azimuth(
+                                    end_ha, dec[choice],
+                                    slew_model.latitude)}
+                else:
+                    current += (durations[choice] + overhead) / 86400.
+
+        return schedule
 
     def _convert_row_to_json(self, row):
         """
@@ -366,15 +862,21 @@ class Scheduler:
                     req_id=row.req_id, obj_id=row.obj_id,
                     obs_dict=row.obs_seq, marshal_id=row.marshal_id)
 
+    @_locked
     def simulate_night(self, start_time='', end_time='', do_focus=True,
                        do_standard=True, target_list=None,
                        get_current_observation=True,
                        return_type='html',
                        sort_columns=('priority', 'start_alt'),
-                       sort_order=(False, False), ):
+                       sort_order=(False, False), use_grid=True,
+                       use_slew=True):
         """
         Simulate the nightly schedule
 
+        :param use_grid: run the fast simulation on the visibility grid
+        :param use_slew: rank equal priority targets by time to first photon
+                         from the previous target and use the modelled slew
+                         instead of a fixed 60s overhead, in both modes
         :param get_current_observation:
         :param return_type:
         :param sort_columns:
@@ -402,15 +904,13 @@ class Scheduler:
 
         # When a target list is not given try and generate a new one
         if not isinstance(target_list, pd.DataFrame) and not target_list:
-            print("Making a new target list")
-            ret = self.get_active_targets()
+            print("Syncing the target list")
+            ret = self.sync_targets()
             if 'data' in ret:
-                targets = ret['data']
+                target_list = ret['data']
             else:
                 return ret
 
-            target_list = self.initialize_targets(targets)['data']
-
         # If there are no targets then return False
         if len(target_list) == 0:
             return {'data': False, 'elaptime': time.time() - start}
@@ -436,11 +936,50 @@ class Scheduler:
         # 2. Get all targets
         targets = target_list
 
-        # 3. Go through all the targets until we fill up the night
+        slew_model = self.slew_model if use_slew else None
+
+        # 3. Fast mode does the whole night on the precomputed grid
+        if use_grid:
+            schedule = self._simulate_night_grid(targets, start_time,
+                                                 end_time, do_focus=do_focus,
+                                                 do_standard=do_standard,
+                                                 sort_columns=sort_columns,
+                                                 sort_order=sort_order,
+                                                 slew_model=slew_model)
+            if return_type != 'html':
+                return {'data': schedule, 'elaptime': time.time() - start}
+
+            for obs in schedule:
+                if obs['index'] is None:
+                    html_str += self._standard_html_row(obs['obstime'])
+                    continue
+                rej_html = self._rejects_html(obs['rejects'])
+                html_str += self._html_row(targets.iloc[obs['index']],
+                                           obs['obstime'], obs['start_ha'],
+                                           obs['end_ha'], rej_html)
+
+            html_str += "</table><br>Last Updated:%s UT" % datetime.datetime.utcnow()
+            return html_str
+
+        # 4. Go through all the targets until we fill up the night
         current_time = start_time
+        position = None
+        if slew_model is not None:
+            sort_columns, sort_order = self._slew_sort(sort_columns,
+                                                       sort_order)
 
         while current_time <= end_time:
             targets = self.update_targets_coords(targets, current_time)['data']
+            if slew_model is not None:
+                # Time to first photon from the last target, the first one
+                # is picked without a slew as in _simulate_night_grid
+                slew_time = 0.
+                if position is not None:
+                    slew_time = slew_model.cost_matrix(
+                        position['ha'], position['dec'], position['domeaz'],
+                        targets['start_ha'].values.astype(float),
+                        pd.to_numeric(targets['dec'], errors='coerce').values)
+                targets = targets.assign(slew_time=slew_time)
             targets = targets.sort_values(list(sort_columns), ascending=list(sort_order))
             print("Using input datetime of: ", current_time.iso)
             # Include focus time?
@@ -470,38 +1009,333 @@ class Scheduler:
             if not idx:
                 print(len(targets))
                 if return_type == 'html':
-                    html_str += self.tr_row.substitute({'allocation': "",
-                                                        'obstime': current_time.iso,
-                                                        'objname': "Standard",
-                                                        'priority': "",
-                                                        'project': "Calib",
-                                                        'ra': "",
-                                                        'dec': "",
-                                                        'start_ha': "",
-                                                        'end_ha': "",
-                                                        'ifu_exptime': 300,
-                                                        'rc_seq': "",
-                                                        'rc_exptime': "",
-                                                        'total': 300,
-                                                        'request_id': "NA",
-                                                        'rejects': ""})
+                    html_str += self._standard_html_row(current_time.iso)
                 current_time += TimeDelta(300, format='sec')
             else:
                 if return_type == 'html':
                     html_str += t[1]
                     t = t[0]
 
+                overhead = 60
+                if slew_model is not None:
+                    row = targets[targets.req_id == idx].iloc[0]
+                    overhead = row.slew_time
+                    dec = float(row.dec)
+                    position = {'ha': row.end_ha, 'dec': dec,
+                                'domeaz': slew.hadec_to_azimuth(
+                                    row.end_ha, dec, slew_model.latitude)}
+
                 targets = targets[targets.req_id != idx]
-                current_time += TimeDelta(t['total'] + 60, format='sec')  # Adding overhead
+                current_time += TimeDelta(t['total'] + overhead, format='sec')  # Adding overhead
 
         if return_type == 'html':
             html_str += "</table><br>Last Updated:%s UT" % datetime.datetime.utcnow()
             return html_str
 
+    def plan_observations(self, n=5, obsdatetime=None, target_list=None,
+                          exclude=None, airmass=(1, 2.8), moon_sep=(30, 180),
+                          altitude_min=15, ha=(18.75, 5.75), do_airmass=True,
+                          do_moon_sep=True,
+                          sort_columns=('priority', 'start_alt'),
+                          sort_order=(False, False), overhead=60,
+                          use_slew=True, after_req_id=None):
+        """
+        Plan the next n observations with their predicted start times using
+        the same greedy policy as simulate_night.  The plan is kept in
+        self.plan so it can be revalidated by get_planned_target.  The state
+        lock is only held to sync the targets, take the inputs and publish
+        the plan, the simulation runs on a copy of the visibility grid.
+
+        :param n: number of observations to plan
+        :param obsdatetime: predicted start of the first observation,
+                            defaults to now
+        :param target_list: dataframe of targets, synced if not given
+        :param exclude: list of request ids to leave out of the plan, e.g.
+                        the target currently being observed
+        :param airmass: airmass constraint
+        :param moon_sep: moon separation constraint
+        :param altitude_min: minimum altitude observable by the telescope
+        :param ha: ha range
+        :param do_airmass: apply airmass constraint
+        :param do_moon_sep: apply moon constraint
+        :param sort_columns: columns to sort by
+        :param sort_order: ascending (True) or descending (False) per column
+        :param overhead: seconds added after each target when the slew model
+                         is not used
+        :param use_slew: rank equal priority targets by time to first photon
+                         starting from the last telescope position
+        :param after_req_id: request id of the target observed before the
+                             plan starts, its position at obsdatetime is used
+                             as the starting telescope position
+        :return: dictionary with the ordered list of planned observations
+        """
+        start = time.time()
+
+        if not obsdatetime:
+            obsdatetime = Time(datetime.datetime.utcnow())
+        else:
+            obsdatetime = Time(obsdatetime)
+
+        if not isinstance(target_list, pd.DataFrame) and not target_list:
+            ret = self.sync_targets()
+            if 'data' not in ret:
+                return ret
+            target_list = ret['data']
+
+        # Work on copies, the ephemeris columns of the table and the grid
+        # rows change under the other locked methods
+        with self.state_lock:
+            target_list = target_list.copy()
+            if self.visibility is None:
+                self.build_visibility_grid()
+            grid = self.visibility.copy()
+            position = self.telescope_pos
+            slew_model = self.slew_model
+
+        previous = target_list[target_list['req_id'] == after_req_id]
+        if after_req_id is not None and len(previous) > 0:
+            ra = float(previous['ra'].iloc[0])
+            dec = float(previous['dec'].iloc[0])
+            ha = ephemeris.hour_angle(ephemeris.target_coords([ra], [dec]),
+                                      obsdatetime, self.site)[0]
+            position = {'ha': ha, 'dec': dec,
+                        'domeaz': float(slew.hadec_to_azimuth(
+                            ha, dec, slew_model.latitude))}
+
+        if exclude:
+            target_list = target_list[~target_list['req_id'].isin(exclude)]
+
+        end_time = self.obs_times['morning_nautical']
+        if len(target_list) == 0 or obsdatetime >= end_time:
+            plan = []
+        else:
+            schedule = self._simulate_night_grid(
+                target_list, obsdatetime, end_time, do_focus=False,
+                do_standard=False, sort_columns=sort_columns,
+                sort_order=sort_order, overhead=overhead, max_observations=n,
+                slew_model=slew_model if use_slew else None,
+                position=position, grid=grid,
+                altitude_min=altitude_min, airmass=airmass,
+                moon_sep=moon_sep, ha=ha, do_airmass=do_airmass,
+                do_moon_sep=do_moon_sep)
+
+            plan = [{'obstime': obs['obstime'], 'req_id': obs['req_id'],
+                     'objname': obs['objname'], 'priority': obs['priority'],
+                     'total': obs['total'], 'slew_time': obs['slew_time']}
+                    for obs in schedule]
+
+        with self.state_lock:
+            self.plan = {'created': datetime.datetime.utcnow().isoformat(),
+                         'obsdatetime': obsdatetime.iso,
+                         'constraints': {'airmass': airmass,
+                                         'moon_sep': moon_sep,
+                                         'altitude_min': altitude_min,
+                                         'ha': ha, 'do_airmass': do_airmass,
+                                         'do_moon_sep': do_moon_sep},
+                         'plan': plan}
+
+        return {'elaptime': time.time() - start, 'data': plan}
+
+    def _run_plan(self, **kwargs):
+        """
+        Thread target for start_planning
+        """
+        try:
+            ret = self.plan_observations(**kwargs)
+            if 'error' in ret:
+                print(ret['error'], "Error planning observations")
+        except Exception as e:
+            print(str(e), "Error planning observations")
+
+    def start_planning(self, n=5, obsdatetime=None, exclude=None, **kwargs):
+        """
+        Plan the next observations in a background thread, meant to be
+        called at the start of an exposure with obsdatetime set to the
+        expected end of the exposure
+
+        :param n: number of observations to plan
+        :param obsdatetime: predicted start of the first observation
+        :param exclude: list of request ids to leave out of the plan
+        :param kwargs: keyword arguments for plan_observations
+        :return: dictionary
+        """
+        start = time.time()
+
+        kwargs.update({'n': n, 'obsdatetime': obsdatetime,
+                       'exclude': exclude})
+        with self.plan_thread_lock:
+            if self.plan_thread is not None and self.plan_thread.is_alive():
+                return {'elaptime': time.time() - start,
+                        'error': 'Planning is already running'}
+
+            self.plan_thread = threading.Thread(target=self._run_plan,
+                                                kwargs=kwargs)
+            self.plan_thread.start()
+
+        return {'elaptime': time.time() - start, 'data': 'Planning started'}
+
+    def get_plan(self, wait=0):
+        """
+        Get the latest plan
+
+        :param wait: seconds to wait for a running plan to finish
+        :return: dictionary
+        """
+        start = time.time()
+
+        thread = self.plan_thread
+        if thread is not None and thread.is_alive():
+            thread.join(wait)
+            if thread.is_alive():
+                return {'elaptime': time.time() - start,
+                        'error': 'Planning is still running'}
+
+        with self.state_lock:
+            if self.plan is None:
+                return {'elaptime': time.time() - start,
+                        'error': 'No plan available'}
+            plan = dict(self.plan, plan=list(self.plan['plan']))
+
+        return {'elaptime': time.time() - start, 'data': plan}
+
+    def get_planned_target(self, obsdatetime=None, completed=None, wait=30,
+                           return_type='json', save=False, save_as='',
+                           airmass=(1, 2.8), moon_sep=(30, 180),
+                           altitude_min=15, ha=(18.75, 5.75),
+                           do_airmass=True, do_moon_sep=True):
+        """
+        Take the next target from the current plan after checking that it
+        is still active and observable at the actual start time.  Only the
+        planned targets are checked, so this is much cheaper than a full
+        get_next_observable_target call, which is used as the fallback
+        when no planned target is valid.
+
+        :param obsdatetime: actual start time, defaults to now
+        :param completed: list of request ids that were already observed
+        :param wait: seconds to wait for a running plan to finish
+        :param return_type: 'json' or '' as for get_next_observable_target
+        :param save: save the target to a file
+        :param save_as: file path
+        :param airmass: airmass constraint
+        :param moon_sep: moon separation constraint
+        :param altitude_min: minimum altitude observable by the telescope
+        :param ha: ha range
+        :param do_airmass: apply airmass constraint
+        :param do_moon_sep: apply moon constraint
+        :return: same as get_next_observable_target.  The constraints the
+                 plan was made with take precedence over the ones given
+        """
+        s = time.time()
+
+        if not obsdatetime:
+            obsdatetime = Time(datetime.datetime.utcnow())
+        else:
+            obsdatetime = Time(obsdatetime)
+
+        constraints = {'airmass': airmass, 'moon_sep': moon_sep,
+                       'altitude_min': altitude_min, 'ha': ha,
+                       'do_airmass': do_airmass, 'do_moon_sep': do_moon_sep}
+
+        # Give a running plan the chance to finish, otherwise the last plan
+        # is revalidated
+        thread = self.plan_thread
+        if thread is not None and thread.is_alive():
+            thread.join(wait)
+
+        with self.state_lock:
+            # Pick up any changes to the requests since the plan was made
+            ret = self.sync_targets()
+            if 'data' not in ret:
+                return ret
+            target_list = ret['data']
+
+            if self.plan is not None:
+                plan = self.plan['plan']
+                constraints.update(self.plan['constraints'])
+            else:
+                plan = []
+
+            completed = set(completed or [])
+            planned = [obs['req_id'] for obs in plan
+                       if obs['req_id'] is not None and
+                       obs['req_id'] not in completed]
+            candidates = target_list[target_list['req_id'].isin(planned)]
+
+            if len(candidates) > 0:
+                candidates = candidates.set_index('req_id', drop=False)
+                candidates = candidates.loc[[r for r in planned
+                                             if r in candidates.index]]
+                candidates = candidates.reset_index(drop=True)
+                candidates = self.update_targets_coords(candidates,
+                                                        obsdatetime)['data']
+                rejections = self._grid_rejections(candidates, obsdatetime,
+                                                   **constraints)
+
+                ha = constraints['ha']
+                for row in candidates.itertuples():
+                    if rejections.get(row.req_id, -1) != 0:
+                        continue
+                    if ha[0] > row.start_ha > ha[1]:
+                        continue
+                    if ha[0] > row.end_ha > ha[1]:
+                        continue
+
+                    # Drop everything up to the chosen target from the plan
+                    pos = [obs['req_id'] for obs in plan].index(row.req_id)
+                    self.plan['plan'] = plan[pos + 1:]
+
+                    if return_type != 'json':
+                        return row.req_id, row.obs_seq
+
+                    targ = self._convert_row_to_json(row)
+                    if save:
+                        if not save_as:
+                            save_as = os.path.join(self.target_dir,
+                                                   "next_target_%s.json" %
+                                                   datetime.datetime.utcnow().strftime("%Y%m%d"))
+                        with open(save_as, 'w') as outfile:
+                            outfile.write(json.dumps(targ))
+                    return {"elaptime": time.time() - s, "data": targ,
+                            "rejects": [], "planned": True}
+
+            # Nothing in the plan can be observed so do the full search
+            if completed:
+                target_list = target_list[
+                    ~target_list['req_id'].isin(completed)]
+            return self.get_next_observable_target(target_list,
+                                                   obsdatetime=obsdatetime,
+                                                   return_type=return_type,
+                                                   save=save, save_as=save_as,
+                                                   **constraints)
+
+    def _active_window(self):
+        """
+        Default request date window for the current active night
+
+        :return: (startdate datetime, enddate str)
+        """
+        # Get the targets for the current active night.
+        if datetime.datetime.utcnow().hour >= 14:
+            startdate = (datetime.datetime.utcnow() +
+                         datetime.timedelta(days=1))
+        else:
+            startdate = datetime.datetime.utcnow()
+
+        # Set the start date to end of the day.  This is to make sure that
+        # we get all the targets for the day no matter what time they
+        # were inserted
+        startdate = startdate.replace(hour=23, minute=59, second=59,
+                                      microsecond=0)
+
+        enddate = (datetime.datetime.utcnow() +
+                   datetime.timedelta(days=1)).strftime("%Y-%m-%d")
+
+        return startdate, enddate
+
     def get_active_targets(self, startdate=None, enddate=None,
                            where_statement="", and_statement="",
                            group_statement="", order_statement="",
-                           save_copy=True):
+                           save_copy=True, modified_since=None):
         """
         Get all the active targets currently PENDING in the pharos database
 
@@ -512,27 +1346,19 @@ class Scheduler:
         :param group_statement:
         :param order_statement:
         :param save_copy:
+        :param modified_since: only return requests modified after
+                               this time
         :return:
         """
 
         start = time.time()
 
-        # Get the targets for the current active night.
+        default_start, default_end = self._active_window()
         if not startdate:
-            if datetime.datetime.utcnow().hour >= 14:
-                startdate = (datetime.datetime.utcnow() +
-                             datetime.timedelta(days=1))
-            else:
-                startdate = datetime.datetime.utcnow()
-
-            # Set the start date to end of the day.  This is to make sure that
-            # we get all the targets for the day no matter what time they
-            # were inserted
-            startdate = startdate.replace(hour=23, minute=59, second=59)
+            startdate = default_start
 
         if not enddate:
-            enddate = (datetime.datetime.utcnow() +
-                       datetime.timedelta(days=1)).strftime("%Y-%m-%d")
+            enddate = default_end
 
         # If there is no where statement then use the default filtering of
         # targets by date and object id.  We use greater than 100 do filter
@@ -541,6 +1367,9 @@ class Scheduler:
             where_statement = ("WHERE r.enddate >= '%s' AND r.object_id > 100 "
                                "AND r.inidate <= '%s'" % (enddate, startdate))
 
+        if modified_since is not None:
+            where_statement += " AND r.lastmodified > '%s'" % modified_since
+
         if not and_statement:
             and_statement = "AND r.status = 'PENDING'"
 
@@ -556,18 +1385,101 @@ class Scheduler:
 
         return {"data": df, "elaptime": time.time() - start}
 
-    def initialize_targets(self, target_df, obstime=''):
+    def _get_modified_request_ids(self, modified_since):
         """
-        Given in an input dataframe of targets initialize the sky properties
-        of each target
+        Get the ids of every request modified after a given time,
+        whatever its status
 
-        :param target_df: pandas dataframe
-        :param obstime: time to initialize the targets against
-        :return:
+        :param modified_since: datetime or timestamp
+        :return: (set of request ids, latest modification time)
         """
+        q = ("SELECT r.id AS req_id, r.lastmodified FROM \"public\".request r "
+             "WHERE r.lastmodified > '%s'" % modified_since)
+        df = pd.read_sql_query(q, self.ph_db.connect)
+        if len(df) == 0:
+            return set(), modified_since
+        return set(df['req_id']), df['lastmodified'].max()
 
+    @_locked
+    def sync_targets(self, full=False):
+        """
+        Keep an in-memory, request-id indexed table of initialized targets in
+        step with pharos.  After the first full load only requests modified
+        since the last sync are queried, and inserts, updates and drops are
+        applied to the table.  A full reload is done when the active night
+        changes.
+
+        :param full: force a full reload
+        :return: dictionary with elapsed time and the target table
+        """
         start = time.time()
 
+        # Try to pick up where a previous process left off
+        if self.target_table is None and not full:
+            self.load_state()
+
+        window = self._active_window()
+        if self.target_table is None or window != self.sync_window:
+            full = True
+
+        if full:
+            ret = self.get_active_targets()
+            if 'data' not in ret:
+                return ret
+            table = self.initialize_targets(ret['data'])['data']
+            table.index = table['req_id'].values
+            self.target_table = table
+            self.sync_window = window
+            self.last_sync = table['lastmodified'].max() if len(table) else None
+
+            if self.visibility is not None:
+                self.visibility.remove_targets(list(self.visibility.req_ids))
+                self.add_to_visibility_grid(table)
+
+            self.save_state()
+            return {'elaptime': time.time() - start, 'data': self.target_table}
+
+        if self.last_sync is None or pd.isnull(self.last_sync):
+            return self.sync_targets(full=True)
+
+        modified, last_modified = self._get_modified_request_ids(self.last_sync)
+        if not modified:
+            return {'elaptime': time.time() - start, 'data': self.target_table}
+
+        ret = self.get_active_targets(modified_since=self.last_sync,
+                                      save_copy=False)
+        if 'data' not in ret:
+            return ret
+        changed = ret['data']
+
+        # Anything that was modified but is no longer active (completed,
+        # canceled or moved out of the window) is dropped.  Updated requests
+        # are dropped too and re-inserted below with fresh values
+        table = self.target_table
+        drop = list(modified | set(changed['req_id']))
+        table = table[~table['req_id'].isin(drop)]
+        if self.visibility is not None:
+            self.visibility.remove_targets(drop)
+
+        if len(changed) > 0:
+            changed = self.initialize_targets(changed)['data']
+            changed.index = changed['req_id'].values
+            table = pd.concat([table, changed])
+            self.add_to_visibility_grid(changed)
+
+        self.target_table = table
+        self.last_sync = last_modified
+        self.save_state()
+        return {'elaptime': time.time() - start, 'data': self.target_table}
+
+    def _set_sky_objects(self, target_df):
+        """
+        Add the SkyCoords and astroplan FixedTarget columns for the targets
+        with a fixed position
+
+        :param target_df: pandas dataframe
+        :return: dataframe
+        """
         # Only get targets that have a fixed position
         mask = (target_df['typedesig'] == 'f')
         target_df_valid = target_df[mask]
@@ -577,44 +1489,109 @@ class Scheduler:
         target_df.loc[mask, 'SkyCoords'] = SkyCoord(ra=target_df_valid['ra'],
                                                     dec=target_df_valid['dec'],
                                                     unit="deg")
+        target_df['fixed_object'] = target_df.apply(self._set_fixed_targets,
+                                                    axis=1)
+        return target_df
+
+    @_locked
+    def save_state(self):
+        """
+        Save the synced target table and visibility grid to a snapshot for
+        the current night
+
+        :return: dictionary with elapsed time and snapshot path
+        """
+        start = time.time()
+
+        if self.target_table is None or self.sync_window is None:
+            return {'elaptime': time.time() - start,
+                    'error': 'No target table to save'}
+
+        meta = {'window': [str(self.sync_window[0]), self.sync_window[1]],
+                'last_sync': (None if self.last_sync is None or
+                              pd.isnull(self.last_sync) else
+                              str(self.last_sync))}
+        path = snapshot.snapshot_path(self.snapshot_dir, self.sync_window[0])
+
+        try:
+            snapshot.save_snapshot(path, self.target_table,
+                                   grid=self.visibility, meta=meta)
+        except Exception as e:
+            print("Unable to save scheduler snapshot:", str(e))
+            return {'elaptime': time.time() - start, 'error': str(e)}
+
+        return {'elaptime': time.time() - start, 'data': path}
+
+    @_locked
+    def load_state(self):
+        """
+        Restore the target table and visibility grid from the snapshot of
+        the current night.  Snapshots from another night are ignored.
+
+        :return: bool, True if a snapshot was loaded
+        """
+        window = self._active_window()
+        path = snapshot.snapshot_path(self.snapshot_dir, window[0])
 
-        # Calculate the ephemeris times for each target
-        target_df['start_obs'] = False
+        try:
+            snap = snapshot.load_snapshot(path)
+        except Exception as e:
+            print("Unable to load scheduler snapshot:", str(e))
+            return False
+
+        if not snap or snap['meta'].get('window') != [str(window[0]),
+                                                      window[1]]:
+            return False
+
+        table = self._set_sky_objects(snap['table'])
+        table.index = table['req_id'].values
+        self.target_table = table
+        self.sync_window = window
+
+        last_sync = snap['meta'].get('last_sync')
+        self.last_sync = pd.Timestamp(last_sync) if last_sync else None
+
+        if snap['arrays'] is not None:
+            self.visibility = visibility.VisibilityGrid.from_arrays(
+                snap['arrays'], snap['req_ids'], self.site,
+                resolution=snap['meta']['resolution'])
+        return True
+
+    def initialize_targets(self, target_df, obstime=''):
+        """
+        Given in an input dataframe of targets initialize the sky properties
+        of each target
+
+        :param target_df: pandas dataframe
+        :param obstime: time to initialize the targets against
+        :return:
+        """
+
+        start = time.time()
+
+        target_df = self._set_sky_objects(target_df)
+
+        # Calculate the ephemeris values for each target
         if not obstime:
             obstime = datetime.datetime.utcnow()
 
-        target_df.loc[mask, 'start_obs'] = Time(obstime)
-
         target_df['obs_seq'] = target_df.apply(self._set_obs_seq, axis=1)
-        target_df['end_obs'] = target_df.apply(self._set_end_time, axis=1)
-        target_df['start_alt'] = target_df.apply(self._set_start_altaz,
-                                                 axis=1)
-        target_df['end_alt'] = target_df.apply(self._set_end_altaz, axis=1)
-        target_df['fixed_object'] = target_df.apply(self._set_fixed_targets,
-                                                    axis=1)
-        target_df['start_ha'] = target_df.apply(self._set_start_ha, axis=1)
-        target_df['end_ha'] = target_df.apply(self._set_end_ha, axis=1)
-        target_df['rise_time'] = target_df.apply(self._set_rise_time, axis=1)
-        target_df['set_time'] = target_df.apply(self._set_set_time, axis=1)
+        target_df = self._set_ephemeris(target_df, obstime)
+        target_df = self._set_rise_set_times(target_df, obstime)
 
         return {'data': target_df, 'elaptime': time.time() - start}
 
     def update_targets_coords(self, df, obstime=None):
         """Update the ephemeris data with new times"""
         start = time.time()
-        df['start_obs'] = False
 
         if not obstime:
             obstime = datetime.datetime.utcnow()
 
-        df['start_obs'] = Time(obstime)
-        df['end_obs'] = df.apply(self._set_end_time, axis=1)
-        df['start_alt'] = df.apply(self._set_start_altaz, axis=1)
-        df['end_alt'] = df.apply(self._set_end_altaz, axis=1)
-        df['start_ha'] = df.apply(self._set_start_ha, axis=1)
-        df['end_ha'] = df.apply(self._set_end_ha, axis=1)
+        df = self._set_ephemeris(df, obstime)
         return {'data': df, 'elaptime': time.time() - start}
 
+    @_locked
     def look_for_new_targets(self, df, startdate=None, enddate=None,
                              where_statement="", and_statement="",
                              group_statement="", order_statement="",
@@ -656,13 +1633,17 @@ class Scheduler:
             ret = self.initialize_targets(new_df)
 
             if 'data' in ret:
-                df = df.append(ret['data'])
+                df = pd.concat([df, ret['data']])
+                self.add_to_visibility_grid(ret['data'])
 
         if len(dropped_targets) >= 1:
             df = df[-df["req_id"].isin(dropped_targets)]
+            if self.visibility is not None:
+                self.visibility.remove_targets(dropped_targets)
 
         return {'data': df, 'elaptime': time.time() - start}
 
+    @_locked
     def get_next_observable_target(self, target_list=None, obsdatetime=None,
                                    airmass=(1, 2.8), moon_sep=(30, 180),
                                    altitude_min=15, ha=(18.75, 5.75),
@@ -671,7 +1652,8 @@ class Scheduler:
                                    sort_columns=('priority', 'start_alt'),
                                    sort_order=(False, False), save=False,
                                    save_as='',
-                                   check_end_of_night=True, update_coords=True):
+                                   check_end_of_night=True, update_coords=True,
+                                   use_grid=True, use_slew=True):
         """
         Get the next available target to observe.
 
@@ -692,6 +1674,9 @@ class Scheduler:
         :param save_as: file path
         :param check_end_of_night: determine if it is end of the night
         :param update_coords: update the ephemeris of the dataframe
+        :param use_grid: look up observability in the nightly visibility grid
+        :param use_slew: when the telescope position is known, order targets
+                         of equal priority by time to first photon
         :return: dictionary
         """
 
@@ -705,15 +1690,13 @@ class Scheduler:
 
         # Check if the target list is valid and has targets
         if not isinstance(target_list, pd.DataFrame) and not target_list:
-            print("Making a new target list")
-            ret = self.get_active_targets()
+            print("Syncing the target list")
+            ret = self.sync_targets()
             if 'data' in ret:
-                targets = ret['data']
+                target_list = ret['data']
             else:
                 return ret
 
-            target_list = self.initialize_targets(targets)['data']
-
         # If no target found the return False
         if len(target_list) == 0:
             return {'data': False, 'elaptime': time.time() - s}
@@ -733,19 +1716,54 @@ class Scheduler:
         # Since we are looking for the highest priority target, sort by that
         # value first and then by targets that are setting first
         if do_sort:
+            if use_slew and self.telescope_pos is not None:
+                target_list = target_list.copy()
+                target_list['slew_time'] = self.slew_model.cost_matrix(
+                    self.telescope_pos['ha'], self.telescope_pos['dec'],
+                    self.telescope_pos['domeaz'],
+                    target_list['start_ha'].values.astype(float),
+                    pd.to_numeric(target_list['dec'], errors='coerce').values)
+                sort_columns, sort_order = self._slew_sort(sort_columns,
+                                                           sort_order)
             target_list = target_list.sort_values(list(sort_columns),
                                                   ascending=list(sort_order))
 
+        # Force altitude constraint check
+        constraint = {'altitude': astroplan.AltitudeConstraint(
+            min=altitude_min * u.deg)}
+
+        # Determine other constraints to apply
+        if do_airmass:
+            constraint['airmass'] = astroplan.AirmassConstraint(
+                min=airmass[0], max=airmass[1])
+        if do_moon_sep:
+            constraint['moon_sep'] = astroplan.MoonSeparationConstraint(
+                min=moon_sep[0] * u.degree)
+
+        # Evaluate every constraint for all fixed targets in one pass.  The
+        # nightly visibility grid is used where it covers the targets and
+        # the rest are checked on a single astroplan constraint matrix
+        fixed = target_list[target_list['typedesig'] == 'f']
+        rejections = {}
+        if use_grid:
+            rejections = self._grid_rejections(fixed, obsdatetime,
+                                               altitude_min=altitude_min,
+                                               airmass=airmass,
+                                               moon_sep=moon_sep, ha=ha,
+                                               do_airmass=do_airmass,
+                                               do_moon_sep=do_moon_sep)
+        missing = fixed[~fixed['req_id'].isin(list(rejections))]
+        rejections.update(self._astroplan_rejections(missing, obsdatetime,
+                                                     constraint))
+
         # Set variables
-        rej_html = ""
+        rejects = []
         target_reorder = False
 
         # Loop through the targets until the first observable target is found
         for row in target_list.itertuples():
             start = obsdatetime
 
-            finish = start + TimeDelta(row.obs_seq['total'],
-                                       format='sec')
             # If we are only looking at targets that are priority 2 or below
             # then reorder the targets by hour angle
             if row.priority <= 2 and not target_reorder:
@@ -755,60 +1773,24 @@ class Scheduler:
                 target_reorder = True
                 continue
 
-            # Force altitude constraint check
-            constraint = [astroplan.AltitudeConstraint(min=altitude_min
-                                                           * u.deg)]
-
-            # Determine other constraints to apply
-            if do_airmass:
-                constraint.append(astroplan.AirmassConstraint(min=airmass[0],
-                                                              max=airmass[1]))
-            if do_moon_sep:
-                constraint.append(astroplan.MoonSeparationConstraint(min=moon_sep[0] * u.degree))
-
             # Determine if fixed or periodic target
             if row.typedesig == 'f':
 
-                # Use astroplan to check if the target is currently observable
-                if astroplan.is_observable(constraint, self.obs_site_plan,
-                                           row.fixed_object,
-                                           times=[start, finish],
-                                           time_grid_resolution=0.1 * u.hour):
-
-                    s_ha = float(row.start_ha.to_string(unit=u.hour, decimal=True))
-                    e_ha = float(row.end_ha.to_string(unit=u.hour, decimal=True))
+                mask = rejections[row.req_id]
+                if mask == 0:
 
                     # If the target falls outside the observable hour range for
                     # the telescope then go on to the next target
-                    if 18.75 > s_ha > 5.75:
+                    if 18.75 > row.start_ha > 5.75:
                         continue
-                    if 18.75 > e_ha > 5.75:
+                    if 18.75 > row.end_ha > 5.75:
                         continue
 
                     # html returns are used for the scheduler webpage
                     if return_type == 'html':
-                        if row.obs_seq['rc']:
-                            rc_seq = row.obs_seq['rc_obs_dict']['obs_order'],
-                            rc_exptime = row.obs_seq['rc_obs_dict']['obs_exptime'],
-                        else:
-                            rc_seq = 'NA'
-                            rc_exptime = 'NA'
-
-                        html = self.tr_row.substitute({'allocation': row.allocation_id,
-                                                       'obstime': start.iso,
-                                                       'objname': row.objname,
-                                                       'priority': row.priority,
-                                                       'project': row.designator,
-                                                       'ra': row.ra,
-                                                       'dec': row.dec,
-                                                       'start_ha': row.start_ha,
-                                                       'end_ha': row.end_ha,
-                                                       'ifu_exptime': row.obs_seq['ifu_exptime'],
-                                                       'rc_seq': rc_seq,
-                                                       'rc_exptime': rc_exptime,
-                                                       'total': row.obs_seq['total'],
-                                                       'request_id': row.req_id,
-                                                       'rejects': rej_html})
+                        html = self._html_row(row, start.iso, row.start_ha,
+                                              row.end_ha,
+                                              self._rejects_html(rejects))
                         return row.req_id, (row.obs_seq, html)
 
                     # JSON returns are for sending target in appropriate
@@ -825,33 +1807,24 @@ class Scheduler:
                                 with open(save_as, 'w') as outfile:
                                     outfile.write(json.dumps(targ))
 
-                        return {"elaptime": time.time() - s, "data": targ}
+                        return {"elaptime": time.time() - s, "data": targ,
+                                "rejects": rejects}
                     else:
                         return row.req_id, row.obs_seq
-                else:
-                    # When the target is priority 4 or above we want to know
-                    # why the target is not being observed
-                    if row.priority >= 4:
-                        count = 1
-                        num = []
-
-                        # Go through each constraints and determine which failed
-                        for i in constraint:
-                            ret = astroplan.is_observable([i], self.obs_site_plan,
-                                                       row.fixed_object, times=[start, finish],
-                                                       time_grid_resolution=0.1 * u.hour)
-
-                            if ret:
-                                num.append(str(count))
-                            count += 1
-                        if return_type == 'html' and len(num) >= 1:
-                            rej_html += """%s: %s<br>""" % (row.objname, ','.join(num))
-                        elif return_type == 'json' and len(num) >= 1:
-                            rej_html += ','.join(num)
+
+                # When the target is priority 4 or above we want to know
+                # why the target is not being observed
+                elif row.priority >= 4:
+                    rejects.append({'req_id': row.req_id,
+                                    'objname': row.objname,
+                                    'priority': int(row.priority),
+                                    'mask': mask,
+                                    'failed': visibility.describe_mask(mask)})
 
         # If we made it here then no observable target was found.
         if return_type == 'json':
-            return {"elaptime": time.time() - s, "error": "No targets found"}
+            return {"elaptime": time.time() - s, "error": "No targets found",
+                    "rejects": rejects}
         return False, False
 
     def get_lst(self, obsdatetime=None):
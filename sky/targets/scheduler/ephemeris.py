@@ -0,0 +1,94 @@
+import numpy as np
+from astropy.time import Time, TimeDelta
+from astropy.coordinates import SkyCoord, AltAz
+import astropy.units as u
+
+# Float64 columns written to the target dataframe by compute_ephemeris
+COLUMNS = ['start_obs', 'end_obs', 'start_alt', 'end_alt', 'start_ha',
+           'end_ha', 'start_airmass', 'end_airmass']
+
+# Ratio of sidereal to solar time, used to advance hour angles in time
+SIDEREAL_RATE = 1.00273790935
+
+
+def target_coords(ra, dec):
+    """
+    Build a single SkyCoord array for a list of targets
+
+    :param ra: array of right ascensions in degrees
+    :param dec: array of declinations in degrees
+    :return: SkyCoord array
+    """
+    return SkyCoord(ra=np.asarray(ra, dtype=float),
+                    dec=np.asarray(dec, dtype=float), unit='deg')
+
+
+def time_to_jd(times):
+    """
+    Convert an astropy Time (possibly masked) to a float64 array of julian
+    dates with NaN for masked values
+
+    :param times: astropy Time object
+    :return: numpy array
+    """
+    return np.ma.filled(np.ma.asarray(times.jd, dtype=float), np.nan)
+
+
+def hour_angle(coords, obstime, location):
+    """
+    Calculate the hour angle of all targets at once.  Values are in decimal
+    hours wrapped to the 0-24h range to match astroplan target_hour_angle
+
+    :param coords: SkyCoord array
+    :param obstime: astropy Time scalar or array broadcastable to coords
+    :param location: EarthLocation of the observatory
+    :return: numpy array of hour angles in hours
+    """
+    lst = obstime.sidereal_time('apparent', longitude=location.lon)
+    ha = (lst - coords.ra).wrap_at(360 * u.deg)
+    return np.asarray(ha.to_value(u.hourangle), dtype=float)
+
+
+def altitude_airmass(coords, obstime, location):
+    """
+    Transform all targets to AltAz in one call
+
+    :param coords: SkyCoord array
+    :param obstime: astropy Time scalar or array broadcastable to coords
+    :param location: EarthLocation of the observatory
+    :return: (altitude in degrees, airmass) numpy arrays.  Targets below the
+             horizon are given an infinite airmass
+    """
+    altaz = coords.transform_to(AltAz(obstime=obstime, location=location))
+    alt = np.asarray(altaz.alt.to_value(u.deg), dtype=float)
+    with np.errstate(divide='ignore'):
+        airmass = np.where(alt > 0, 1 / np.sin(np.radians(alt)), np.inf)
+    return alt, airmass
+
+
+def compute_ephemeris(coords, start_time, durations, location):
+    """
+    Compute the start and end altitude, hour angle and airmass of every
+    target with one array transform per time
+
+    :param coords: SkyCoord array of targets
+    :param start_time: astropy Time scalar for the start of the observations
+    :param durations: array with the length of each observation in seconds
+    :param location: EarthLocation of the observatory
+    :return: dictionary of float64 arrays keyed by COLUMNS
+    """
+    start_time = Time(start_time)
+    durations = np.asarray(durations, dtype=float)
+    end_time = start_time + TimeDelta(durations, format='sec')
+
+    start_alt, start_airmass = altitude_airmass(coords, start_time, location)
+    end_alt, end_airmass = altitude_airmass(coords, end_time, location)
+
+    return {'start_obs': np.full(len(durations), start_time.jd),
+            'end_obs': time_to_jd(end_time),
+            'start_alt': start_alt,
+            'end_alt': end_alt,
+            'start_ha': hour_angle(coords, start_time, location),
+            'end_ha': hour_angle(coords, end_time, location),
+            'start_airmass': start_airmass,
+            'end_airmass': end_airmass}
@@ -0,0 +1,277 @@
+import os
+import json
+import numpy as np
+import pandas as pd
+
+# Columns written to the TCS position history by tcs.Telescope.record_pos
+HISTORY_COLUMNS = ['julian_date', 'telescope_ha', 'telescope_dec',
+                   'telescope_azimuth', 'dome_azimuth',
+                   'telescope_motion_status', 'move_id']
+
+# Axes of the model and the history column each one is fit from
+AXES = {'ha': 'ha_deg', 'dec': 'telescope_dec', 'dome': 'dome_azimuth'}
+
+# Changes smaller than this (degrees) between samples are treated as tracking
+MOVE_TOLERANCE = 0.05
+
+# Samples further apart than this (seconds, a few times the tcs move
+# poll_max) are not in the same move.  Only used to split histories written
+# before record_pos added the move id
+MOVE_GAP = 30.
+
+
+def sexagesimal_to_float(value):
+    """
+    Convert a TCS sexagesimal string such as 'e00:51:28.85' or '-20:31:56.3'
+    to a float in the units of the first field.  East hour angles are
+    returned as negative values.
+
+    :param value: str or float
+    :return: float, NaN if the value can't be parsed
+    """
+    if isinstance(value, (int, float)):
+        return float(value)
+
+    value = str(value).strip().lower()
+    sign = 1
+    if value[:1] in ('e', '-'):
+        sign = -1
+        value = value[1:]
+    elif value[:1] in ('w', '+'):
+        value = value[1:]
+
+    try:
+        fields = [float(x) for x in value.split(':')]
+    except ValueError:
+        return np.nan
+
+    total = 0
+    for i, field in enumerate(fields):
+        total += field / 60 ** i
+    return sign * total
+
+
+def wrap_ha(ha):
+    """
+    Wrap hour angles in hours to the -12 to 12 range used by the TCS
+
+    :param ha: float or array of hour angles in hours
+    :return: numpy array
+    """
+    return (np.asarray(ha, dtype=float) + 12) % 24 - 12
+
+
+def hadec_to_azimuth(ha, dec, latitude):
+    """
+    Azimuth (degrees east of north) of targets from their hour angle and
+    declination.  Used as the dome position needed for each target
+
+    :param ha: array of hour angles in hours
+    :param dec: array of declinations in degrees
+    :param latitude: site latitude in degrees
+    :return: numpy array of azimuths in degrees
+    """
+    h = np.radians(np.asarray(ha, dtype=float) * 15)
+    d = np.radians(np.asarray(dec, dtype=float))
+    lat = np.radians(latitude)
+    az = np.arctan2(-np.cos(d) * np.sin(h),
+                    np.sin(d) * np.cos(lat) -
+                    np.cos(d) * np.sin(lat) * np.cos(h))
+    return np.degrees(az) % 360
+
+
+def load_history(path):
+    """
+    Read the TCS position history and convert the positions to degrees
+
+    :param path: csv file written by tcs.Telescope.record_pos
+    :return: dataframe sorted by move and time with added ha_deg and move
+             columns
+    """
+    df = pd.read_csv(path, names=HISTORY_COLUMNS, header=None,
+                     dtype={'move_id': str})
+    df['julian_date'] = pd.to_numeric(df['julian_date'], errors='coerce')
+    df['ha_deg'] = [sexagesimal_to_float(x) * 15 for x in df['telescope_ha']]
+    df['telescope_dec'] = [sexagesimal_to_float(x)
+                           for x in df['telescope_dec']]
+    df['dome_azimuth'] = pd.to_numeric(df['dome_azimuth'], errors='coerce')
+    df = df.dropna(subset=['julian_date'])
+    df = df.sort_values('julian_date').reset_index(drop=True)
+
+    # Samples without a move id are split into moves at the time gaps
+    gaps = (df['julian_date'].diff() * 86400 > MOVE_GAP).cumsum()
+    move_id = df['move_id'].fillna('')
+    df['move'] = np.where(move_id != '', move_id, 'gap' + gaps.astype(str))
+    return df.sort_values(['move', 'julian_date'],
+                          kind='stable').reset_index(drop=True)
+
+
+def extract_moves(times, positions, moves=None, circular=False,
+                  tolerance=MOVE_TOLERANCE):
+    """
+    Find the moves of one axis in a sampled position history.  A move runs
+    from the last stationary sample before the axis starts moving to the
+    first stationary sample after it stops, and never spans two recorded
+    moves.
+
+    :param times: array of julian dates
+    :param positions: array of positions in degrees
+    :param moves: array of the move each sample belongs to, samples of one
+                  move must be next to each other.  None for one move
+    :param circular: wrap differences to +/-180 degrees (dome azimuth)
+    :param tolerance: changes below this are not counted as motion
+    :return: (distances in degrees, durations in seconds) numpy arrays
+    """
+    times = np.asarray(times, dtype=float)
+    positions = np.asarray(positions, dtype=float)
+    if len(times) < 3:
+        return np.array([]), np.array([])
+
+    step = np.diff(positions)
+    if circular:
+        step = (step + 180) % 360 - 180
+    moving = np.abs(step) > tolerance
+    if moves is not None:
+        # Tracking between two moves is not part of either
+        moves = np.asarray(moves)
+        moving &= moves[1:] == moves[:-1]
+
+    # Starts and ends of each run of moving steps
+    edges = np.diff(np.concatenate(([0], moving.astype(int), [0])))
+    starts = np.flatnonzero(edges == 1)
+    ends = np.flatnonzero(edges == -1)
+
+    distances = np.array([abs(step[s:e].sum()) for s, e in zip(starts, ends)])
+    durations = (times[ends] - times[starts]) * 86400
+
+    ok = np.isfinite(distances) & (durations > 0)
+    return distances[ok], durations[ok]
+
+
+class SlewModel:
+    """
+    Time to first photon model for the P60.  Each axis (hour angle,
+    declination and dome) moves independently with a fixed start up time
+    and a constant rate, and the telescope can start observing once the
+    slowest axis has arrived and the acquisition is done.
+    """
+
+    def __init__(self, rates=None, overheads=None, acquisition=30.,
+                 latitude=33.3574):
+        """
+        :param rates: dictionary of axis: degrees per second
+        :param overheads: dictionary of axis: start up and settle seconds
+        :param acquisition: seconds from arriving on target to first photon
+        :param latitude: site latitude in degrees
+        """
+        self.rates = {'ha': 1.0, 'dec': 1.0, 'dome': 1.5}
+        self.overheads = {'ha': 10., 'dec': 10., 'dome': 10.}
+        if rates:
+            self.rates.update(rates)
+        if overheads:
+            self.overheads.update(overheads)
+        self.acquisition = acquisition
+        self.latitude = latitude
+        self.nmoves = {}
+
+    def axis_time(self, axis, distance):
+        """
+        Seconds needed to move an axis by the given distance
+
+        :param axis: name of the axis
+        :param distance: array of distances in degrees
+        :return: numpy array of seconds, zero where nothing moves
+        """
+        distance = np.abs(np.asarray(distance, dtype=float))
+        return np.where(distance > MOVE_TOLERANCE,
+                        self.overheads[axis] + distance / self.rates[axis],
+                        0.)
+
+    def cost_matrix(self, from_ha, from_dec, from_dome, to_ha, to_dec):
+        """
+        Time to first photon from every start position to every target.
+        Inputs broadcast, so a single start position gives a vector over
+        all candidates and column/row vectors give the full matrix.
+
+        :param from_ha: hour angle(s) of the start position in hours
+        :param from_dec: declination(s) of the start position in degrees
+        :param from_dome: dome azimuth(s) of the start position in degrees
+        :param to_ha: hour angles of the targets in hours
+        :param to_dec: declinations of the targets in degrees
+        :return: numpy array of seconds
+        """
+        from_ha = wrap_ha(from_ha)
+        to_ha = wrap_ha(to_ha)
+        to_dome = hadec_to_azimuth(to_ha, to_dec, self.latitude)
+
+        dome = (to_dome - np.asarray(from_dome, dtype=float) + 180) % 360 \
+            - 180
+
+        times = np.maximum.reduce(np.broadcast_arrays(
+            self.axis_time('ha', (to_ha - from_ha) * 15),
+            self.axis_time('dec', np.asarray(to_dec, dtype=float) -
+                           np.asarray(from_dec, dtype=float)),
+            self.axis_time('dome', dome)))
+        return times + self.acquisition
+
+    def fit(self, history, min_moves=5):
+        """
+        Fit the overhead and rate of each axis with a straight line of move
+        duration against distance.  Axes with too few moves keep their
+        current values.
+
+        :param history: dataframe from load_history
+        :param min_moves: minimum number of moves needed to fit an axis
+        :return: dictionary of axis: number of moves used
+        """
+        for axis, column in AXES.items():
+            distances, durations = extract_moves(history['julian_date'],
+                                                 history[column],
+                                                 history['move'],
+                                                 circular=(axis == 'dome'))
+            self.nmoves[axis] = len(distances)
+            if len(distances) < min_moves:
+                continue
+
+            slope, intercept = np.polyfit(distances, durations, 1)
+            if slope <= 0:
+                continue
+            self.rates[axis] = 1 / slope
+            self.overheads[axis] = max(intercept, 0.)
+
+        return self.nmoves
+
+    def to_dict(self):
+        return {'rates': self.rates, 'overheads': self.overheads,
+                'acquisition': self.acquisition, 'latitude': self.latitude,
+                'nmoves': self.nmoves}
+
+    def save(self, path):
+        """
+        Save the model parameters as json
+
+        :param path: file path
+        """
+        with open(path, 'w') as outfile:
+            json.dump(self.to_dict(), outfile)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Load a saved model, the default model is returned when the file
+        doesn't exist
+
+        :param path: file path
+        :return: SlewModel
+        """
+        if not path or not os.path.exists(path):
+            return cls()
+
+        with open(path) as data_file:
+            data = json.load(data_file)
+
+        model = cls(rates=data.get('rates'), overheads=data.get('overheads'),
+                    acquisition=data.get('acquisition', 30.),
+                    latitude=data.get('latitude', 33.3574))
+        model.nmoves = data.get('nmoves', {})
+        return model
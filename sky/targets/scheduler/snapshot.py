@@ -0,0 +1,169 @@
+import os
+import json
+import shutil
+import datetime
+import numpy as np
+import pandas as pd
+
+from sky.targets.scheduler.visibility import VisibilityGrid
+
+# Bump when the layout of the snapshot changes so old files are rebuilt
+SNAPSHOT_VERSION = 2
+
+# Object columns that can't be stored and are rebuilt on load
+OBJECT_COLUMNS = ['SkyCoords', 'fixed_object']
+
+# numpy kinds stored as one .npy file per column, other columns (strings,
+# the obs_seq dictionaries) go to a json file
+NPY_KINDS = 'biufcmM'
+
+
+def snapshot_path(snapshot_dir, night):
+    """
+    Directory holding the snapshot for one night
+
+    :param snapshot_dir: base snapshot directory
+    :param night: datetime or str (YYYYMMDD) of the night
+    :return: str
+    """
+    if isinstance(night, (datetime.date, datetime.datetime)):
+        night = night.strftime("%Y%m%d")
+    return os.path.join(snapshot_dir, night)
+
+
+def save_table(directory, table):
+    """
+    Write a dataframe column by column, numeric, bool and datetime columns
+    as .npy files and the rest as json lists
+
+    :param directory: existing directory to write to
+    :param table: dataframe
+    """
+    columns = []
+    json_columns = {}
+    for i, name in enumerate(table.columns):
+        values = table[name]
+        dtype = values.dtype
+        if isinstance(dtype, np.dtype) and dtype.kind in NPY_KINDS:
+            filename = 'col%03d.npy' % i
+            np.save(os.path.join(directory, filename), values.to_numpy())
+            columns.append({'name': name, 'file': filename})
+        else:
+            json_columns[name] = [None if v is None or
+                                  (np.isscalar(v) and pd.isnull(v)) else v
+                                  for v in values.tolist()]
+            columns.append({'name': name, 'file': None})
+
+    with open(os.path.join(directory, 'objects.json'), 'w') as data_file:
+        json.dump(json_columns, data_file, default=str)
+    with open(os.path.join(directory, 'columns.json'), 'w') as data_file:
+        json.dump(columns, data_file)
+
+
+def load_table(directory, mmap_mode='c'):
+    """
+    Read a dataframe written by save_table
+
+    :param directory: table directory
+    :param mmap_mode: numpy memory map mode of the .npy columns, the
+                      default copy on write mode lets the table be changed
+                      without touching the files
+    :return: dataframe
+    """
+    with open(os.path.join(directory, 'columns.json')) as data_file:
+        columns = json.load(data_file)
+    with open(os.path.join(directory, 'objects.json')) as data_file:
+        json_columns = json.load(data_file)
+
+    data = {}
+    for column in columns:
+        if column['file']:
+            data[column['name']] = np.load(
+                os.path.join(directory, column['file']), mmap_mode=mmap_mode)
+        else:
+            data[column['name']] = json_columns[column['name']]
+    return pd.DataFrame(data, columns=[c['name'] for c in columns])
+
+
+def save_snapshot(path, table, grid=None, meta=None):
+    """
+    Write the target table and visibility grid to disk.  The table is stored
+    column by column and each grid array as a separate .npy file so they
+    can be memory mapped on load.  The snapshot is written to a temporary
+    directory first and then swapped in, the previous one is renamed aside
+    until the new one is in place so a crash never leaves no snapshot.
+
+    :param path: snapshot directory
+    :param table: initialized target dataframe
+    :param grid: VisibilityGrid or None
+    :param meta: dictionary of json serializable values
+    :return: path
+    """
+    tmp = path + '.tmp'
+    old = path + '.old'
+    if os.path.exists(tmp):
+        shutil.rmtree(tmp)
+    os.makedirs(os.path.join(tmp, 'targets'))
+
+    save_table(os.path.join(tmp, 'targets'),
+               table.drop(columns=OBJECT_COLUMNS, errors='ignore'))
+
+    info = {'version': SNAPSHOT_VERSION,
+            'saved': datetime.datetime.utcnow().isoformat(),
+            'grid': grid is not None}
+    if meta:
+        info.update(meta)
+
+    if grid is not None:
+        info['resolution'] = grid.resolution
+        np.save(os.path.join(tmp, 'req_ids.npy'), np.asarray(grid.req_ids))
+        for key, values in grid.to_arrays().items():
+            np.save(os.path.join(tmp, key + '.npy'), np.asarray(values))
+
+    with open(os.path.join(tmp, 'meta.json'), 'w') as data_file:
+        json.dump(info, data_file)
+
+    if os.path.exists(path):
+        if os.path.exists(old):
+            shutil.rmtree(old)
+        os.rename(path, old)
+    os.rename(tmp, path)
+    if os.path.exists(old):
+        shutil.rmtree(old)
+    return path
+
+
+def load_snapshot(path, mmap_mode='r'):
+    """
+    Read a snapshot written by save_snapshot, or the previous one when a
+    save was interrupted before the new one was moved into place
+
+    :param path: snapshot directory
+    :param mmap_mode: numpy memory map mode for the grid arrays
+    :return: dictionary with 'meta', 'table', 'req_ids' and 'arrays' or None
+             if there is no usable snapshot
+    """
+    if not os.path.exists(path) and os.path.exists(path + '.old'):
+        path = path + '.old'
+
+    meta_file = os.path.join(path, 'meta.json')
+    if not os.path.exists(meta_file):
+        return None
+
+    with open(meta_file) as data_file:
+        meta = json.load(data_file)
+
+    if meta.get('version') != SNAPSHOT_VERSION:
+        return None
+
+    snapshot = {'meta': meta,
+                'table': load_table(os.path.join(path, 'targets')),
+                'req_ids': None, 'arrays': None}
+
+    if meta.get('grid'):
+        snapshot['req_ids'] = np.load(os.path.join(path, 'req_ids.npy')).tolist()
+        snapshot['arrays'] = {}
+        for key in VisibilityGrid.ARRAYS:
+            snapshot['arrays'][key] = np.load(os.path.join(path, key + '.npy'),
+                                              mmap_mode=mmap_mode)
+    return snapshot
@@ -0,0 +1,385 @@
+import copy
+import numpy as np
+from astropy.time import Time, TimeDelta
+from astropy.coordinates import AltAz, Longitude, get_body
+import astropy.units as u
+
+from sky.targets.scheduler import ephemeris
+
+
+# Bit set in a rejection mask when a constraint fails over the window
+CONSTRAINT_BITS = {'altitude': 1, 'airmass': 2, 'moon_sep': 4, 'ha': 8}
+
+
+def describe_mask(mask):
+    """
+    Names of the constraints that failed in a rejection mask
+
+    :param mask: int rejection mask
+    :return: list of constraint names
+    """
+    return [name for name, bit in CONSTRAINT_BITS.items() if mask & bit]
+
+
+def _jd(times):
+    """
+    Julian date(s) from an astropy Time, a datetime or float julian dates
+    """
+    if isinstance(times, Time):
+        return times.jd
+    if isinstance(times, (float, int, np.ndarray)):
+        return np.asarray(times, dtype=float)
+    return Time(times).jd
+
+
+def angular_separation(alt1, az1, alt2, az2):
+    """
+    Angular distance between two sets of horizontal coordinates.  All inputs
+    are in degrees and broadcast against each other
+
+    :return: numpy array of separations in degrees
+    """
+    alt1, az1, alt2, az2 = [np.radians(x) for x in (alt1, az1, alt2, az2)]
+    cos_sep = (np.sin(alt1) * np.sin(alt2) +
+               np.cos(alt1) * np.cos(alt2) * np.cos(az1 - az2))
+    return np.degrees(np.arccos(np.clip(cos_sep, -1, 1)))
+
+
+class VisibilityGrid:
+    """
+    Precomputed (targets x time-bins) arrays of altitude, airmass, moon
+    separation and hour angle for a single night.  Observability checks
+    become array lookups instead of repeated astroplan evaluations.
+    """
+
+    def __init__(self, start_time, end_time, location, resolution=0.1):
+        """
+        :param start_time: start of the night (astropy Time or datetime)
+        :param end_time: end of the night (astropy Time or datetime)
+        :param location: EarthLocation of the observatory
+        :param resolution: time bin size in hours
+        """
+        self.start_time = Time(start_time)
+        self.end_time = Time(end_time)
+        self.location = location
+        self.resolution = resolution
+        self.step = resolution / 24.
+
+        nbins = int(np.ceil((self.end_time.jd - self.start_time.jd) /
+                            self.step)) + 1
+        self.times = self.start_time + TimeDelta(np.arange(nbins) *
+                                                 resolution * 3600,
+                                                 format='sec')
+        self.jd = self.times.jd
+        self.frame = AltAz(obstime=self.times, location=self.location)
+
+        moon = get_body('moon', self.times, location=self.location)
+        moon = moon.transform_to(self.frame)
+        self.moon_alt = moon.alt.to_value(u.deg)
+        self.moon_az = moon.az.to_value(u.deg)
+        self.lst = self.times.sidereal_time('apparent',
+                                            longitude=self.location.lon)
+
+        self.req_ids = []
+        self.index = {}
+        self.alt = np.empty((0, nbins))
+        self.airmass = np.empty((0, nbins))
+        self.moon_sep = np.empty((0, nbins))
+        self.ha = np.empty((0, nbins))
+
+    # Arrays needed to restore a grid without recomputing it
+    ARRAYS = ['jd', 'moon_alt', 'moon_az', 'lst', 'alt', 'airmass',
+              'moon_sep', 'ha']
+
+    def to_arrays(self):
+        """
+        Plain numpy arrays describing the grid, used for snapshots
+
+        :return: dictionary of numpy arrays
+        """
+        arrays = {'jd': self.jd, 'moon_alt': self.moon_alt,
+                  'moon_az': self.moon_az,
+                  'lst': self.lst.to_value(u.hourangle),
+                  'alt': self.alt, 'airmass': self.airmass,
+                  'moon_sep': self.moon_sep, 'ha': self.ha}
+        return arrays
+
+    @classmethod
+    def from_arrays(cls, arrays, req_ids, location, resolution=0.1):
+        """
+        Restore a grid from the output of to_arrays without recomputing any
+        coordinate transforms
+
+        :param arrays: dictionary of numpy arrays (may be memory mapped)
+        :param req_ids: request ids of the grid rows
+        :param location: EarthLocation of the observatory
+        :param resolution: time bin size in hours
+        :return: VisibilityGrid
+        """
+        grid = cls.__new__(cls)
+        grid.location = location
+        grid.resolution = resolution
+        grid.step = resolution / 24.
+        grid.jd = np.asarray(arrays['jd'])
+        grid.times = Time(grid.jd, format='jd')
+        grid.start_time = grid.times[0]
+        grid.end_time = grid.times[-1]
+        grid.frame = AltAz(obstime=grid.times, location=location)
+        grid.moon_alt = np.asarray(arrays['moon_alt'])
+        grid.moon_az = np.asarray(arrays['moon_az'])
+        grid.lst = Longitude(np.asarray(arrays['lst']) * u.hourangle)
+
+        grid.req_ids = list(req_ids)
+        grid.index = {r: i for i, r in enumerate(grid.req_ids)}
+        grid.alt = arrays['alt']
+        grid.airmass = arrays['airmass']
+        grid.moon_sep = arrays['moon_sep']
+        grid.ha = arrays['ha']
+        return grid
+
+    def copy(self):
+        """
+        Copy of the grid sharing the arrays.  add_targets and remove_targets
+        replace the arrays instead of changing them, so the copy stays
+        consistent while the original gains or loses targets
+
+        :return: VisibilityGrid
+        """
+        grid = copy.copy(self)
+        grid.req_ids = list(self.req_ids)
+        grid.index = dict(self.index)
+        return grid
+
+    def __len__(self):
+        return len(self.req_ids)
+
+    def __contains__(self, req_id):
+        return req_id in self.index
+
+    def covers(self, start, end=None):
+        """
+        Check that a time window falls inside the grid
+
+        :param start: astropy Time or julian date
+        :param end: astropy Time, julian date or None
+        :return: bool
+        """
+        if end is None:
+            end = start
+        return bool(self.jd[0] <= np.min(_jd(start)) and
+                    np.max(_jd(end)) <= self.jd[-1] + self.step)
+
+    def add_targets(self, req_ids, ra, dec):
+        """
+        Compute the grid rows for new targets and append them.  Targets
+        already in the grid are skipped.
+
+        :param req_ids: list of request ids
+        :param ra: array of right ascensions in degrees
+        :param dec: array of declinations in degrees
+        :return: number of targets added
+        """
+        req_ids = list(req_ids)
+        ra = np.asarray(ra, dtype=float)
+        dec = np.asarray(dec, dtype=float)
+
+        keep = np.array([r not in self.index for r in req_ids], dtype=bool)
+        if not keep.any():
+            return 0
+
+        req_ids = [r for r, k in zip(req_ids, keep) if k]
+        coords = ephemeris.target_coords(ra[keep], dec[keep])
+
+        altaz = coords.reshape((len(coords), 1)).transform_to(self.frame)
+        alt = altaz.alt.to_value(u.deg)
+        az = altaz.az.to_value(u.deg)
+
+        with np.errstate(divide='ignore'):
+            airmass = np.where(alt > 0, 1 / np.sin(np.radians(alt)), np.inf)
+
+        moon_sep = angular_separation(alt, az, self.moon_alt, self.moon_az)
+        ha = (self.lst[np.newaxis, :] -
+              coords.ra[:, np.newaxis]).wrap_at(360 * u.deg)
+
+        for r in req_ids:
+            self.index[r] = len(self.req_ids)
+            self.req_ids.append(r)
+
+        self.alt = np.vstack([self.alt, alt])
+        self.airmass = np.vstack([self.airmass, airmass])
+        self.moon_sep = np.vstack([self.moon_sep, moon_sep])
+        self.ha = np.vstack([self.ha, ha.to_value(u.hourangle)])
+        return len(req_ids)
+
+    def remove_targets(self, req_ids):
+        """
+        Drop targets from the grid
+
+        :param req_ids: list of request ids
+        :return: number of targets removed
+        """
+        drop = set(r for r in req_ids if r in self.index)
+        if not drop:
+            return 0
+
+        keep = np.array([r not in drop for r in self.req_ids], dtype=bool)
+        self.req_ids = [r for r in self.req_ids if r not in drop]
+        self.index = {r: i for i, r in enumerate(self.req_ids)}
+        self.alt = self.alt[keep]
+        self.airmass = self.airmass[keep]
+        self.moon_sep = self.moon_sep[keep]
+        self.ha = self.ha[keep]
+        return len(drop)
+
+    def rows(self, req_ids):
+        """
+        Row numbers for a list of request ids, -1 if not in the grid
+
+        :param req_ids: list of request ids
+        :return: numpy int array
+        """
+        return np.array([self.index.get(r, -1) for r in req_ids], dtype=int)
+
+    def bins(self, times):
+        """
+        Time bin index for each input time, clipped to the grid
+
+        :param times: astropy Time or julian dates, scalar or array
+        :return: numpy int array
+        """
+        idx = np.floor((np.atleast_1d(_jd(times)) - self.jd[0]) / self.step)
+        return np.clip(idx, 0, len(self.jd) - 1).astype(int)
+
+    def constraint_mask(self, altitude_min=15, airmass=(1, 2.8),
+                        moon_sep=(30, 180), ha=(18.75, 5.75),
+                        do_airmass=True, do_moon_sep=True):
+        """
+        Evaluate each constraint on the full grid
+
+        :return: dictionary of boolean (targets x time-bins) arrays
+        """
+        masks = {'altitude': self.alt >= altitude_min}
+        if do_airmass:
+            masks['airmass'] = ((self.airmass >= airmass[0]) &
+                                (self.airmass <= airmass[1]))
+        if do_moon_sep:
+            masks['moon_sep'] = ((self.moon_sep >= moon_sep[0]) &
+                                 (self.moon_sep <= moon_sep[1]))
+        if ha:
+            masks['ha'] = ~((self.ha < ha[0]) & (self.ha > ha[1]))
+        return masks
+
+    def interpolate(self, values, rows, times_jd):
+        """
+        Linearly interpolate a grid quantity in time
+
+        :param values: (targets x time-bins) array such as self.alt
+        :param rows: row index of each candidate, -1 for targets not gridded
+        :param times_jd: julian date (scalar or one per candidate)
+        :return: numpy array with NaN for targets not in the grid
+        """
+        rows = np.asarray(rows)
+        if len(values) == 0:
+            return np.full(rows.shape, np.nan)
+
+        pos = (np.broadcast_to(times_jd, rows.shape) - self.jd[0]) / self.step
+        i0 = np.clip(np.floor(pos), 0, len(self.jd) - 2).astype(int)
+        w = np.clip(pos - i0, 0, 1)
+        safe = np.where(rows >= 0, rows, 0)
+        out = values[safe, i0] * (1 - w) + values[safe, i0 + 1] * w
+        return np.where(rows >= 0, out, np.nan)
+
+    @staticmethod
+    def failure_table(mask):
+        """
+        Cumulative count of failed bins along the time axis, with a leading
+        column of zeros so any window can be checked with one subtraction
+
+        :param mask: boolean (targets x time-bins) array
+        :return: int array of shape (targets, time-bins + 1)
+        """
+        failed = np.zeros((mask.shape[0], mask.shape[1] + 1), dtype=int)
+        np.cumsum(~mask, axis=1, out=failed[:, 1:])
+        return failed
+
+    @staticmethod
+    def window_all(table, rows, start_bins, end_bins):
+        """
+        For each row check that no bin from start to end (inclusive) failed
+
+        :param table: output of failure_table
+        :param rows: row index of each candidate
+        :param start_bins: first bin of each candidate window
+        :param end_bins: last bin of each candidate window
+        :return: boolean array, one value per candidate
+        """
+        counts = table[rows, end_bins + 1] - table[rows, start_bins]
+        return counts == 0
+
+    def failure_tables(self, **constraints):
+        """
+        Failure tables for every constraint, built once and reused for any
+        number of windows
+
+        :param constraints: keyword arguments passed to constraint_mask
+        :return: dictionary of constraint name: failure_table
+        """
+        return {name: self.failure_table(mask) for name, mask in
+                self.constraint_mask(**constraints).items()}
+
+    @classmethod
+    def rejection_from_tables(cls, tables, rows, start_bins, end_bins):
+        """
+        Evaluate every constraint over each window and combine the failures
+        into a bitmask (see CONSTRAINT_BITS)
+
+        :param tables: output of failure_tables
+        :param rows: row index of each candidate
+        :param start_bins: first bin of each candidate window
+        :param end_bins: last bin of each candidate window
+        :return: int array of rejection masks, 0 means observable
+        """
+        masks = np.zeros(np.shape(rows), dtype=int)
+        for name, table in tables.items():
+            failed = ~cls.window_all(table, rows, start_bins, end_bins)
+            masks = masks | (failed * CONSTRAINT_BITS[name])
+        return masks
+
+    def rejection_masks(self, req_ids, start, end, **constraints):
+        """
+        Evaluate all constraints for all candidates in one pass
+
+        :param req_ids: list of request ids
+        :param start: astropy Time for the start of the observations
+        :param end: astropy Time (scalar or one per target) for the end
+        :param constraints: keyword arguments passed to constraint_mask
+        :return: (int array of rejection masks, bool array of the targets
+                 that are in the grid)
+        """
+        rows = self.rows(req_ids)
+        masks = np.zeros(len(rows), dtype=int)
+        valid = rows >= 0
+        if not valid.any():
+            return masks, valid
+
+        start_bins = np.broadcast_to(self.bins(start), rows.shape)[valid]
+        end_bins = np.broadcast_to(self.bins(end), rows.shape)[valid]
+
+        masks[valid] = self.rejection_from_tables(
+            self.failure_tables(**constraints), rows[valid], start_bins,
+            end_bins)
+        return masks, valid
+
+    def is_observable(self, req_ids, start, end, **constraints):
+        """
+        Array equivalent of astroplan.is_observable for a list of targets
+
+        :param req_ids: list of request ids
+        :param start: astropy Time for the start of the observations
+        :param end: astropy Time (scalar or one per target) for the end
+        :param constraints: keyword arguments passed to constraint_mask
+        :return: boolean numpy array, False for targets not in the grid
+        """
+        masks, valid = self.rejection_masks(req_ids, start, end,
+                                            **constraints)
+        return valid & (masks == 0)
@@ -0,0 +1,366 @@
+"""
+asyncio clients of the command servers.
+
+The same request ids, encodings and telemetry as message_client.Connection
+over an asyncio stream, so a sequence can have several commands out at
+once on one connection and wait for them together:
+
+    async with AsyncObservatory() as ocs, AsyncCamera(port=5002) as rc:
+        await asyncio.gather(ocs.tel_move(ra=ra, dec=dec),
+                             ocs.move_stage(3.5, 1),
+                             ocs.arclamp('hg', 'ON'))
+        ret = await rc.take_image(exptime=30)
+
+Every command method is a coroutine returning the same dictionary as the
+blocking client, so errors come back as {'elaptime':..., 'error':...}
+rather than as exceptions.
+"""
+import time
+import json
+import asyncio
+import logging
+import functools
+import itertools
+
+from utils.framing import encode_frame
+from utils.command_server import read_frame_async
+from utils import codec
+
+logger = logging.getLogger(__name__)
+
+
+def async_command(build, **options):
+    """
+    AsyncClient method sending the command made by a request builder, the
+    asyncio side of message_client.client_command.  Both use the same
+    builder so the blocking and asyncio clients send the same parameters.
+
+    :param build: function of the command arguments returning
+                  (command, parameters)
+    :param options: send_command keyword arguments with their defaults,
+                    callers can override them by keyword
+    :return: coroutine method
+    """
+    @functools.wraps(build)
+    async def method(self, *args, **kwargs):
+        send = {key: kwargs.pop(key, value) for key, value in options.items()}
+        cmd, parameters = build(*args, **kwargs)
+        return await self.send_command(cmd=cmd, parameters=parameters, **send)
+    return method
+
+
+class AsyncConnection:
+    """
+    One asyncio connection to a command server.  A reader task hands each
+    reply to the request with the same id and keeps the latest snapshot of
+    every subscribed telemetry topic.
+    """
+
+    def __init__(self, address, port, encodings=None):
+        """
+        :param address: host name of the server
+        :param port: int for tcp port communication
+        :param encodings: encodings to offer the server in order of
+                          preference, by default all the installed ones
+        """
+        self.address = address
+        self.port = port
+        self.encodings = encodings if encodings else codec.ENCODINGS
+        self.codec = codec.JSON
+        self.reader = None
+        self.writer = None
+        self.reader_task = None
+        self.ids = itertools.count(1)
+        self.futures = {}
+        self.closed = None
+        # Latest published snapshot of each subscribed telemetry topic
+        self.telemetry = {}
+        # Set every time a snapshot arrives, for wait_telemetry
+        self.telemetry_event = asyncio.Event()
+
+    async def connect(self, timeout=10):
+        """
+        Open the connection and agree on the payload encoding
+
+        :param timeout: seconds to wait for the server
+        """
+        self.reader, self.writer = await asyncio.wait_for(
+            asyncio.open_connection(self.address, self.port), timeout)
+        try:
+            await asyncio.wait_for(self.negotiate(), timeout)
+        except Exception:
+            self.writer.close()
+            raise
+        self.reader_task = asyncio.ensure_future(self._read_replies())
+        return self
+
+    async def negotiate(self):
+        if self.encodings == ['json']:
+            return
+
+        self.writer.write(encode_frame(json.dumps(
+            {'command': 'ENCODING',
+             'parameters': {'encodings': self.encodings}})))
+        await self.writer.drain()
+        payload = await read_frame_async(self.reader)
+        if payload is None:
+            raise ConnectionError('Connection closed by the server')
+        reply = json.loads(payload.decode('utf-8'))
+        # Servers that don't know the command keep talking json
+        if isinstance(reply, dict) and reply.get('data') in self.encodings:
+            self.codec = codec.get_codec(reply['data'])
+
+    async def _read_replies(self):
+        reason = 'Connection closed by the server'
+        try:
+            while True:
+                payload = await read_frame_async(self.reader)
+                if payload is None:
+                    break
+                self._dispatch(self.codec.decode(payload))
+        except asyncio.CancelledError:
+            reason = 'Connection closed'
+        except Exception as e:
+            reason = str(e)
+
+        self.closed = reason
+        for future in self.futures.values():
+            if not future.done():
+                future.set_result({'error': reason})
+
+    def _dispatch(self, reply):
+        if isinstance(reply, dict) and 'topic' in reply and 'id' not in reply:
+            self.telemetry[reply['topic']] = reply
+            self.telemetry_event.set()
+            self.telemetry_event.clear()
+            return
+
+        request_id = reply.get('id') if isinstance(reply, dict) else None
+        if request_id is None:
+            # Servers without request ids answer in order
+            waiting = [f for f in self.futures.values() if not f.done()]
+            future = waiting[0] if waiting else None
+        else:
+            future = self.futures.get(request_id)
+
+        if future is None or future.done():
+            logger.warning("Dropping reply to unknown request %s", request_id)
+            return
+        future.set_result(reply)
+
+    async def submit(self, cmd="", parameters=None):
+        """
+        Send a command without waiting for the reply
+
+        :return: asyncio future of the reply dictionary
+        """
+        if self.closed:
+            raise ConnectionError(self.closed)
+
+        request_id = next(self.ids)
+        request = {'command': cmd, 'id': request_id}
+        if parameters:
+            request['parameters'] = parameters
+
+        future = asyncio.get_running_loop().create_future()
+        self.futures[request_id] = future
+        future.add_done_callback(
+            lambda f: self.futures.pop(request_id, None))
+        try:
+            self.writer.write(encode_frame(self.codec.encode(request)))
+            await self.writer.drain()
+        except Exception:
+            self.futures.pop(request_id, None)
+            raise
+        return future
+
+    async def send_command(self, cmd="", parameters=None, timeout=300,
+                           start=0):
+        """
+        Send a command and wait for its reply
+
+        :param cmd: string command to send to the server
+        :param parameters: dictionary of parameters associated with cmd
+        :param timeout: seconds to wait for the reply, None waits forever
+        :param start: Unix timestamp float used for the elaptime of errors
+        :return: reply dictionary
+        """
+        try:
+            future = await self.submit(cmd, parameters)
+        except Exception as e:
+            return {'elaptime': time.time() - start, 'error': str(e)}
+
+        try:
+            return await asyncio.wait_for(future, timeout or None)
+        except asyncio.TimeoutError:
+            return {'elaptime': time.time() - start,
+                    'error': 'timed out waiting for %s' % cmd}
+
+    def latest(self, topic, max_age=None):
+        """
+        Latest published snapshot of a subscribed topic, see
+        message_client.Connection.latest
+        """
+        snapshot = self.telemetry.get(topic)
+        if snapshot is None:
+            return None
+        if max_age is not None and time.time() - snapshot['time'] > max_age:
+            return None
+        return snapshot
+
+    async def close(self):
+        if self.reader_task is not None:
+            self.reader_task.cancel()
+            try:
+                await self.reader_task
+            except asyncio.CancelledError:
+                pass
+        if self.writer is not None:
+            self.writer.close()
+        self.closed = self.closed or 'Connection closed'
+
+
+class AsyncClient:
+    """
+    Base of the asyncio clients.  The connection is opened on the first
+    command and opened again after it drops.  A command in the idempotent
+    list whose connection dropped while waiting for the reply is sent once
+    more, as ConnectionPool does.
+    """
+
+    IDEMPOTENT = []
+
+    def __init__(self, address='localhost', port=None, encodings=None,
+                 retries=1):
+        """
+        :param address: host name of the server
+        :param port: int for tcp port communication
+        :param encodings: encodings offered to the server
+        :param retries: number of times a failed command is sent again
+        """
+        self.address = address
+        self.port = port
+        self.encodings = encodings
+        self.retries = retries
+        self.idempotent = set(self.IDEMPOTENT) | {'PING'}
+        self.connection = None
+        self.subscription = None
+        self._connect_lock = None
+
+    async def get_connection(self):
+        """
+        :return: AsyncConnection, connected again if it was closed
+        """
+        if self._connect_lock is None:
+            self._connect_lock = asyncio.Lock()
+        async with self._connect_lock:
+            if self.connection is None or self.connection.closed:
+                connection = AsyncConnection(self.address, self.port,
+                                             encodings=self.encodings)
+                await connection.connect()
+                if self.subscription is not None:
+                    await connection.send_command('SUBSCRIBE',
+                                                  self.subscription,
+                                                  timeout=10)
+                self.connection = connection
+        return self.connection
+
+    async def send_command(self, cmd="", parameters=None, timeout=300):
+        """
+        Send a command to the server and wait for the reply
+
+        :param cmd: string command to send to the server
+        :param parameters: dictionary of parameters associated with cmd
+        :param timeout: timeout in seconds for waiting for the reply
+        :return: reply dictionary
+        """
+        start = time.time()
+        ret = None
+        for attempt in range(self.retries + 1):
+            try:
+                connection = await self.get_connection()
+            except Exception as e:
+                ret = {'elaptime': time.time() - start, 'error': str(e)}
+                continue
+
+            try:
+                future = await connection.submit(cmd, parameters)
+            except Exception as e:
+                # Never reached the server, safe to send again
+                await connection.close()
+                ret = {'elaptime': time.time() - start, 'error': str(e)}
+                continue
+
+            try:
+                ret = await asyncio.wait_for(future, timeout or None)
+            except asyncio.TimeoutError:
+                return {'elaptime': time.time() - start,
+                        'error': 'timed out waiting for %s' % cmd}
+
+            if not connection.closed or cmd.upper() not in self.idempotent:
+                return ret
+            logger.warning("Connection to %s:%s dropped during %s, sending "
+                           "it again", self.address, self.port, cmd)
+        return ret
+
+    async def subscribe(self, topics=None):
+        """
+        Have the server push every new snapshot of the topics to this
+        client.  The subscription is renewed when the connection is opened
+        again.
+        :param topics: list of topics, by default all of them
+        """
+        self.subscription = {'topics': topics} if topics else {}
+        ret = await self.send_command('SUBSCRIBE', self.subscription,
+                                      timeout=10)
+        # The server replies with the topics, so a later unsubscribe from
+        # some of them knows what is left
+        if isinstance(ret.get('data'), list):
+            self.subscription = {'topics': ret['data']}
+        return ret
+
+    async def unsubscribe(self, topics=None):
+        """
+        Stop the pushes of some topics, or of all of them by default.  The
+        rest stay subscribed after the connection is opened again.
+        """
+        if not topics:
+            self.subscription = None
+        elif self.subscription is not None:
+            remaining = [t for t in self.subscription.get('topics') or []
+                         if t not in topics]
+            self.subscription = {'topics': remaining} if remaining else None
+        return await self.send_command('UNSUBSCRIBE',
+                                       {'topics': topics} if topics else None,
+                                       timeout=10)
+
+    def latest(self, topic, max_age=None):
+        """
+        Last snapshot of a subscribed topic pushed to this client
+
+        :return: snapshot dictionary or None
+        """
+        if self.connection is None:
+            return None
+        return self.connection.latest(topic, max_age)
+
+    async def check_socket(self):
+        return await self.send_command(cmd="PING", timeout=10)
+
+    async def get_metrics(self, command=None, reset=False):
+        parameters = {
+            'command': command,
+            'reset': reset
+        }
+        return await self.send_command(cmd="METRICS", parameters=parameters)
+
+    async def close(self):
+        if self.connection is not None:
+            await self.connection.close()
+
+    async def __aenter__(self):
+        await self.get_connection()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
@@ -0,0 +1,149 @@
+"""
+Encodings for the payload of the server frames.
+
+Connections start out sending json.  A client can send an ENCODING request
+listing the encodings it understands, the server answers in json with the
+first one it also supports and both ends use it for the rest of the
+connection.  msgpack is used when it is installed:
+
+    {"command": "ENCODING", "parameters": {"encodings": ["msgpack", "json"]}}
+
+With msgpack, numpy arrays are sent as their raw bytes with the dtype and
+shape (extension type ARRAY_EXT) and come back out as numpy arrays, so
+catalogs, centroids and focus curves don't travel as lists of floats.  In
+json they are sent as lists.
+"""
+import json
+import struct
+import numpy as np
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# msgpack extension type code of numpy arrays
+ARRAY_EXT = 1
+
+# Number of dimensions then the dtype string length
+ARRAY_HEADER = struct.Struct('!BB')
+
+
+def encode_array(array):
+    """
+    Pack a numpy array as dtype, shape and raw C ordered bytes
+
+    :param array: numpy array of a numeric dtype
+    :return: bytes
+    """
+    array = np.ascontiguousarray(array)
+    dtype = array.dtype.str.encode('ascii')
+    return (ARRAY_HEADER.pack(array.ndim, len(dtype)) + dtype +
+            struct.pack('!%dQ' % array.ndim, *array.shape) +
+            array.tobytes())
+
+
+def decode_array(data):
+    """
+    Inverse of encode_array
+
+    :param data: bytes
+    :return: numpy array, read only when it points into data
+    """
+    ndim, dtype_len = ARRAY_HEADER.unpack_from(data)
+    offset = ARRAY_HEADER.size
+    dtype = np.dtype(data[offset:offset + dtype_len].decode('ascii'))
+    offset += dtype_len
+    shape = struct.unpack_from('!%dQ' % ndim, data, offset)
+    offset += 8 * ndim
+    return np.frombuffer(data, dtype=dtype, offset=offset).reshape(shape)
+
+
+def _json_default(obj):
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    if isinstance(obj, np.generic):
+        return obj.item()
+    if isinstance(obj, bytes):
+        return obj.decode('utf-8', errors='replace')
+    raise TypeError("%s is not json serializable" % type(obj).__name__)
+
+
+def _msgpack_default(obj):
+    if isinstance(obj, np.ndarray):
+        if obj.dtype.kind in 'biufc':
+            return msgpack.ExtType(ARRAY_EXT, encode_array(obj))
+        return obj.tolist()
+    if isinstance(obj, np.generic):
+        return obj.item()
+    raise TypeError("%s can't be packed" % type(obj).__name__)
+
+
+def _msgpack_ext_hook(code, data):
+    if code == ARRAY_EXT:
+        return decode_array(data)
+    return msgpack.ExtType(code, data)
+
+
+class JSONCodec:
+    name = 'json'
+
+    @staticmethod
+    def encode(obj):
+        """
+        :param obj: python object, or a str that is already json
+        :return: bytes
+        """
+        if isinstance(obj, str):
+            return obj.encode('utf-8')
+        return json.dumps(obj, default=_json_default).encode('utf-8')
+
+    @staticmethod
+    def decode(payload):
+        return json.loads(payload.decode('utf-8'))
+
+
+class MsgpackCodec:
+    name = 'msgpack'
+
+    @staticmethod
+    def encode(obj):
+        return msgpack.packb(obj, default=_msgpack_default,
+                             use_bin_type=True)
+
+    @staticmethod
+    def decode(payload):
+        return msgpack.unpackb(payload, ext_hook=_msgpack_ext_hook,
+                               raw=False, strict_map_key=False)
+
+
+JSON = JSONCodec()
+
+CODECS = {'json': JSON}
+if msgpack is not None:
+    CODECS['msgpack'] = MsgpackCodec()
+
+# Encodings this side supports, most compact first
+ENCODINGS = [name for name in ['msgpack', 'json'] if name in CODECS]
+
+
+def get_codec(name):
+    """
+    :param name: encoding name
+    :return: codec with encode and decode methods
+    """
+    return CODECS[name]
+
+
+def negotiate(offered):
+    """
+    Pick the encoding for a connection
+
+    :param offered: list of encodings the client supports, in the order it
+                    prefers them
+    :return: name of the first one supported here, 'json' if none are
+    """
+    for name in offered or []:
+        if name in CODECS:
+            return name
+    return 'json'
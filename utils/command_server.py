@@ -0,0 +1,501 @@
+import os
+import json
+import time
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from utils.framing import HEADER, MAX_FRAME_SIZE, FrameError, encode_frame
+from utils.message_server import response_handler, error_handler
+from utils import codec
+from utils.metrics import Metrics
+
+
+async def read_frame_async(reader):
+    """
+    Read one length prefixed frame from an asyncio stream
+
+    :param reader: asyncio.StreamReader
+    :return: payload bytes, or None when the connection was closed cleanly
+             between frames
+    """
+    try:
+        header = await reader.readexactly(HEADER.size)
+    except asyncio.IncompleteReadError as e:
+        if e.partial:
+            raise FrameError("Connection closed inside a frame header")
+        return None
+
+    size = HEADER.unpack(header)[0]
+    if size > MAX_FRAME_SIZE:
+        raise FrameError("Frame of %s bytes is larger than the %s limit" %
+                         (size, MAX_FRAME_SIZE))
+    try:
+        return await reader.readexactly(size)
+    except asyncio.IncompleteReadError as e:
+        raise FrameError("Connection closed after %s of %s bytes" %
+                         (len(e.partial), size))
+
+
+class Command:
+    """A registered server command"""
+
+    def __init__(self, name, func, timeout=None, pool='default',
+                 blocking=True, group=None, session=False):
+        """
+        :param name: command name, matched case insensitively
+        :param func: callable taking the command parameters as keyword
+                     arguments
+        :param timeout: seconds before the client is sent a timeout error.
+                        Either a number, None for no limit or a callable
+                        that returns one of those from the parameters
+        :param pool: name of the worker pool blocking commands run in
+        :param blocking: False for commands that return immediately, they
+                         are run directly on the event loop.  Coroutine
+                         functions are awaited on the loop
+        :param group: device the command talks to, either a name or a
+                      callable that returns one from the parameters.
+                      Commands of a BATCH in the same group are run one
+                      after the other, by default the pool is the group
+        :param session: pass the Session of the connection the request came
+                        in on as the 'session' keyword argument
+        """
+        self.name = name.upper()
+        self.func = func
+        self.timeout = timeout
+        self.pool = pool
+        self.blocking = blocking
+        self.group = group
+        self.session = session
+
+    def get_timeout(self, parameters):
+        if callable(self.timeout):
+            return self.timeout(parameters)
+        return self.timeout
+
+    def get_group(self, parameters):
+        if callable(self.group):
+            return self.group(parameters)
+        return self.group if self.group else self.pool
+
+
+class Session:
+    """
+    One client connection.  Replies and published messages are written
+    through it so frames written by concurrent tasks are never interleaved.
+    """
+
+    # Published messages are dropped for clients with this many bytes
+    # already waiting to be sent
+    MAX_BACKLOG = 1024 * 1024
+
+    def __init__(self, writer):
+        self.writer = writer
+        self.address = writer.get_extra_info('peername')
+        self.write_lock = asyncio.Lock()
+        self.on_close = []
+        self.closed = False
+        # Every connection starts in json until an ENCODING request
+        self.codec = codec.JSON
+
+    def encode(self, obj):
+        """
+        Encode a message for this connection in a single step
+
+        :param obj: reply dictionary
+        :return: framed bytes
+        """
+        return encode_frame(self.codec.encode(obj))
+
+    async def send(self, frame):
+        """
+        Write one encoded frame
+
+        :param frame: bytes from encode_frame
+        """
+        async with self.write_lock:
+            self.writer.write(frame)
+            await self.writer.drain()
+
+    def publish(self, frame):
+        """
+        Queue a frame that the client didn't ask for, slow clients miss
+        messages instead of holding up the publisher
+
+        :param frame: bytes from encode_frame
+        :return: False when the frame was dropped
+        """
+        if self.closed or self.writer.transport.get_write_buffer_size() > \
+                self.MAX_BACKLOG:
+            return False
+        asyncio.ensure_future(self._publish(frame))
+        return True
+
+    async def _publish(self, frame):
+        try:
+            await self.send(frame)
+        except ConnectionError:
+            pass
+
+    def close(self):
+        self.closed = True
+        for callback in self.on_close:
+            callback(self)
+        self.writer.close()
+
+
+class CommandServer:
+    """
+    asyncio socket server shared by the cam, ocs, sky and sanity servers.
+
+    Commands are registered in a table instead of being matched in an
+    if/elif chain.  Each connection is served by a coroutine, so idle
+    pollers cost no threads, and blocking hardware calls run in bounded
+    thread pools, one per device, so a slow device can't starve the rest.
+    Requests without an 'id' are answered in order, one at a time.
+    Requests with an 'id' are run as soon as they arrive and answered when
+    they finish, with the id echoed in the reply, so a client can have
+    several commands outstanding on one connection and match the replies
+    as they come back (a STATUS can be answered while a TAKE_IMAGE is
+    still exposing).
+    """
+
+    def __init__(self, hostname, port, logger=None, default_timeout=300,
+                 pools=None, stop_file=None, metrics_file=None,
+                 metrics_interval=900):
+        """
+        :param hostname: str for host to run the server on
+        :param port: int for tcp port communication
+        :param logger: logger for requests and responses
+        :param default_timeout: timeout for commands registered without one
+        :param pools: dictionary of pool name: number of worker threads, a
+                      'default' pool with 4 workers is always available
+        :param stop_file: the server shuts down when this file exists
+        :param metrics_file: json lines file the command metrics are
+                             appended to
+        :param metrics_interval: seconds between writes of the metrics
+        """
+        self.hostname = hostname
+        self.port = port
+        self.logger = logger if logger else logging.getLogger(__name__)
+        self.default_timeout = default_timeout
+        self.stop_file = stop_file
+        self.commands = {}
+        self.pool_sizes = {'default': 4}
+        if pools:
+            self.pool_sizes.update(pools)
+        self.pools = {}
+        self.server = None
+        # Coroutine functions run as background tasks while serving
+        self.background = []
+
+        self.metrics = Metrics()
+        self.metrics_file = metrics_file
+        self.metrics_interval = metrics_interval
+        if metrics_file and metrics_interval:
+            self.background.append(self._dump_metrics)
+
+        self.register('PING', self.ping, blocking=False)
+        self.register('BATCH', self.batch, blocking=False, timeout=None)
+        self.register('METRICS', self.get_metrics, blocking=False)
+
+    def register(self, name, func, timeout=-1, pool='default',
+                 blocking=True, group=None, session=False):
+        """
+        Add a command to the table, see Command for the arguments.  A
+        timeout of -1 uses the server default.
+        """
+        if timeout == -1:
+            timeout = self.default_timeout
+        if pool not in self.pool_sizes:
+            self.pool_sizes[pool] = 1
+        self.commands[name.upper()] = Command(name, func, timeout=timeout,
+                                              pool=pool, blocking=blocking,
+                                              group=group, session=session)
+
+    def ping(self):
+        return {'data': 'PONG'}
+
+    def get_metrics(self, command=None, reset=False):
+        """
+        Latency histograms, counts and error counts of the commands run
+        since the server started or the metrics were last reset
+
+        :param command: only return this command
+        :param reset: start counting again, for this command only when one
+                      is given
+        """
+        return {'data': self.metrics.snapshot(command=command, reset=reset)}
+
+    async def _dump_metrics(self):
+        while True:
+            await asyncio.sleep(self.metrics_interval)
+            line = dict(self.metrics.snapshot(), port=self.port)
+            try:
+                with open(self.metrics_file, 'a') as outfile:
+                    outfile.write(json.dumps(line) + "\n")
+            except OSError:
+                self.logger.error("Unable to write the metrics to %s",
+                                  self.metrics_file, exc_info=True)
+
+    def _batch_group(self, item):
+        name = item['command'].upper()
+        if name not in self.commands:
+            return name
+        return self.commands[name].get_group(item.get('parameters') or {})
+
+    async def batch(self, commands):
+        """
+        Run a list of commands and merge their replies into one.  Commands
+        for different devices run at the same time, commands for the same
+        device run in the order given, so the batch takes about as long as
+        the slowest device.
+
+        :param commands: list of dictionaries with the 'command', optional
+                         'parameters' and an optional 'key'.  The data of a
+                         command with a key is stored under that key,
+                         dictionary data without a key is merged in
+        :return: dictionary with the merged data.  Failed commands are
+                 listed in 'batch_errors' by key or command name
+        """
+        starttime = time.time()
+        for item in commands:
+            if not isinstance(item, dict) or 'command' not in item:
+                return {'elaptime': time.time() - starttime,
+                        'error': "Batch entries need a 'command'"}
+            if item['command'].upper() == 'BATCH':
+                return {'elaptime': time.time() - starttime,
+                        'error': "Batches can't be nested"}
+
+        groups = {}
+        for i, item in enumerate(commands):
+            groups.setdefault(self._batch_group(item), []).append(i)
+
+        results = [None] * len(commands)
+
+        async def run_group(indices):
+            for i in indices:
+                results[i] = await self.execute(commands[i], starttime)
+
+        await asyncio.gather(*[run_group(indices)
+                               for indices in groups.values()])
+
+        merged = {}
+        errors = {}
+        for item, ret in zip(commands, results):
+            label = item.get('key', item['command'].lower())
+            if isinstance(ret, dict) and 'error' in ret:
+                errors[label] = ret['error']
+                continue
+            if isinstance(ret, dict) and 'data' in ret:
+                ret = ret['data']
+
+            if 'key' not in item and isinstance(ret, dict):
+                merged.update(ret)
+            else:
+                merged[label] = ret
+
+        if errors:
+            merged['batch_errors'] = errors
+        return {'elaptime': time.time() - starttime, 'data': merged}
+
+    def _get_pool(self, name):
+        if name not in self.pools:
+            self.pools[name] = ThreadPoolExecutor(
+                max_workers=self.pool_sizes[name],
+                thread_name_prefix='%s-%s' % (self.port, name))
+        return self.pools[name]
+
+    async def run_blocking(self, pool, func, *args, **kwargs):
+        """
+        Run a blocking call in one of the worker pools
+
+        :param pool: name of the pool
+        :param func: callable
+        :return: return value of the call
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._get_pool(pool),
+                                          lambda: func(*args, **kwargs))
+
+    async def execute(self, data, starttime, session=None):
+        """
+        Look up and run a command, its latency from the request arriving
+        is added to the metrics, so time spent waiting for a worker counts
+
+        :param data: decoded request dictionary
+        :param starttime: time the request was received, for the commands
+                          of a BATCH the time the batch was
+        :param session: Session the request came in on
+        :return: return value of the command or an error dictionary
+        """
+        ret = await self._execute(data, starttime, session)
+
+        name = data['command'].upper()
+        self.metrics.record(name if name in self.commands else 'UNKNOWN',
+                            time.time() - starttime, ret)
+        return ret
+
+    async def _execute(self, data, starttime, session=None):
+        name = data['command'].upper()
+        parameters = data.get('parameters') or {}
+
+        if name not in self.commands:
+            return {'elaptime': time.time() - starttime,
+                    'error': "Command not found"}
+
+        command = self.commands[name]
+        if command.session:
+            parameters = dict(parameters, session=session)
+        try:
+            if not command.blocking:
+                ret = command.func(**parameters)
+                if asyncio.iscoroutine(ret):
+                    ret = await asyncio.wait_for(
+                        ret, command.get_timeout(parameters))
+                return ret
+
+            loop = asyncio.get_running_loop()
+            future = loop.run_in_executor(self._get_pool(command.pool),
+                                          lambda: command.func(**parameters))
+            # The worker thread can't be interrupted, on a timeout the
+            # client gets an error and the call finishes in the background
+            return await asyncio.wait_for(asyncio.shield(future),
+                                          command.get_timeout(parameters))
+        except asyncio.TimeoutError:
+            self.logger.error("%s timed out", name)
+            return {'elaptime': time.time() - starttime,
+                    'error': "Command %s timed out after %ss" %
+                             (name, command.get_timeout(parameters))}
+        except Exception as e:
+            self.logger.error("Error running %s", name, exc_info=True)
+            return {'elaptime': time.time() - starttime,
+                    'error': "%s: %s" % (name, str(e))}
+
+    async def respond(self, data, starttime, session):
+        """
+        Run a request and write its reply
+
+        :param data: decoded request dictionary
+        :param starttime: time the request was received
+        :param session: Session of the connection
+        """
+        ret = await self.execute(data, starttime, session=session)
+
+        response = response_handler(ret, inputdata=data,
+                                    starttime=starttime,
+                                    request_id=data.get('id'),
+                                    return_type='dict')
+        self.logger.info("Response: %s", response)
+        try:
+            await session.send(session.encode(response))
+        except ConnectionError:
+            self.logger.error("Connection lost before the %s reply was sent",
+                              data['command'])
+
+    async def set_encoding(self, data, starttime, session):
+        """
+        Answer an ENCODING request in the current encoding and switch the
+        connection to the chosen one.  This is done before the next request
+        is read, so it is never run concurrently with other requests.
+        """
+        parameters = data.get('parameters') or {}
+        name = codec.negotiate(parameters.get('encodings'))
+        response = response_handler({'data': name}, inputdata=data,
+                                    starttime=starttime,
+                                    request_id=data.get('id'),
+                                    return_type='dict')
+        await session.send(session.encode(response))
+        session.codec = codec.get_codec(name)
+        self.logger.info("%s now using %s", session.address, name)
+
+    async def handle(self, reader, writer):
+        """
+        Serve one client connection until it closes
+        """
+        session = Session(writer)
+        self.logger.info("Incoming: %s", session.address)
+        running = set()
+
+        try:
+            while True:
+                try:
+                    payload = await read_frame_async(reader)
+                except (FrameError, ConnectionError) as e:
+                    self.logger.error("Bad frame from %s: %s",
+                                      session.address, str(e))
+                    break
+                if payload is None:
+                    break
+
+                starttime = time.time()
+                try:
+                    data = session.codec.decode(payload)
+                    if not isinstance(data, dict) or 'command' not in data:
+                        raise ValueError("'command' not in input data")
+                except Exception as e:
+                    response = error_handler("Unable to load the incoming "
+                                             "%s request: %s" %
+                                             (session.codec.name, str(e)),
+                                             starttime=starttime,
+                                             inputdata='NA',
+                                             return_type='dict')
+                    await session.send(session.encode(response))
+                    break
+
+                self.logger.info("Data Received: %s", data)
+                if data['command'].upper() == 'ENCODING':
+                    await self.set_encoding(data, starttime, session)
+                    continue
+
+                if data.get('id') is None:
+                    await self.respond(data, starttime, session)
+                    continue
+
+                task = asyncio.ensure_future(
+                    self.respond(data, starttime, session))
+                running.add(task)
+                task.add_done_callback(running.discard)
+        except ConnectionError:
+            pass
+        finally:
+            # Nobody is left to read the replies of unfinished requests
+            for task in running:
+                task.cancel()
+            session.close()
+            self.logger.info("Connection closed: %s", session.address)
+
+    async def _watch_stop_file(self):
+        while True:
+            if os.path.exists(self.stop_file):
+                self.logger.info("Stop file found, shutting down")
+                self.server.close()
+                return
+            await asyncio.sleep(5)
+
+    async def serve(self):
+        self.server = await asyncio.start_server(self.handle, self.hostname,
+                                                 self.port,
+                                                 reuse_address=True)
+        self.logger.debug("Server now listening for connections on port:%s"
+                          % self.port)
+        tasks = [asyncio.ensure_future(func()) for func in self.background]
+        if self.stop_file:
+            tasks.append(asyncio.ensure_future(self._watch_stop_file()))
+
+        try:
+            async with self.server:
+                await self.server.serve_forever()
+        except asyncio.CancelledError:
+            pass
+        finally:
+            for task in tasks:
+                task.cancel()
+            for pool in self.pools.values():
+                pool.shutdown(wait=False)
+
+    def start(self):
+        """
+        Run the server until it is stopped
+        """
+        asyncio.run(self.serve())
@@ -0,0 +1,114 @@
+import json
+import struct
+
+# Every message on the server sockets is sent as a 4 byte big endian length
+# followed by that many bytes of utf-8 encoded json
+HEADER = struct.Struct('!I')
+
+# Refuse frames larger than this so a corrupt header can't allocate GBs
+MAX_FRAME_SIZE = 256 * 1024 * 1024
+
+# Size of each recv call made by the reader
+RECV_SIZE = 65536
+
+
+class FrameError(Exception):
+    """Raised when the stream doesn't contain a valid frame"""
+    pass
+
+
+def encode_frame(payload):
+    """
+    Add the length header to a payload
+
+    :param payload: bytes or str, strings are utf-8 encoded
+    :return: bytes
+    """
+    if isinstance(payload, str):
+        payload = payload.encode('utf-8')
+    return HEADER.pack(len(payload)) + payload
+
+
+def send_frame(connection, payload):
+    """
+    Send one framed message on a socket
+
+    :param connection: socket
+    :param payload: bytes or str
+    """
+    connection.sendall(encode_frame(payload))
+
+
+def send_json(connection, obj):
+    """
+    Encode a python object as json and send it as one frame
+
+    :param connection: socket
+    :param obj: json serializable object
+    """
+    send_frame(connection, json.dumps(obj))
+
+
+class FrameReader:
+    """
+    Buffered reader that returns one complete frame at a time from a socket,
+    however the bytes arrive.  Bytes past the end of a frame are kept for the
+    next call so back to back messages are never merged.  Create one reader
+    per socket and use it for every read on that socket.
+    """
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.buffer = bytearray()
+
+    def _fill(self, size):
+        """
+        Read from the socket until the buffer holds at least size bytes
+
+        :param size: number of bytes needed
+        :return: False if the connection was closed first
+        """
+        while len(self.buffer) < size:
+            chunk = self.connection.recv(max(RECV_SIZE,
+                                             size - len(self.buffer)))
+            if not chunk:
+                return False
+            self.buffer.extend(chunk)
+        return True
+
+    def read_frame(self):
+        """
+        Block until a full frame is available.  Socket timeouts set on the
+        connection are passed through to the caller.
+
+        :return: payload bytes, or None when the connection was closed
+                 cleanly between frames
+        """
+        if not self._fill(HEADER.size):
+            if self.buffer:
+                raise FrameError("Connection closed inside a frame header")
+            return None
+
+        size = HEADER.unpack_from(self.buffer)[0]
+        if size > MAX_FRAME_SIZE:
+            raise FrameError("Frame of %s bytes is larger than the %s "
+                             "limit" % (size, MAX_FRAME_SIZE))
+
+        if not self._fill(HEADER.size + size):
+            raise FrameError("Connection closed after %s of %s bytes" %
+                             (len(self.buffer) - HEADER.size, size))
+
+        payload = bytes(self.buffer[HEADER.size:HEADER.size + size])
+        del self.buffer[:HEADER.size + size]
+        return payload
+
+    def read_json(self):
+        """
+        Read one frame and decode it from json
+
+        :return: python object, or None when the connection was closed
+        """
+        payload = self.read_frame()
+        if payload is None:
+            return None
+        return json.loads(payload.decode('utf-8'))
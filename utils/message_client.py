@@ -1,9 +1,20 @@
 import time
 import json
+import socket
+import threading
+import functools
+import itertools
+import logging
+import collections
+from concurrent.futures import Future, TimeoutError
+from utils.framing import FrameReader, send_frame
+from utils import codec
+
+logger = logging.getLogger(__name__)
 
 
 def send_message(outgoing_connection, cmd="", parameters=None, timeout=300,
-                 return_before_done=False, start=0):
+                 return_before_done=False, start=0, reader=None):
     """
     Any command sent to the server should expect a json string return
 
@@ -13,8 +24,11 @@ def send_message(outgoing_connection, cmd="", parameters=None, timeout=300,
     :param cmd: string command to send to the camera socket
     :param parameters: list of parameters associated with cmd
     :param timeout: timeout in seconds for waiting for a command
+    :param reader: FrameReader kept by the caller for this connection
     :return: Tuple (bool,string)
     """
+    if reader is None:
+        reader = FrameReader(outgoing_connection)
 
     try:
         # 1. Set a time out for the connection if needed
@@ -29,23 +43,568 @@ def send_message(outgoing_connection, cmd="", parameters=None, timeout=300,
             send_str = json.dumps({'command': cmd})
 
         # 3. Send the command to the intended server
-        outgoing_connection.send(b"%s" % send_str.encode('utf-8'))
+        send_frame(outgoing_connection, send_str)
 
         # 4.
         if return_before_done:
             return {"elaptime": time.time() - start,
                     "data": "exiting the loop early"}
 
-        data = outgoing_connection.recv(2048)
-        counter = 0
-        while not data:
-            time.sleep(.01)
-            data = outgoing_connection.recv(2048)
-            counter += 1
-            if counter > 100:
-                break
+        # 5. Wait for the complete reply
+        data = reader.read_frame()
+        if data is None:
+            return {'elaptime': time.time() - start,
+                    'error': 'Connection closed by the server'}
         return json.loads(data.decode('utf-8'))
 
     except Exception as e:
         return {'elaptime': time.time() - start,
-                'error': str(e)}
\ No newline at end of file
+                'error': str(e)}
+
+
+class Connection:
+    """
+    Client connection to one of the command servers that can have several
+    commands outstanding at once.
+
+    Every request is sent with an 'id' that the server echoes in its reply.
+    A reader thread takes the replies off the socket as they arrive and
+    hands each one to the request with the same id, so replies can come
+    back in any order and a command sent with return_before_done can't
+    have its reply picked up by another command on the same connection.
+
+    The payload encoding is agreed with the server when connecting, see
+    utils.codec.
+    """
+
+    def __init__(self, address, port, encodings=None, connect_timeout=10):
+        """
+        :param address: host name of the server
+        :param port: int for tcp port communication
+        :param encodings: encodings to offer the server in order of
+                          preference, by default all the installed ones
+        :param connect_timeout: seconds to wait for the server to accept
+                                the connection and agree on the encoding
+        """
+        self.address = address
+        self.port = port
+        self.socket = socket.create_connection((self.address, self.port),
+                                               timeout=connect_timeout)
+        self.reader = FrameReader(self.socket)
+        self.codec = codec.JSON
+        try:
+            self.negotiate(encodings if encodings else codec.ENCODINGS)
+        except Exception:
+            self.socket.close()
+            raise
+        # Replies can take as long as the command, the waiting is timed
+        # by result instead
+        self.socket.settimeout(None)
+
+        self.ids = itertools.count(1)
+        # Requests whose reply hasn't been collected yet, oldest first
+        self.futures = collections.OrderedDict()
+        # Ids of the requests sent with return_before_done, for listen
+        self.early = collections.deque()
+        self.lock = threading.Lock()
+        self.send_lock = threading.Lock()
+        self.closed = None
+        # Latest published snapshot of each subscribed telemetry topic
+        self.telemetry = {}
+
+        self.reader_thread = threading.Thread(target=self._read_replies,
+                                              daemon=True)
+        self.reader_thread.start()
+
+    def negotiate(self, encodings):
+        """
+        Agree on the payload encoding with the server.  Done before the
+        reader thread starts so no reply can be decoded with the wrong one.
+
+        :param encodings: list of encoding names in order of preference
+        """
+        if encodings == ['json']:
+            return
+
+        send_frame(self.socket, json.dumps(
+            {'command': 'ENCODING', 'parameters': {'encodings': encodings}}))
+        reply = self.reader.read_json()
+        # Servers that don't know the command keep talking json
+        if isinstance(reply, dict) and reply.get('data') in encodings:
+            self.codec = codec.get_codec(reply['data'])
+
+    def _read_replies(self):
+        """
+        Hand every reply to the request waiting for it until the
+        connection closes
+        """
+        reason = 'Connection closed by the server'
+        try:
+            while True:
+                payload = self.reader.read_frame()
+                if payload is None:
+                    break
+                self._dispatch(self.codec.decode(payload))
+        except Exception as e:
+            reason = str(e)
+
+        with self.lock:
+            self.closed = reason
+            waiting = [f for f in self.futures.values() if not f.done()]
+        for future in waiting:
+            future.set_result({'error': reason})
+
+    def _dispatch(self, reply):
+        if isinstance(reply, dict) and 'topic' in reply and 'id' not in reply:
+            self.telemetry[reply['topic']] = reply
+            return
+
+        request_id = reply.get('id') if isinstance(reply, dict) else None
+        with self.lock:
+            if request_id is None:
+                # Servers without request ids answer in order
+                waiting = [f for f in self.futures.values() if not f.done()]
+                future = waiting[0] if waiting else None
+            else:
+                future = self.futures.get(request_id)
+
+        if future is None or future.done():
+            logger.warning("Dropping reply to unknown request %s", request_id)
+            return
+        future.set_result(reply)
+
+    def submit(self, cmd="", parameters=None):
+        """
+        Send a command without waiting for the reply
+
+        :param cmd: string command to send to the server
+        :param parameters: dictionary of parameters associated with cmd
+        :return: id of the request, pass it to result to get the reply
+        """
+        request_id = next(self.ids)
+        request = {'command': cmd, 'id': request_id}
+        if parameters:
+            request['parameters'] = parameters
+
+        with self.lock:
+            if self.closed:
+                raise ConnectionError(self.closed)
+            self.futures[request_id] = Future()
+
+        try:
+            with self.send_lock:
+                send_frame(self.socket, self.codec.encode(request))
+        except Exception:
+            self.discard(request_id)
+            raise
+        return request_id
+
+    def result(self, request_id, timeout=None, start=0):
+        """
+        Wait for the reply of a request
+
+        :param request_id: id returned by submit
+        :param timeout: seconds to wait, None waits forever.  On a timeout
+                        the request stays outstanding and result can be
+                        called again
+        :param start: Unix timestamp float used for the elaptime of errors
+        :return: reply dictionary
+        """
+        with self.lock:
+            future = self.futures.get(request_id)
+        if future is None:
+            return {'elaptime': time.time() - start,
+                    'error': 'No outstanding request %s' % request_id}
+
+        try:
+            reply = future.result(timeout)
+        except TimeoutError:
+            return {'elaptime': time.time() - start,
+                    'error': 'timed out waiting for request %s' % request_id}
+
+        self.discard(request_id)
+        return reply
+
+    def discard(self, request_id):
+        """
+        Forget a request, a reply that arrives later is dropped
+        """
+        with self.lock:
+            self.futures.pop(request_id, None)
+            if request_id in self.early:
+                self.early.remove(request_id)
+
+    def send_command(self, cmd="", parameters=None, timeout=300,
+                     return_before_done=False, start=0):
+        """
+        Send a command and wait for its reply, see send_message for the
+        arguments.  With return_before_done the reply is kept for listen.
+
+        :return: reply dictionary
+        """
+        try:
+            request_id = self.submit(cmd, parameters)
+        except Exception as e:
+            return {'elaptime': time.time() - start, 'error': str(e)}
+
+        if return_before_done:
+            with self.lock:
+                self.early.append(request_id)
+            return {"elaptime": time.time() - start, "id": request_id,
+                    "data": "exiting the loop early"}
+
+        reply = self.result(request_id, timeout=timeout or None,
+                            start=start)
+        # A caller that timed out has given up on this request
+        self.discard(request_id)
+        return reply
+
+    def listen(self, request_id=None, timeout=None):
+        """
+        Wait for the reply of a command sent with return_before_done
+
+        :param request_id: id returned in the early reply, by default the
+                           oldest command sent with return_before_done
+        :param timeout: seconds to wait, None waits forever
+        :return: reply dictionary
+        """
+        start = time.time()
+        if request_id is None:
+            with self.lock:
+                if not self.early:
+                    return {'elaptime': 0,
+                            'error': 'No command is waiting for a reply'}
+                request_id = self.early[0]
+        return self.result(request_id, timeout=timeout, start=start)
+
+    def latest(self, topic, max_age=None):
+        """
+        Latest published snapshot of a subscribed topic
+
+        :param topic: name of the topic
+        :param max_age: seconds, older snapshots are not returned.  None
+                        returns whatever was last published
+        :return: snapshot dictionary or None
+        """
+        snapshot = self.telemetry.get(topic)
+        if snapshot is None:
+            return None
+        if max_age is not None and time.time() - snapshot['time'] > max_age:
+            return None
+        return snapshot
+
+    def close(self):
+        try:
+            self.socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.socket.close()
+
+
+def client_command(build, **options):
+    """
+    Client method sending the command made by a request builder.  The
+    asyncio clients make their methods from the same builders with
+    async_client.async_command, so both send the same parameters.
+
+    :param build: function of the command arguments returning
+                  (command, parameters)
+    :param options: send_request keyword arguments with their defaults,
+                    such as return_before_done, callers can override them
+                    by keyword
+    :return: method calling self.send_request(cmd, parameters, **options)
+    """
+    @functools.wraps(build)
+    def method(self, *args, **kwargs):
+        send = {key: kwargs.pop(key, value) for key, value in options.items()}
+        cmd, parameters = build(*args, **kwargs)
+        return self.send_request(cmd, parameters, **send)
+    return method
+
+
+# Pools shared by all the clients of a server, by (address, port)
+POOLS = {}
+POOLS_LOCK = threading.Lock()
+
+
+def get_pool(address, port, **kwargs):
+    """
+    Connection pool for a server, created the first time it is asked for.
+    Clients of the same server share the pool, so creating a new client
+    object doesn't open new sockets.
+
+    :param address: host name of the server
+    :param port: int for tcp port communication
+    :param kwargs: passed to ConnectionPool when the pool is created.  For
+                   an existing pool the idempotent commands are added to
+                   its set, other settings that differ from the pool's are
+                   reported and ignored
+    :return: ConnectionPool
+    """
+    with POOLS_LOCK:
+        pool = POOLS.get((address, port))
+        if pool is None or pool.stopped:
+            pool = ConnectionPool(address, port, **kwargs)
+            POOLS[(address, port)] = pool
+            return pool
+
+    idempotent = kwargs.pop('idempotent', None)
+    if idempotent:
+        pool.add_idempotent(idempotent)
+
+    current = pool.settings()
+    ignored = ["%s=%s (pool has %s)" % (key, value, current[key])
+               for key, value in kwargs.items()
+               if key in current and current[key] != value]
+    if ignored:
+        logger.warning("Pool for %s:%s already exists, ignoring %s",
+                       address, port, ", ".join(ignored))
+    return pool
+
+
+class ConnectionPool:
+    """
+    A few connections to one server that are replaced when they drop.
+
+    Requests go out on the connection with the fewest outstanding requests.
+    A background thread PINGs every connection so a dead socket is found
+    and replaced between commands rather than in the middle of one.  A
+    command that never reached the server is sent again on a new
+    connection.  A command whose connection dropped while waiting for the
+    reply is only sent again if it is in the idempotent set, as it may
+    already have run.
+    """
+
+    def __init__(self, address, port, size=2, heartbeat=30.,
+                 heartbeat_timeout=10., idempotent=None, retries=1,
+                 encodings=None):
+        """
+        :param address: host name of the server
+        :param port: int for tcp port communication
+        :param size: number of connections
+        :param heartbeat: seconds between PINGs of each connection, None
+                          for no heartbeat
+        :param heartbeat_timeout: seconds a PING may take before the
+                                  connection is replaced
+        :param idempotent: commands that are safe to run twice
+        :param retries: number of times a failed command is sent again
+        :param encodings: encodings offered to the server
+        """
+        self.address = address
+        self.port = port
+        self.heartbeat = heartbeat
+        self.heartbeat_timeout = heartbeat_timeout
+        self.idempotent = set(c.upper() for c in idempotent or []) | {'PING'}
+        self.retries = retries
+        self.encodings = encodings
+
+        self.slots = [None] * size
+        self.slot_locks = [threading.Lock() for _ in range(size)]
+        self.lock = threading.Lock()
+        # (connection, request id) of commands sent with return_before_done
+        self.early = collections.deque()
+        # Telemetry topics subscribed on the first connection, renewed
+        # whenever that connection is replaced
+        self.subscription = None
+        self.stopped = False
+
+        # Connect one socket right away so a server that is down is
+        # reported when the client is created, as before
+        self.get(0)
+
+        self.heartbeat_thread = None
+        if heartbeat:
+            self.heartbeat_thread = threading.Thread(target=self._heartbeat,
+                                                     daemon=True)
+            self.heartbeat_thread.start()
+
+    def add_idempotent(self, commands):
+        """
+        Add commands that are safe to run twice, for a client that shares
+        the pool with others that don't send them
+        """
+        self.idempotent = self.idempotent | set(c.upper() for c in commands)
+
+    def settings(self):
+        """
+        :return: dictionary of the ConnectionPool arguments the pool was
+                 made with, other than the address and idempotent commands
+        """
+        return {'size': len(self.slots), 'heartbeat': self.heartbeat,
+                'heartbeat_timeout': self.heartbeat_timeout,
+                'retries': self.retries, 'encodings': self.encodings}
+
+    def _connect(self, slot):
+        connection = Connection(self.address, self.port,
+                                encodings=self.encodings)
+        if slot == 0 and self.subscription is not None:
+            connection.send_command('SUBSCRIBE', self.subscription,
+                                    timeout=self.heartbeat_timeout)
+        return connection
+
+    def get(self, slot=None):
+        """
+        Connection to send a request on, reconnecting if it was dropped
+
+        :param slot: index of the connection, by default the one with the
+                     fewest outstanding requests
+        :return: (slot, Connection)
+        """
+        if slot is None:
+            with self.lock:
+                live = [i for i, c in enumerate(self.slots)
+                        if c is not None and not c.closed]
+                idle = [i for i in live if not self.slots[i].futures]
+                if idle:
+                    slot = idle[0]
+                elif len(live) < len(self.slots):
+                    slot = [i for i in range(len(self.slots))
+                            if i not in live][0]
+                else:
+                    slot = min(live, key=lambda i: len(self.slots[i].futures))
+
+        with self.slot_locks[slot]:
+            connection = self.slots[slot]
+            if connection is None or connection.closed:
+                connection = self._connect(slot)
+                self.slots[slot] = connection
+        return slot, connection
+
+    def drop(self, slot, connection):
+        """
+        Close a connection that failed, it is replaced on the next request
+        """
+        with self.slot_locks[slot]:
+            if self.slots[slot] is connection:
+                self.slots[slot] = None
+        connection.close()
+
+    def send_command(self, cmd="", parameters=None, timeout=300,
+                     return_before_done=False, start=0):
+        """
+        Send a command and wait for its reply, see send_message for the
+        arguments
+
+        :return: reply dictionary
+        """
+        reply = None
+        for attempt in range(self.retries + 1):
+            slot, connection = None, None
+            try:
+                slot, connection = self.get()
+                request_id = connection.submit(cmd, parameters)
+            except Exception as e:
+                # The request never reached the server, any command can
+                # be sent again
+                reply = {'elaptime': time.time() - start, 'error': str(e)}
+                if connection is not None:
+                    self.drop(slot, connection)
+                continue
+
+            if return_before_done:
+                with self.lock:
+                    self.early.append((connection, request_id))
+                return {"elaptime": time.time() - start, "id": request_id,
+                        "data": "exiting the loop early"}
+
+            reply = connection.result(request_id, timeout=timeout or None,
+                                      start=start)
+            connection.discard(request_id)
+            if not connection.closed:
+                return reply
+
+            self.drop(slot, connection)
+            if cmd.upper() not in self.idempotent:
+                return reply
+        return reply
+
+    def listen(self, request_id=None, timeout=None):
+        """
+        Wait for the reply of a command sent with return_before_done
+
+        :param request_id: id returned in the early reply, by default the
+                           oldest command sent with return_before_done
+        :param timeout: seconds to wait, None waits forever
+        :return: reply dictionary
+        """
+        with self.lock:
+            waiting = [e for e in self.early
+                       if request_id is None or e[1] == request_id]
+        if not waiting:
+            return {'elaptime': 0,
+                    'error': 'No command is waiting for a reply'}
+
+        connection, request_id = waiting[0]
+        reply = connection.result(request_id, timeout=timeout,
+                                  start=time.time())
+        if request_id not in connection.futures:
+            with self.lock:
+                self.early.remove(waiting[0])
+        return reply
+
+    def subscribe(self, topics=None):
+        """
+        Subscribe the first connection to telemetry topics, kept when the
+        connection is replaced
+        """
+        self.subscription = {'topics': topics}
+        ret = self.get(0)[1].send_command('SUBSCRIBE', self.subscription,
+                                          timeout=self.heartbeat_timeout)
+        # The server replies with the topics, so a later unsubscribe from
+        # some of them knows what is left
+        if isinstance(ret.get('data'), list):
+            self.subscription = {'topics': ret['data']}
+        return ret
+
+    def unsubscribe(self, topics=None):
+        """
+        Stop the pushes of some topics, or of all of them by default.  The
+        rest stay subscribed when the connection is replaced.
+        """
+        if not topics:
+            self.subscription = None
+        elif self.subscription is not None:
+            remaining = [t for t in self.subscription.get('topics') or []
+                         if t not in topics]
+            self.subscription = {'topics': remaining} if remaining else None
+        return self.get(0)[1].send_command('UNSUBSCRIBE', {'topics': topics},
+                                           timeout=self.heartbeat_timeout)
+
+    def latest(self, topic, max_age=None):
+        """
+        Latest published snapshot of a subscribed topic, see
+        Connection.latest
+        """
+        snapshots = [c.latest(topic, max_age) for c in list(self.slots)
+                     if c is not None]
+        snapshots = [x for x in snapshots if x is not None]
+        if not snapshots:
+            return None
+        return max(snapshots, key=lambda x: x['time'])
+
+    def _heartbeat(self):
+        while not self.stopped:
+            time.sleep(self.heartbeat)
+            for slot, connection in enumerate(list(self.slots)):
+                if self.stopped or connection is None:
+                    continue
+                ret = connection.send_command('PING',
+                                              timeout=self.heartbeat_timeout,
+                                              start=time.time())
+                if 'error' not in ret:
+                    continue
+
+                logger.warning("Lost connection %s to %s:%s, reconnecting: %s",
+                               slot, self.address, self.port, ret['error'])
+                self.drop(slot, connection)
+                try:
+                    self.get(slot)
+                except Exception as e:
+                    logger.error("Unable to reconnect to %s:%s: %s",
+                                 self.address, self.port, str(e))
+
+    def close(self):
+        self.stopped = True
+        for slot, connection in enumerate(list(self.slots)):
+            if connection is not None:
+                self.drop(slot, connection)
@@ -1,40 +1,52 @@
 import json
 import time
+from utils.framing import FrameReader, send_frame
 
 
 def error_handler(msg, starttime=0.0, inputdata=None, return_type='json',
-                  incoming_connection=None):
+                  incoming_connection=None, request_id=None):
     """
 
     :param incoming_connection:
     :param msg:
     :param starttime:
     :param inputdata:
-    :param return_type:
+    :param return_type: 'json' for a json string, 'dict' for the reply
+                        dictionary to be encoded by the caller
+    :param request_id: id of the request, echoed back so clients can match
+                       replies to pipelined requests
     :return:
     """
 
-    if return_type == 'json':
-        ret = json.dumps({"elaptime": time.time() - starttime,
-                          "input": inputdata,
-                          "error": "error message %s" % msg})
+    if return_type in ('json', 'dict'):
+        reply = {"elaptime": time.time() - starttime,
+                 "input": inputdata,
+                 "error": "error message %s" % msg}
+        if request_id is not None:
+            reply['id'] = request_id
+        if return_type == 'dict':
+            return reply
+        ret = json.dumps(reply)
 
         if incoming_connection:
-            incoming_connection.sendall(ret)
+            send_frame(incoming_connection, ret)
             print("I am still in the loop")
         else:
             return ret
 
 
 def response_handler(msg, starttime=0.0, inputdata=None, return_type='json',
-                     incoming_connection=None):
+                     incoming_connection=None, request_id=None):
     """
 
     :param incoming_connection:
     :param msg:
     :param starttime:
     :param inputdata:
-    :param return_type:
+    :param return_type: 'json' for a json string, 'dict' for the reply
+                        dictionary to be encoded by the caller
+    :param request_id: id of the request, echoed back so clients can match
+                       replies to pipelined requests
     :return:
     """
     if isinstance(msg, dict):
@@ -43,27 +55,43 @@ def response_handler(msg, starttime=0.0, inputdata=None, return_type='json',
         elif 'error' in msg:
             return error_handler(msg, starttime=starttime,
                                  inputdata=inputdata,
-                                 return_type=return_type)
-
-    if return_type == 'json':
-        return json.dumps({"elaptime": time.time() - starttime,
-                           "input": inputdata,
-                           "data": msg})
+                                 return_type=return_type,
+                                 request_id=request_id)
+
+    if return_type in ('json', 'dict'):
+        reply = {"elaptime": time.time() - starttime,
+                 "input": inputdata,
+                 "data": msg}
+        if request_id is not None:
+            reply['id'] = request_id
+        if return_type == 'dict':
+            return reply
+        return json.dumps(reply)
     else:
         return True
 
 
-def message_handler(incoming_connection, starttime=0.0):
+def message_handler(incoming_connection, starttime=0.0, reader=None):
     """
 
     :param incoming_connection:
     :param starttime:
+    :param reader: FrameReader for the connection.  Servers should keep one
+                   per connection so bytes of a following message are not
+                   lost
     :return:
     """
 
-    # 1. Start by parsing the incoming request
+    if reader is None:
+        reader = FrameReader(incoming_connection)
+
+    # 1. Start by parsing the incoming request, a whole frame is read no
+    # matter how large it is
     try:
-        data = incoming_connection.recv(2048)
+        data = reader.read_frame()
+        if data is None:
+            # The client closed the connection
+            return False
         data = data.decode("utf8")
     except Exception as e:
         print("Unable to retrieve incoming data")
@@ -73,8 +101,10 @@ def message_handler(incoming_connection, starttime=0.0):
                                    inputdata='NA',
                                    return_type='json')
         # Send reply back to incoming address and exit the loop
-
-        incoming_connection.sendall(error_dict)
+        try:
+            send_frame(incoming_connection, error_dict)
+        except OSError:
+            pass
         return False
 
     # 2. Verify that the incoming command has valid data
@@ -100,7 +130,7 @@ def message_handler(incoming_connection, starttime=0.0):
                                    inputdata=data,
                                    return_type='json')
         # Send reply back to incoming address and exit the loop
-        incoming_connection.sendall(error_dict.encode('utf-8'))
+        send_frame(incoming_connection, error_dict)
         return False
 
     # 4. Check that we have an incoming command
@@ -109,7 +139,7 @@ def message_handler(incoming_connection, starttime=0.0):
                                    starttime=starttime, inputdata=data,
                                    return_type='json')
         # Send reply back to incoming address and exit the loop
-        incoming_connection.sendall(error_dict.encode('utf-8'))
+        send_frame(incoming_connection, error_dict)
         return False
 
     return data
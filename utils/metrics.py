@@ -0,0 +1,119 @@
+import time
+import bisect
+
+# Upper edges of the latency histogram buckets in milliseconds, the last
+# bucket holds everything slower
+BUCKETS_MS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000,
+              30000, 60000, 120000, 300000]
+
+
+class CommandStats:
+    """Latency histogram and counts of one command"""
+
+    def __init__(self, started=None):
+        self.started = started if started is not None else time.time()
+        self.count = 0
+        self.errors = 0
+        self.timeouts = 0
+        self.total = 0.
+        self.min = None
+        self.max = 0.
+        self.histogram = [0] * (len(BUCKETS_MS) + 1)
+
+    def record(self, seconds, error=None):
+        ms = seconds * 1000
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        self.min = seconds if self.min is None else min(self.min, seconds)
+        self.histogram[bisect.bisect_left(BUCKETS_MS, ms)] += 1
+        if error is not None:
+            self.errors += 1
+            if 'timed out' in str(error):
+                self.timeouts += 1
+
+    def percentile(self, q):
+        """
+        Upper edge of the bucket holding the q-th percentile
+
+        :param q: percentile between 0 and 100
+        :return: milliseconds, None when nothing was recorded or it falls in
+                 the last open bucket
+        """
+        if not self.count:
+            return None
+        rank = q / 100. * self.count
+        seen = 0
+        for i, n in enumerate(self.histogram):
+            seen += n
+            if seen >= rank and n:
+                return BUCKETS_MS[i] if i < len(BUCKETS_MS) else None
+        return None
+
+    def to_dict(self):
+        return {'since': self.started,
+                'count': self.count, 'errors': self.errors,
+                'timeouts': self.timeouts,
+                'mean_ms': 1000 * self.total / self.count
+                if self.count else None,
+                'min_ms': 1000 * self.min if self.min is not None else None,
+                'max_ms': 1000 * self.max,
+                'p50_ms': self.percentile(50), 'p90_ms': self.percentile(90),
+                'p99_ms': self.percentile(99),
+                'histogram': self.histogram}
+
+
+class Metrics:
+    """
+    Per command latency statistics kept in memory by a server
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        self.commands = {}
+        # Commands reset on their own since the last full reset
+        self.reset_times = {}
+
+    def record(self, name, seconds, ret=None):
+        """
+        Add one request
+
+        :param name: command name
+        :param seconds: time from the request arriving to the reply
+        :param ret: return of the command, counted as an error when it is
+                    a dictionary with an 'error'
+        """
+        if name not in self.commands:
+            self.commands[name] = CommandStats(
+                self.reset_times.get(name, self.started))
+        error = ret.get('error') if isinstance(ret, dict) else None
+        self.commands[name].record(seconds, error)
+
+    def snapshot(self, command=None, reset=False):
+        """
+        Statistics of every command
+
+        :param command: only return this command
+        :param reset: start counting again after taking the snapshot, only
+                      for the given command when there is one
+        :return: dictionary with the time span, the bucket edges and the
+                 statistics by command, each with its own 'since'
+        """
+        now = time.time()
+        commands = self.commands
+        since = self.started
+        if command:
+            name = command.upper()
+            commands = {k: v for k, v in commands.items() if k == name}
+            since = self.reset_times.get(name, self.started)
+        ret = {'since': since, 'until': now,
+               'buckets_ms': BUCKETS_MS,
+               'commands': {k: v.to_dict() for k, v in commands.items()}}
+        if reset and command:
+            self.commands.pop(name, None)
+            self.reset_times[name] = now
+        elif reset:
+            self.started = now
+            self.commands = {}
+            self.reset_times = {}
+        return ret
@@ -83,8 +83,11 @@ class addHeader():
         for i in missing:
             obsdict[i] = self.default_values[i]
 
-        # Make sure values match type list
+        # Make sure values match type list, the tcs values already come
+        # back as numbers
         for j in self.float_list:
+            if isinstance(obsdict[j], float):
+                continue
             try:
                 obsdict[j] = float(obsdict[j])
             except Exception as e:
@@ -229,7 +232,7 @@ class addHeader():
         # 2: Check that we have everything we need in the obsdict
         obsdict = self._obsdict_check(obsdict=obsdict)
 
-        prihdr.set("TELESCOP", obsdict["telescope_id"], "Telescope ID")
+        prihdr.set("TELESCOP", str(obsdict["telescope_id"]), "Telescope ID")
         prihdr.set("LST", obsdict["lst"], "Local Sideral Time at Start of Observation")
         prihdr.set("MJD_OBS",  float(obsdict['julian_date']) - 2400000.5, "Local Sideral Time at Start of Observation")
         prihdr.set("JD", obsdict["julian_date"], "JD at Start of Observation")
@@ -332,13 +335,19 @@ class addHeader():
         # TODO: Find out why Nick added this .033 correction
         try:
             #prihdr.set("CRVAL1", round(ra_to_deg('05:23:33') - 0.03333, 5), "Center RA value")
-            prihdr.set("CRVAL1", ra_to_deg(obsdict["telescope_ra"]) - 0.03333, "Center RA value")
+            ra = obsdict.get("telescope_ra_deg")
+            if ra is None:
+                ra = ra_to_deg(obsdict["telescope_ra"])
+            prihdr.set("CRVAL1", ra - 0.03333, "Center RA value")
         except:
             prihdr.set("CRVAL1", -999, "Failed to calculate")
             pass
         try:
             #prihdr.set("CRVAL2", round(dec_to_deg('33:23:33') - 0.03333, 5), "Center Dec value")
-            prihdr.set("CRVAL2", dec_to_deg(obsdict["telescope_dec"]) - 0.03333, "Center Dec value")
+            dec = obsdict.get("telescope_dec_deg")
+            if dec is None:
+                dec = dec_to_deg(obsdict["telescope_dec"])
+            prihdr.set("CRVAL2", dec - 0.03333, "Center Dec value")
 
         except:
             prihdr.set("CRVAL2", -999, "Failed to calculate")
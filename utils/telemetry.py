@@ -0,0 +1,200 @@
+import time
+import asyncio
+import itertools
+
+
+class Telemetry:
+    """
+    Background polling and publishing of device status for a CommandServer.
+
+    Each device gets one poller that reads its topics at their own interval
+    in the device's worker pool, so the hardware is polled once however
+    many clients want the values.  Every reading is kept as a timestamped
+    snapshot and pushed to the connections subscribed to the topic.  The
+    following commands are added to the server:
+
+        SUBSCRIBE   topics: list of topics, all topics by default
+        UNSUBSCRIBE topics: list of topics, all topics by default
+        TELEMETRY   topic, max_age: the latest snapshot, polled again when
+                    it is older than max_age seconds
+
+    A published snapshot is a frame with no 'id':
+
+        {"topic": "pos", "time": 1600000000.0, "seq": 12, "data": {...}}
+
+    with "error" instead of "data" when the poll failed.
+    """
+
+    def __init__(self, server):
+        """
+        :param server: CommandServer to add the commands and pollers to
+        """
+        self.server = server
+        self.logger = server.logger
+        self.topics = {}
+        self.devices = {}
+        self.latest = {}
+        self.subscribers = {}
+        self.refreshing = {}
+        self.device_locks = {}
+        self.seq = itertools.count(1)
+
+        server.register('SUBSCRIBE', self.subscribe, blocking=False,
+                        session=True)
+        server.register('UNSUBSCRIBE', self.unsubscribe, blocking=False,
+                        session=True)
+        server.register('TELEMETRY', self.get, blocking=False, timeout=120)
+        server.background.append(self.run)
+
+    def add_topic(self, topic, func, interval, device='default'):
+        """
+        Poll a function in the background and publish what it returns
+
+        :param topic: name clients subscribe to
+        :param func: blocking callable returning a dictionary with 'data'
+                     or 'error', or a plain value
+        :param interval: seconds between polls, None to only poll when a
+                         client asks for a fresher value than the cache
+        :param device: device the function talks to.  Topics of one device
+                       are polled one at a time in the pool of that name
+        """
+        self.topics[topic] = {'func': func, 'interval': interval,
+                              'device': device}
+        self.devices.setdefault(device, []).append(topic)
+        self.device_locks.setdefault(device, asyncio.Lock())
+        self.subscribers.setdefault(topic, set())
+
+    def subscribe(self, session, topics=None):
+        """
+        Push the snapshots of the topics to the connection, starting with
+        the latest one of each
+        """
+        topics = topics if topics else list(self.topics)
+        unknown = [t for t in topics if t not in self.topics]
+        if unknown:
+            return {'error': "Unknown topics: %s" % unknown}
+
+        if self.unsubscribe not in session.on_close:
+            session.on_close.append(self.unsubscribe)
+        for topic in topics:
+            self.subscribers[topic].add(session)
+            if topic in self.latest:
+                session.publish(self._frame(topic, session))
+        return {'data': topics}
+
+    def unsubscribe(self, session, topics=None):
+        for topic in topics if topics else list(self.topics):
+            self.subscribers.get(topic, set()).discard(session)
+        return {'data': 'Unsubscribed'}
+
+    def publish(self, topic, ret):
+        """
+        Store a new reading and push it to the subscribers
+
+        :param topic: name of the topic
+        :param ret: return value of the topic function
+        """
+        snapshot = {'topic': topic, 'time': time.time(),
+                    'seq': next(self.seq)}
+        if isinstance(ret, dict) and 'error' in ret:
+            snapshot['error'] = ret['error']
+        elif isinstance(ret, dict) and 'data' in ret:
+            snapshot['data'] = ret['data']
+        else:
+            snapshot['data'] = ret
+
+        self.latest[topic] = {'snapshot': snapshot, 'frames': {}}
+
+        for session in list(self.subscribers[topic]):
+            if not session.publish(self._frame(topic, session)):
+                self.logger.warning("Dropped %s telemetry for %s", topic,
+                                    session.address)
+
+    def _frame(self, topic, session):
+        """
+        Latest snapshot of a topic encoded for a connection.  The snapshot
+        is encoded once per encoding however many subscribers there are.
+        """
+        frames = self.latest[topic]['frames']
+        name = session.codec.name
+        if name not in frames:
+            frames[name] = session.encode(self.latest[topic]['snapshot'])
+        return frames[name]
+
+    async def refresh(self, topic):
+        """
+        Poll a topic now and publish the result.  Callers asking while a
+        poll of the topic is running wait for that poll instead of starting
+        another one.
+
+        :return: snapshot dictionary
+        """
+        if topic in self.refreshing:
+            return await asyncio.shield(self.refreshing[topic])
+
+        future = asyncio.get_running_loop().create_future()
+        self.refreshing[topic] = future
+        info = self.topics[topic]
+        try:
+            try:
+                async with self.device_locks[info['device']]:
+                    ret = await self.server.run_blocking(info['device'],
+                                                         info['func'])
+            except Exception as e:
+                self.logger.error("Error polling %s", topic, exc_info=True)
+                ret = {'error': str(e)}
+            self.publish(topic, ret)
+            future.set_result(self.latest[topic]['snapshot'])
+        finally:
+            del self.refreshing[topic]
+            if not future.done():
+                future.cancel()
+        return future.result()
+
+    async def get(self, topic, max_age=None):
+        """
+        Latest snapshot of a topic
+
+        :param topic: name of the topic
+        :param max_age: seconds, the topic is polled again when the cached
+                        snapshot is older.  None always uses the cache
+        :return: dictionary with the snapshot data and its 'time' and 'age'
+        """
+        if topic not in self.topics:
+            return {'error': "Unknown topic: %s" % topic}
+
+        latest = self.latest.get(topic)
+        if latest is None or (max_age is not None and
+                              time.time() - latest['snapshot']['time'] >
+                              max_age):
+            snapshot = await self.refresh(topic)
+        else:
+            snapshot = latest['snapshot']
+
+        if 'error' in snapshot:
+            return {'error': snapshot['error']}
+        return {'data': {'topic': topic, 'time': snapshot['time'],
+                         'age': time.time() - snapshot['time'],
+                         'data': snapshot['data']}}
+
+    async def poll_device(self, device):
+        """
+        Poll the topics of one device when they are due, forever
+        """
+        due = {topic: 0 for topic in self.devices[device]
+               if self.topics[topic]['interval']}
+        while due:
+            for topic in sorted(due, key=due.get):
+                if due[topic] > time.time():
+                    break
+                await self.refresh(topic)
+                due[topic] = time.time() + self.topics[topic]['interval']
+            await asyncio.sleep(max(min(due.values()) - time.time(), 0.05))
+
+    async def run(self):
+        """
+        Run the pollers of all the devices, added to the server background
+        tasks
+        """
+        await asyncio.gather(*[self.poll_device(device)
+                               for device in self.devices])